@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+async_download.py
+=================
+
+asyncio-based alternative to `download_nlm_data.retrieve_nlm_files`.
+
+Transfers run over a small FTP client built on asyncio streams, so
+many control and data connections share a single thread. Disk writes
+are handed to the default thread pool and overlap with reads from the
+network. Recording, verifying and exporting completed files (and every
+other use of the downloads database) happens on one dedicated thread,
+so it never stalls transfers.
+
+(c) 2014, Edward J. Stronge
+Available under the GPLv3 - see LICENSE for details.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import ftplib
+import hashlib
+import os
+from os import path
+import socket
+import time
+
+from . import download_nlm_data as downloader
+from . import nlm_downloads_db as ftp_db
+from . import run_metrics
+from . import scheduler
+
+
+class AsyncFTP(object):
+    """Minimal FTP client supporting the commands needed by the downloader
+
+    Replies are mapped to the same exceptions ftplib raises (error_temp
+    for 4xx, error_perm for 5xx and error_reply for anything
+    unexpected).
+    """
+
+    def __init__(self, reader, writer, encoding='utf-8'):
+        self.reader = reader
+        self.writer = writer
+        self.encoding = encoding
+        self.host = writer.get_extra_info('peername')[0]
+        self.family = writer.get_extra_info('socket').family
+        self._data_reader = None
+        self._data_writer = None
+
+    @classmethod
+    async def connect(cls, host, port=21, user='anonymous', password=''):
+        """Return a logged-in AsyncFTP connected to `host`"""
+        reader, writer = await asyncio.open_connection(host, port)
+        client = cls(reader, writer)
+        await client.get_response()
+        response = await client.send_command(
+            'USER %s' % user, expected=('2', '3'))
+        if response.startswith('3'):
+            await client.send_command('PASS %s' % password)
+        await client.send_command('TYPE I')
+        return client
+
+    async def get_response(self):
+        """Read a (possibly multi-line) reply from the server"""
+        line = (await self.reader.readline()).decode(self.encoding)
+        if not line:
+            raise EOFError('FTP control connection closed')
+        response = [line.rstrip('\r\n')]
+        if line[3:4] == '-':
+            code = line[:3]
+            while True:
+                line = (await self.reader.readline()).decode(self.encoding)
+                if not line:
+                    raise EOFError('FTP control connection closed')
+                response.append(line.rstrip('\r\n'))
+                if line[:3] == code and line[3:4] != '-':
+                    break
+        return '\n'.join(response)
+
+    async def check_response(self, expected=('2',)):
+        """Read a reply and raise unless it starts with `expected`"""
+        response = await self.get_response()
+        if response[:1] in expected:
+            return response
+        if response[:1] == '4':
+            raise ftplib.error_temp(response)
+        if response[:1] == '5':
+            raise ftplib.error_perm(response)
+        raise ftplib.error_reply(response)
+
+    async def send_command(self, command, expected=('2',)):
+        self.writer.write(('%s\r\n' % command).encode(self.encoding))
+        await self.writer.drain()
+        return await self.check_response(expected)
+
+    async def open_transfer(self, command, rest=None):
+        """Start a transfer for `command`; return the data stream reader
+
+        Call `finish_transfer` once the data has been read.
+        """
+        if self.family == socket.AF_INET6:
+            _, port = ftplib.parse229(
+                await self.send_command('EPSV'), self.host)
+        else:
+            _, port = ftplib.parse227(await self.send_command('PASV'))
+        # Like ftplib, ignore the address in the PASV reply and reuse
+        # the control connection's peer
+        self._data_reader, self._data_writer = await asyncio.open_connection(
+            self.host, port)
+        try:
+            if rest:
+                await self.send_command('REST %d' % rest, expected=('3',))
+            await self.send_command(command, expected=('1',))
+        except BaseException:
+            # The server refused the transfer; don't leak its connection
+            self._data_writer.close()
+            self._data_reader = self._data_writer = None
+            raise
+        return self._data_reader
+
+    async def finish_transfer(self):
+        self._data_writer.close()
+        self._data_reader = self._data_writer = None
+        return await self.check_response()
+
+    async def mlsd_lines(self, server_dir):
+        """Yield lines of the MLSD listing for `server_dir`"""
+        await self.send_command('TYPE A')
+        try:
+            data = await self.open_transfer('MLSD %s' % server_dir)
+            while True:
+                line = await data.readline()
+                if not line:
+                    break
+                yield line.decode(self.encoding).rstrip('\r\n')
+            await self.finish_transfer()
+        finally:
+            await self.send_command('TYPE I')
+
+    async def quit(self):
+        try:
+            await self.send_command('QUIT')
+        except (ftplib.Error, OSError, EOFError):
+            pass
+        finally:
+            self.writer.close()
+
+
+async def download_file(client, file_info, output_dir, metrics=None,
+                        bucket=None):
+    """asyncio version of `download_nlm_data.download_file`
+
+    Partial files are resumed and the hash is computed as blocks
+    arrive. Each block's write runs in a worker thread while the next
+    block is read from the network. Blocks are throttled by `bucket`, a
+    scheduler.TokenBucket, if one is given.
+    """
+    loop = asyncio.get_running_loop()
+    output_path = path.join(output_dir, file_info.filename)
+    expected_size = int(file_info.size) if file_info.size else None
+    observed_md5 = hashlib.md5()
+
+    offset = 0
+    if expected_size and path.exists(output_path):
+        existing_size = path.getsize(output_path)
+        if existing_size < expected_size:
+            offset = existing_size
+            await loop.run_in_executor(
+                None, downloader.hash_file, output_path, observed_md5)
+            if metrics is not None:
+                metrics.record_retry(file_info.filename)
+    if not offset:
+        # The old copy may be hard-linked to a staged export
+        await loop.run_in_executor(
+            None, downloader.remove_existing, output_path)
+
+    new_file = await loop.run_in_executor(
+        None, open, output_path, 'ab' if offset else 'wb')
+    pending_write = None
+    try:
+        with run_metrics.timed(
+                metrics, file_info.filename, 'download',
+                expected_size - offset if expected_size else None):
+            data = await client.open_transfer(
+                'RETR %s' % file_info.filename, rest=offset)
+            while True:
+                block = await data.read(downloader.DOWNLOAD_BLOCKSIZE)
+                if pending_write is not None:
+                    await pending_write
+                    pending_write = None
+                if not block:
+                    break
+                if bucket is not None:
+                    await asyncio.sleep(bucket.reserve(len(block)))
+                observed_md5.update(block)
+                pending_write = loop.run_in_executor(
+                    None, new_file.write, block)
+            await client.finish_transfer()
+    finally:
+        if pending_write is not None:
+            await pending_write
+        await loop.run_in_executor(None, new_file.close)
+
+    final_size = os.stat(output_path).st_size
+    if expected_size is not None and final_size != expected_size:
+        raise downloader.IncompleteDownloadError(
+            '%s: expected %d bytes, have %d' % (
+                file_info.filename, expected_size, final_size))
+    return file_info._replace(
+        download_date=time.strftime('%Y%m%d%H%M%S'),
+        observed_md5=observed_md5.hexdigest(),
+        output_path=output_path)
+
+
+async def retrieve_nlm_files_async(
+        ftp_params, server_dir, output_dir, db_con, limit=0, concurrency=8,
+        port=21, commit_every=1, commit_interval=None, export_dir=None,
+        metrics=None, max_bytes=0, order='listing', max_rate=None):
+    """Coroutine downloading new files with up to `concurrency` connections
+
+    Each completed file is recorded (and exported, if `export_dir` is
+    given) as soon as it finishes; see
+    `download_nlm_data.process_download`. Archives already held are
+    reused as by `download_nlm_data.retrieve_nlm_files`.
+
+    See `retrieve_nlm_files` for the synchronous wrapper.
+    """
+    output_dir = path.abspath(output_dir)
+    clients = []
+
+    async def connect():
+        client = await AsyncFTP.connect(
+            ftp_params.host, port, ftp_params.user, ftp_params.password)
+        clients.append(client)
+        await client.send_command('CWD %s' % server_dir)
+        return client
+
+    retrieved_files = []
+    errors = []
+    update = None
+    recorder = ftp_db.DownloadRecorder(
+        db_con, batch_size=commit_every, max_delay=commit_interval)
+    loop = asyncio.get_running_loop()
+    # The only thread touching db_con during the run
+    db_executor = ThreadPoolExecutor(max_workers=1)
+
+    def in_db_thread(function, *args):
+        return loop.run_in_executor(db_executor, function, *args)
+
+    try:
+        listing_client = await connect()
+        mlsd_lines = []
+        async for line in listing_client.mlsd_lines(server_dir):
+            mlsd_lines.append(line)
+        update = await in_db_thread(
+            downloader.check_listing, server_dir, mlsd_lines, db_con)
+        if update is None:
+            return retrieved_files
+        bucket = scheduler.TokenBucket(max_rate) if max_rate else None
+        md5_files = [
+            await download_file(
+                listing_client, f, output_dir, metrics, bucket)
+            for f in await in_db_thread(
+                downloader.md5_files_to_fetch, update, db_con)]
+        update, reused = await in_db_thread(
+            downloader.reuse_local_copies, update, output_dir, db_con,
+            md5_files, metrics)
+        for file_info in md5_files + reused:
+            retrieved_files.append(file_info)
+            await in_db_thread(
+                downloader.process_download, file_info, recorder,
+                export_dir, metrics)
+
+        pending = asyncio.Queue()
+        for file_info in downloader.schedule_downloads(
+                update, output_dir, limit, max_bytes, order):
+            pending.put_nowait(file_info)
+
+        async def worker(client):
+            while not errors and not pending.empty():
+                file_info = pending.get_nowait()
+                try:
+                    if client is None:
+                        client = await connect()
+                    downloaded = await download_file(
+                        client, file_info, output_dir, metrics, bucket)
+                except Exception as error:
+                    errors.append(error)
+                    return
+                retrieved_files.append(downloaded)
+                await in_db_thread(
+                    downloader.process_download, downloaded, recorder,
+                    export_dir, metrics)
+
+        n_workers = max(1, min(concurrency, pending.qsize()))
+        await asyncio.gather(*(
+            worker(listing_client if i == 0 else None)
+            for i in range(n_workers)))
+    finally:
+        # Record successful downloads even after a download failure
+        await in_db_thread(recorder.flush)
+        if update is not None:
+            await in_db_thread(
+                downloader.save_listing_snapshot, update, retrieved_files,
+                db_con)
+        db_executor.shutdown()
+        await asyncio.gather(*(client.quit() for client in clients))
+    if errors:
+        raise errors[0]
+    return retrieved_files
+
+
+def retrieve_nlm_files(ftp_params, server_dir, output_dir, db_con, **kwargs):
+    """Download new files from `server_dir` to `output_dir` with asyncio
+
+        ftp_params - download_nlm_data.FTPConnectionParams for the server
+        concurrency - number of simultaneous FTP connections
+
+    Other arguments and the return value are as for
+    `download_nlm_data.retrieve_nlm_files`.
+    """
+    return asyncio.run(retrieve_nlm_files_async(
+        ftp_params, server_dir, output_dir, db_con, **kwargs))
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+daemon.py
+=========
+
+Long-running alternative to running `download_nlm_data.main` from cron.
+
+One logged-in FTP connection is kept open between polls (with NOOP
+keepalives and transparent reconnects). The server directory is
+re-listed on an interval that backs off while nothing changes, and the
+downloads database is only consulted when the listing differs from the
+previous poll.
+
+(c) 2014, Edward J. Stronge
+Available under the GPLv3 - see LICENSE for details.
+"""
+from contextlib import closing
+import ftplib
+import time
+
+from . import download_nlm_data as downloader
+from . import nlm_downloads_db as ftp_db
+
+# Errors meaning the control connection should be replaced
+CONNECTION_ERRORS = ftplib.all_errors + (EOFError,)
+
+
+class KeepaliveConnection(object):
+    """Holds a connection from `connection_factory`, reconnecting as needed
+
+    `get` returns the open connection, first checking it with NOOP if it
+    has been idle for `keepalive_interval` seconds.
+    """
+
+    def __init__(self, connection_factory, keepalive_interval=60,
+                 clock=time.monotonic):
+        self.connection_factory = connection_factory
+        self.keepalive_interval = keepalive_interval
+        self.clock = clock
+        self.connection = None
+        self.last_used = None
+
+    def get(self):
+        if self.connection is None:
+            self.reconnect()
+        elif self.clock() - self.last_used >= self.keepalive_interval:
+            self.keepalive()
+        self.last_used = self.clock()
+        return self.connection
+
+    def keepalive(self):
+        """Send NOOP, replacing the connection if it has gone away"""
+        if self.connection is None:
+            return
+        try:
+            self.connection.voidcmd('NOOP')
+        except CONNECTION_ERRORS:
+            self.reconnect()
+        self.last_used = self.clock()
+
+    def reconnect(self):
+        self.close()
+        self.connection = self.connection_factory()
+        self.last_used = self.clock()
+
+    def close(self):
+        if self.connection is None:
+            return
+        try:
+            self.connection.quit()
+        except CONNECTION_ERRORS:
+            self.connection.close()
+        self.connection = None
+
+
+class PollBackoff(object):
+    """Poll interval starting at `min_interval` seconds, multiplied by
+    `factor` after every unchanged poll up to `max_interval`
+    """
+
+    def __init__(self, min_interval=300, max_interval=3600, factor=2):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.interval = min_interval
+
+    def changed(self):
+        self.interval = self.min_interval
+
+    def unchanged(self):
+        self.interval = min(self.max_interval, self.interval * self.factor)
+
+
+def sleep_with_keepalive(seconds, keeper, sleep=time.sleep):
+    """Sleep for `seconds`, sending keepalives over `keeper` meanwhile"""
+    remaining = seconds
+    while remaining > 0:
+        step = min(remaining, keeper.keepalive_interval)
+        sleep(step)
+        remaining -= step
+        if remaining > 0:
+            keeper.keepalive()
+
+
+def poll_once(keeper, server_dir, output_dir, db_con, last_digest=None,
+              **retrieve_kwargs):
+    """List `server_dir` and download new files if the listing changed
+
+    Returns a (digest, retrieved files) tuple; the retrieved files are
+    None if the listing matched `last_digest`. Other arguments are
+    passed to `download_nlm_data.retrieve_nlm_files`.
+    """
+    connection = keeper.get()
+    connection.cwd(server_dir)
+    with closing(downloader.iter_mlsd_lines(
+            connection, server_dir)) as mlsd_lines:
+        mlsd_lines = list(mlsd_lines)
+    digest = ftp_db.listing_digest(mlsd_lines)
+    if digest == last_digest:
+        return digest, None
+    retrieved_files = downloader.retrieve_nlm_files(
+        connection, server_dir, output_dir, db_con, mlsd_lines=mlsd_lines,
+        **retrieve_kwargs)
+    return digest, retrieved_files
+
+
+def run_daemon(
+        connection_factory, server_dir, output_dir, db_con,
+        min_interval=300, max_interval=3600, keepalive_interval=60,
+        should_stop=None, on_update=None, on_error=None,
+        metrics_factory=None, sleep=time.sleep, **retrieve_kwargs):
+    """Poll `server_dir` and download new files until `should_stop()`
+    returns True (forever by default)
+
+        on_update - called with the retrieved files after each poll
+            that downloaded any
+        on_error - called with the exception when a poll fails; the
+            connection is replaced and the poll retried, backing off
+            while failures persist. Without it, errors are raised.
+        metrics_factory - returns a run_metrics.RunMetrics for each
+            poll that downloads files; polls retried after an error
+            are counted as retries
+
+    `connection_factory` is also used for the extra connections when
+    `workers` > 1. Other keyword arguments are passed to
+    `download_nlm_data.retrieve_nlm_files`.
+    """
+    keeper = KeepaliveConnection(connection_factory, keepalive_interval)
+    backoff = PollBackoff(min_interval, max_interval)
+    retrieve_kwargs.setdefault('connection_factory', connection_factory)
+    last_digest = None
+    retrying = False
+    try:
+        while should_stop is None or not should_stop():
+            metrics = metrics_factory() if metrics_factory else None
+            if retrying and metrics is not None:
+                metrics.record_retry()
+            try:
+                digest, retrieved_files = poll_once(
+                    keeper, server_dir, output_dir, db_con, last_digest,
+                    metrics=metrics, **retrieve_kwargs)
+            except Exception as error:
+                if metrics is not None:
+                    metrics.finish(success=False)
+                if on_error is None:
+                    raise
+                on_error(error)
+                keeper.close()
+                if retrying:
+                    backoff.unchanged()
+                else:
+                    backoff.changed()
+                retrying = True
+            else:
+                retrying = False
+                if retrieved_files is not None:
+                    # With a limit in force, files may remain to be
+                    # downloaded from an unchanged listing
+                    limited = retrieve_kwargs.get('limit') or \
+                        retrieve_kwargs.get('max_bytes')
+                    last_digest = None if limited and retrieved_files \
+                        else digest
+                if not retrieved_files:
+                    backoff.unchanged()
+                else:
+                    if metrics is not None:
+                        metrics.finish(success=True)
+                    backoff.changed()
+                    if on_update is not None:
+                        on_update(retrieved_files)
+            if should_stop is not None and should_stop():
+                break
+            sleep_with_keepalive(backoff.interval, keeper, sleep)
+    finally:
+        keeper.close()
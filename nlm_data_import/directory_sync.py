@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+directory_sync.py
+=================
+
+Sync several NLM server directories (e.g. the baseline and the update
+files) in one run. Listings and downloads for every directory share a
+single pool of FTP connections, while all database writes happen in
+the calling thread.
+
+(c) 2014, Edward J. Stronge
+Available under the GPLv3 - see LICENSE for details.
+"""
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
+import ftplib
+from os import path
+import threading
+
+from . import download_nlm_data as downloader
+from . import nlm_downloads_db as ftp_db
+from . import scheduler
+
+# A server directory with the local directories its files are saved
+# to and exported from
+SyncTarget = namedtuple('SyncTarget', 'server_dir output_dir export_dir')
+
+
+def parse_sync_target(spec, output_dir, export_dir):
+    """Return a SyncTarget for `spec`, SERVER_DIR[:OUTPUT_DIR[:EXPORT_DIR]]
+
+    `output_dir` and `export_dir` are used where `spec` doesn't give
+    them.
+    """
+    parts = spec.split(':')
+    if len(parts) > 3 or not parts[0]:
+        raise ValueError('Invalid server directory %r' % spec)
+    parts += [''] * (3 - len(parts))
+    return SyncTarget(
+        parts[0], parts[1] or output_dir, parts[2] or export_dir)
+
+
+class ConnectionPool(object):
+    """Thread pool whose workers each hold their own FTP connection
+
+    Connections are opened with `connection_factory` when a worker first
+    needs one and change directory only when a task is for a different
+    server directory than the worker's last.
+    """
+
+    def __init__(self, connection_factory, workers):
+        self.connection_factory = connection_factory
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def connection(self, server_dir):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.connection_factory()
+            self.local.connection = connection
+            self.local.server_dir = None
+            with self.lock:
+                self.connections.append(connection)
+        if self.local.server_dir != server_dir:
+            connection.cwd(server_dir)
+            self.local.server_dir = server_dir
+        return connection
+
+    def submit(self, server_dir, function, *args):
+        """Call `function(connection, *args)` on a worker whose connection
+        is in `server_dir`; return a Future
+        """
+        return self.executor.submit(
+            lambda: function(self.connection(server_dir), *args))
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        for connection in self.connections:
+            try:
+                connection.quit()
+            except ftplib.all_errors:
+                connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def fetch_listing(connection, server_dir):
+    """Return the lines of the MLSD listing of `server_dir`"""
+    with closing(downloader.iter_mlsd_lines(
+            connection, server_dir)) as mlsd_lines:
+        return list(mlsd_lines)
+
+
+def download_jobs(pool, jobs, metrics=None, bucket=None):
+    """Download (SyncTarget, FTPFileParams) `jobs` over `pool`
+
+    Yields (SyncTarget, downloaded FTPFileParams) pairs as transfers
+    complete. If a transfer fails, queued transfers are cancelled and
+    the first error is raised once the in-flight transfers have been
+    yielded. Outstanding transfers are also cancelled if the caller
+    stops early.
+    """
+    futures = {
+        pool.submit(target.server_dir, downloader.download_file, file_info,
+                    target.output_dir, metrics, bucket): target
+        for target, file_info in jobs}
+    first_error = None
+    try:
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            try:
+                yield futures[future], future.result()
+            except Exception as error:
+                if first_error is None:
+                    first_error = error
+                    for pending in futures:
+                        pending.cancel()
+    finally:
+        for future in futures:
+            future.cancel()
+    if first_error is not None:
+        raise first_error
+
+
+def retrieve_directories(
+        targets, db_con, connection_factory, workers=4, limit=0,
+        max_bytes=0, order='listing', max_rate=None, commit_every=1,
+        commit_interval=None, queue_size=4, metrics=None):
+    """Download new files from every SyncTarget in `targets`
+
+    All directories are listed and downloaded concurrently over one
+    pool of `workers` connections from `connection_factory`. Completed
+    files are exported and recorded in this thread as they arrive (see
+    `download_nlm_data.process_download`). Archives already held are
+    reused rather than downloaded (see
+    `download_nlm_data.reuse_local_copies`). `limit` and `max_bytes`
+    apply to each directory separately; other arguments are as for
+    `download_nlm_data.retrieve_nlm_files`.
+
+    Returns a dict mapping each server directory to its retrieved files.
+    """
+    targets = [target._replace(output_dir=path.abspath(target.output_dir))
+               for target in targets]
+    retrieved_files = {target.server_dir: [] for target in targets}
+    updates = []
+    recorder = ftp_db.DownloadRecorder(
+        db_con, batch_size=commit_every, max_delay=commit_interval)
+    with ConnectionPool(connection_factory, workers) as pool:
+        try:
+            listings = [
+                pool.submit(target.server_dir, fetch_listing,
+                            target.server_dir)
+                for target in targets]
+            bucket = scheduler.TokenBucket(max_rate) if max_rate else None
+            checked = []
+            for target, listing in zip(targets, listings):
+                update = downloader.check_listing(
+                    target.server_dir, listing.result(), db_con)
+                if update is not None:
+                    checked.append((target, update))
+
+            # Checksums of possibly re-published archives come first
+            md5_jobs = [
+                (target, file_info) for target, update in checked
+                for file_info in downloader.md5_files_to_fetch(
+                    update, db_con)]
+            md5_files = {target.server_dir: [] for target in targets}
+            for target, file_info in download_jobs(
+                    pool, md5_jobs, metrics, bucket):
+                md5_files[target.server_dir].append(file_info)
+
+            jobs = []
+            for target, update in checked:
+                update, reused = downloader.reuse_local_copies(
+                    update, target.output_dir, db_con,
+                    md5_files[target.server_dir], metrics)
+                updates.append(update)
+                for file_info in md5_files[target.server_dir] + reused:
+                    retrieved_files[target.server_dir].append(file_info)
+                    downloader.process_download(
+                        file_info, recorder, target.export_dir, metrics)
+                jobs.extend(
+                    (target, file_info)
+                    for file_info in downloader.schedule_downloads(
+                        update, target.output_dir, limit, max_bytes, order))
+
+            for target, file_info in downloader.run_in_background(
+                    download_jobs(pool, jobs, metrics, bucket), queue_size):
+                retrieved_files[target.server_dir].append(file_info)
+                downloader.process_download(
+                    file_info, recorder, target.export_dir, metrics)
+        finally:
+            # Record successful downloads even after a download failure
+            recorder.flush()
+            for update in updates:
+                downloader.save_listing_snapshot(
+                    update, retrieved_files[update.server_dir], db_con)
+    return retrieved_files
@@ -4,7 +4,9 @@ ftp_update_job.py
 =================
 
 Script for retrieving Medline records from the NLM FTP server.  Run
-this as a cron job.
+this as a cron job, or keep it running with `--daemon` (see
+`daemon.run_daemon`). `--plan` reports what a run would download
+without downloading it (see `planner`).
 
 NOTE: This script requires that a netrc file exist and contain
 only an entry for the NLM public server. See `man 5 netrc` for details
@@ -14,21 +16,35 @@ on the netrc file format.
 Available under the GPLv3 - see LICENSE for details.
 """
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
+import functools
 import hashlib
 import ftplib
+import json
 import netrc
 import os
 from os import path
+import queue
 import re
-import shutil
-import io
+import threading
 import traceback
 import time
 
 from send_ses_message.send_smtp_ses_email import \
     get_smtp_parameters, get_server_reference
 
+from . import async_download
+from . import daemon
+from . import directory_sync
+from . import export_watcher
+from . import gzip_index
 from . import nlm_downloads_db as ftp_db
+from . import notifications
+from . import planner
+from . import pmid_index
+from . import run_metrics
+from . import scheduler
 
 
 FTPConnectionParams = namedtuple(
@@ -39,6 +55,20 @@ FTPFileParams = namedtuple(
     'modification_date size unique_file_id filename download_date'
     ' observed_md5 output_path')
 
+# A server directory listing compared with its stored snapshot; see
+# `check_listing`
+ListingUpdate = namedtuple(
+    'ListingUpdate',
+    'server_dir digest file_listing files_to_download reissued')
+
+# Size of the blocks requested from retrbinary. Each block is written
+# and hashed as soon as it arrives.
+DOWNLOAD_BLOCKSIZE = 64 * 1024
+
+
+class IncompleteDownloadError(Exception):
+    """Raised when a transfer ends before the advertised file size"""
+
 
 # Examples of files from an mlsd listings. There's one record per line.
 #
@@ -47,10 +77,18 @@ FTPFileParams = namedtuple(
 #
 # modify=20131125174556;perm=adfr;size=63;type=file;unique=4600001UEA02;
 #     UNIX.group=183;UNIX.mode=0644;UNIX.owner=505; medline14n0002.xml.gz.md5
-def parse_mlsd(line):
-    """Parses lines of text from an FTP directory listing
-    (see examples above)
-    """
+#
+# The NLM server always lists facts in the order above, so lines can
+# usually be parsed in one pass with MLSD_FAST_PATTERN. Lines with
+# facts in another order (or missing facts, as for some directories)
+# fall back to the general parser.
+MLSD_FAST_PATTERN = re.compile(
+    r'modify=([^;]*);(?:[^;]*;)*?size=([^;]*);(?:[^;]*;)*?type=([^;]*);'
+    r'(?:[^;]*;)*?unique=([^;]*);[^ ]* (.*?)\s*$')
+
+
+def _parse_mlsd_facts(line):
+    """Parses any MLSD line by splitting each of its facts"""
     metadata_string, filename = line.split()
     metadata = {}
     for param in metadata_string.split(';'):
@@ -65,6 +103,19 @@ def parse_mlsd(line):
         filename, '', '', '')
 
 
+def parse_mlsd(line):
+    """Parses lines of text from an FTP directory listing
+    (see examples above)
+    """
+    match = MLSD_FAST_PATTERN.match(line)
+    if match is None:
+        return _parse_mlsd_facts(line)
+    modify, size, file_type, unique, filename = match.groups()
+    if file_type != 'file':
+        return
+    return FTPFileParams(modify, size, unique, filename, '', '', '')
+
+
 def get_file_listing(ftp_files, skip_patterns=None):
     """Returns tuples of file information for each file in ftp_files
 
@@ -76,24 +127,508 @@ def get_file_listing(ftp_files, skip_patterns=None):
     """
     if skip_patterns is None:
         skip_patterns = (r'.*stats\.html$', r'.*\.dat$')
-    skip_patterns = tuple(re.compile(p) for p in skip_patterns)
+    if isinstance(skip_patterns, str):
+        raise TypeError('skip_patterns should be a collection of patterns')
+    skip_pattern = re.compile(
+        '|'.join('(?:%s)' % p for p in skip_patterns) or '(?!)')
 
     for line in ftp_files:
         listing = parse_mlsd(line)
         if listing is None:
             continue
-        if any(p.match(listing.filename) for p in skip_patterns):
+        if skip_pattern.match(listing.filename):
             continue
         yield listing
 
 
+def iter_mlsd_lines(connection, server_dir):
+    """Yield lines of the MLSD listing for `server_dir` as they arrive
+
+    The data connection is opened in ASCII mode explicitly; retrbinary
+    switches the connection back to BINARY mode before each download.
+    """
+    connection.voidcmd('TYPE A')
+    data_connection = connection.transfercmd('MLSD %s' % server_dir)
+    completed = False
+    try:
+        with data_connection.makefile(
+                'r', encoding=connection.encoding) as listing:
+            for line in listing:
+                yield line.rstrip('\r\n')
+        completed = True
+    finally:
+        data_connection.close()
+        try:
+            connection.voidresp()
+        except ftplib.error_temp:
+            # The server reports an aborted transfer if the listing
+            # wasn't read to the end
+            if completed:
+                raise
+
+
+def connect_to_nlm(ftp_params):
+    """Return an ftplib.FTP connection logged in with `ftp_params`"""
+    return ftplib.FTP(
+        host=ftp_params.host, user=ftp_params.user, passwd=ftp_params.password)
+
+
+def get_ftp_connection_params(netrc_file):
+    """Read FTPConnectionParams for the NLM server from `netrc_file`"""
+    nlm_netrc = netrc.netrc(file=path.expanduser(netrc_file))
+    assert len(nlm_netrc.hosts.keys()
+               ) == 1, "The netrc file should contain only one record"
+    for server, params in nlm_netrc.hosts.items():
+        ftp_params = FTPConnectionParams(*([server] + list(params)))
+    return ftp_params
+
+
+def hashing_writer(output_file, hasher):
+    """Return a retrbinary callback writing to `output_file` and `hasher`
+
+    Feeding the hash as blocks arrive means each file is only touched
+    once and memory use stays at one block regardless of file size.
+    """
+    def write(block):
+        output_file.write(block)
+        hasher.update(block)
+    return write
+
+
+def hash_file(file_path, hasher, blocksize=DOWNLOAD_BLOCKSIZE):
+    """Feed the contents of `file_path` to `hasher` block by block"""
+    with open(file_path, 'rb') as existing_file:
+        for block in iter(lambda: existing_file.read(blocksize), b''):
+            hasher.update(block)
+    return hasher
+
+
+def remove_existing(file_path):
+    """Unlink `file_path` if it exists"""
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+
+def download_file(connection, file_info, output_dir, metrics=None,
+                  bucket=None):
+    """Retrieve `file_info` over `connection` into `output_dir`.
+
+    If a partial copy of the file is already in `output_dir` (i.e., it is
+    smaller than the MLSD `size` fact), the transfer is resumed from the
+    end of that copy with a REST offset; the existing bytes are hashed
+    first so the observed md5 covers the whole file. Otherwise any
+    existing copy is unlinked rather than overwritten, since it may be
+    hard-linked to a staged export (see `stage_file`).
+
+    Returns `file_info` updated with the download date, observed md5
+    hash and local output path. Raises IncompleteDownloadError if the
+    transferred file is shorter than expected. The transfer is timed
+    (and a resumed transfer counted as a retry) if a
+    run_metrics.RunMetrics is given as `metrics`, and throttled by
+    `bucket`, a scheduler.TokenBucket, if one is given.
+    """
+    output_path = path.join(output_dir, file_info.filename)
+    expected_size = int(file_info.size) if file_info.size else None
+    observed_md5 = hashlib.md5()
+
+    offset = 0
+    if expected_size and path.exists(output_path):
+        existing_size = path.getsize(output_path)
+        if existing_size < expected_size:
+            offset = existing_size
+            hash_file(output_path, observed_md5)
+            if metrics is not None:
+                metrics.record_retry(file_info.filename)
+    if not offset:
+        remove_existing(output_path)
+
+    with open(output_path, 'ab' if offset else 'wb') as new_file, \
+            run_metrics.timed(
+                metrics, file_info.filename, 'download',
+                expected_size - offset if expected_size else None):
+        connection.retrbinary(
+            'RETR %s' % file_info.filename,
+            scheduler.throttled_writer(
+                hashing_writer(new_file, observed_md5), bucket),
+            blocksize=DOWNLOAD_BLOCKSIZE, rest=offset or None)
+
+    if expected_size is not None and \
+            path.getsize(output_path) != expected_size:
+        raise IncompleteDownloadError(
+            '%s: expected %d bytes, have %d' % (
+                file_info.filename, expected_size,
+                path.getsize(output_path)))
+    return file_info._replace(
+        download_date=time.strftime('%Y%m%d%H%M%S'),
+        observed_md5=observed_md5.hexdigest(),
+        output_path=output_path)
+
+
+def download_files_in_parallel(
+        files_to_download, server_dir, output_dir, connection_factory,
+        workers, metrics=None, bucket=None):
+    """Download `files_to_download` over a pool of `workers` connections.
+
+    Each worker thread lazily opens its own connection by calling
+    `connection_factory` and changes to `server_dir`. Completed
+    downloads are yielded as they finish. If any download fails, queued
+    downloads are cancelled and the first error is raised once the
+    in-flight downloads have been yielded. Queued downloads are also
+    cancelled if the caller stops early.
+    """
+    thread_data = threading.local()
+    connections = []
+    connections_lock = threading.Lock()
+
+    def fetch(file_info):
+        connection = getattr(thread_data, 'connection', None)
+        if connection is None:
+            connection = thread_data.connection = connection_factory()
+            with connections_lock:
+                connections.append(connection)
+            connection.cwd(server_dir)
+        return download_file(
+            connection, file_info, output_dir, metrics, bucket)
+
+    first_error = None
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(fetch, f) for f in files_to_download]
+            try:
+                for future in as_completed(futures):
+                    if future.cancelled():
+                        continue
+                    try:
+                        yield future.result()
+                    except Exception as error:
+                        if first_error is None:
+                            first_error = error
+                            for pending in futures:
+                                pending.cancel()
+            finally:
+                # Otherwise leaving the executor waits for every queued
+                # download, even after the caller has stopped
+                for pending in futures:
+                    pending.cancel()
+    finally:
+        for connection in connections:
+            try:
+                connection.quit()
+            except (ftplib.Error, OSError):
+                connection.close()
+    if first_error is not None:
+        raise first_error
+
+
+def run_in_background(iterable, queue_size=4):
+    """Iterate over `iterable` in a separate thread, yielding its items
+
+    At most `queue_size` items are buffered, so a slow consumer holds
+    the producer back. Exceptions raised by the producer are re-raised
+    in the consumer. If the consumer stops early, the producer is
+    stopped (and closed, if it's a generator) before returning.
+    """
+    items = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    finished = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put((item, None)):
+                    break
+        except BaseException as error:
+            put((finished, error))
+        else:
+            put((finished, None))
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is finished:
+                break
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+def copy_file_contents(source_fd, destination_fd, size):
+    """Copy `size` bytes between file descriptors inside the kernel
+
+    Uses copy_file_range where available, then sendfile, and falls back
+    to reading and writing blocks if neither works for these files.
+    """
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < size:
+                n_bytes = os.copy_file_range(
+                    source_fd, destination_fd, size - copied, copied, copied)
+                if n_bytes == 0:
+                    break
+                copied += n_bytes
+        except OSError:
+            pass
+    if copied < size and hasattr(os, 'sendfile'):
+        os.lseek(destination_fd, copied, os.SEEK_SET)
+        try:
+            while copied < size:
+                n_bytes = os.sendfile(
+                    destination_fd, source_fd, copied, size - copied)
+                if n_bytes == 0:
+                    break
+                copied += n_bytes
+        except OSError:
+            pass
+    while copied < size:
+        block = os.pread(
+            source_fd, min(DOWNLOAD_BLOCKSIZE, size - copied), copied)
+        if not block:
+            break
+        copied += os.pwrite(destination_fd, block, copied)
+    return copied
+
+
+def stage_file(source_path, destination_path, allow_link=True):
+    """Put a copy of `source_path` at `destination_path`
+
+    The file is hard-linked when both are on the same filesystem, so
+    staging only costs metadata operations; otherwise it is copied in
+    the kernel. Either way it is first staged under a temporary name
+    and renamed into place, so readers never see a partial file.
+    """
+    destination_dir, filename = path.split(destination_path)
+    temp_path = path.join(destination_dir, '.%s.partial' % filename)
+    if path.lexists(temp_path):
+        os.remove(temp_path)
+
+    source_stat = os.stat(source_path)
+    if allow_link and source_stat.st_dev == os.stat(destination_dir).st_dev:
+        os.link(source_path, temp_path)
+    else:
+        with open(source_path, 'rb') as source, \
+                open(temp_path, 'wb') as destination:
+            copied = copy_file_contents(
+                source.fileno(), destination.fileno(), source_stat.st_size)
+        if copied != source_stat.st_size:
+            os.remove(temp_path)
+            raise OSError('Copying %s to %s stopped after %d bytes' % (
+                source_path, temp_path, copied))
+    os.replace(temp_path, destination_path)
+
+
+def export_file(file_info, export_dir, allow_link=True):
+    """Stage a downloaded file in `export_dir`; return its export path
+
+    The local copy is kept (see `export_watcher` for cleaning it up once
+    the application has retrieved the export). The export is hard-linked
+    or copied with `stage_file`, so the application server never sees a
+    partial file.
+    """
+    export_path = path.join(export_dir, path.basename(file_info.output_path))
+    stage_file(file_info.output_path, export_path, allow_link)
+    return export_path
+
+
+def process_download(file_info, recorder, export_dir=None, metrics=None):
+    """Record a completed download, staging it in `export_dir` first if
+    one is given.
+    """
+    filename = file_info.filename
+    if metrics is not None:
+        metrics.record_queue_wait(filename)
+    export_location = None
+    if export_dir is not None:
+        with run_metrics.timed(metrics, filename, 'export'):
+            export_location = export_file(file_info, export_dir)
+    with run_metrics.timed(metrics, filename, 'record'):
+        recorder.add(file_info, export_location)
+    if metrics is not None:
+        metrics.file_done(filename)
+
+
+def check_listing(server_dir, mlsd_lines, db_con):
+    """Compare `mlsd_lines` with the stored snapshot of `server_dir`
+
+    Returns None if the listing is identical to the last one fully
+    processed, so it needn't even be parsed. Otherwise returns a
+    ListingUpdate with the files that changed and need downloading (see
+    `nlm_downloads_db.get_files_to_download`).
+    """
+    mlsd_lines = list(mlsd_lines)
+    digest = ftp_db.listing_digest(mlsd_lines)
+    if digest == ftp_db.get_listing_digest(server_dir, db_con):
+        return None
+    file_listing = list(get_file_listing(mlsd_lines))
+    files_to_download, reissued = ftp_db.get_files_to_download(
+        server_dir, file_listing, db_con)
+    return ListingUpdate(
+        server_dir, digest, file_listing, files_to_download, reissued)
+
+
+def schedule_downloads(update, output_dir, limit=0, max_bytes=0,
+                       order='listing'):
+    """Return the files from ListingUpdate `update` to download now,
+    ordered by `order` and cut to `limit` files and `max_bytes` bytes
+
+    Local copies of scheduled files that NLM has reissued are deleted so
+    they are downloaded afresh rather than resumed.
+    """
+    scheduled = scheduler.limit_downloads(
+        scheduler.order_downloads(update.files_to_download, order),
+        limit, max_bytes)
+    for file_info in scheduled:
+        if file_info.filename in update.reissued:
+            remove_existing(path.join(output_dir, file_info.filename))
+    return scheduled
+
+
+def md5_files_to_fetch(update, db_con):
+    """Return the `.md5` files from ListingUpdate `update` to download
+    ahead of their archives (see `reuse_local_copies`)
+
+    Only the checksums of new archives the same size as an archive
+    already recorded are worth fetching first.
+    """
+    scheduled = {f.filename: f for f in update.files_to_download}
+    return [
+        scheduled[f.filename + '.md5'] for f in update.files_to_download
+        if f.filename.endswith('.xml.gz') and
+        f.filename + '.md5' in scheduled and f.size and
+        ftp_db.has_archive_of_size(int(f.size), db_con)]
+
+
+def find_local_copy(file_info, md5_value, db_con):
+    """Return the path of a recorded archive with the size of
+    `file_info` and NLM's checksum `md5_value`, or None
+    """
+    expected_md5 = ftp_db.parse_nlm_md5(md5_value)
+    if expected_md5 is None:
+        return None
+    size = int(file_info.size)
+    for archive in ftp_db.get_archive_copies(size, expected_md5, db_con):
+        for location in (archive['download_location'],
+                         archive['export_location']):
+            if location and path.isfile(location) and \
+                    path.getsize(location) == size:
+                return location
+    return None
+
+
+def reuse_local_copies(update, output_dir, db_con, md5_files,
+                       metrics=None):
+    """Reuse archives already held for files NLM has only re-published
+
+    An archive from ListingUpdate `update` is reused when its size and
+    the checksum in its listed `.md5` file match an archive recorded
+    earlier whose copy is still on disk. That copy is staged in
+    `output_dir` with `stage_file` instead of being transferred again.
+    Checksums are read from `md5_files` (downloaded FTPFileParams; see
+    `md5_files_to_fetch`) or, if the `.md5` file is unchanged, from the
+    database.
+
+    Returns `update` without `md5_files` and the reused archives, and
+    the reused archives as downloaded FTPFileParams.
+    """
+    listed = {f.filename: f for f in update.file_listing}
+    md5_values = {}
+    for md5_file in md5_files:
+        with open(md5_file.output_path) as hash_file:
+            md5_values[md5_file.filename] = hash_file.read()
+
+    reused = []
+    for file_info in update.files_to_download:
+        md5_info = listed.get(file_info.filename + '.md5')
+        if not file_info.filename.endswith('.xml.gz') or \
+                md5_info is None or not file_info.size:
+            continue
+        md5_value = md5_values.get(md5_info.filename) or \
+            ftp_db.get_md5_value(md5_info.unique_file_id, db_con)
+        local_copy = md5_value and find_local_copy(
+            file_info, md5_value, db_con)
+        if not local_copy:
+            continue
+        output_path = path.join(output_dir, file_info.filename)
+        with run_metrics.timed(metrics, file_info.filename, 'reuse'):
+            if not (path.exists(output_path) and
+                    path.samefile(local_copy, output_path)):
+                stage_file(local_copy, output_path)
+        reused.append(file_info._replace(
+            download_date=time.strftime('%Y%m%d%H%M%S'),
+            observed_md5=ftp_db.parse_nlm_md5(md5_value),
+            output_path=output_path))
+
+    done = {f.filename for f in md5_files + reused}
+    remaining = [
+        f for f in update.files_to_download if f.filename not in done]
+    return update._replace(files_to_download=remaining), reused
+
+
+def save_listing_snapshot(update, retrieved_files, db_con):
+    """Store the listing from `update` once `retrieved_files` are
+    recorded; files not retrieved are checked again on the next run
+    """
+    retrieved = {f.filename for f in retrieved_files}
+    ftp_db.save_listing_snapshot(
+        update.server_dir, update.file_listing, db_con, update.digest,
+        pending=[f.filename for f in update.files_to_download
+                 if f.filename not in retrieved])
+    db_con.commit()
+
+
 def retrieve_nlm_files(
-        connection, server_dir, output_dir, db_con, limit=0):
+        connection, server_dir, output_dir, db_con, limit=0, workers=1,
+        connection_factory=None, commit_every=1, commit_interval=None,
+        export_dir=None, queue_size=4, metrics=None, max_bytes=0,
+        order='listing', max_rate=None, mlsd_lines=None):
     """Download new files from path `server_dir` to `output_dir` and record
     the filenames to db_con.
 
-        limit - Retrieve limit files if limit > 0
+    Downloads run in a background thread and are handed over through a
+    queue of at most `queue_size` files. Each completed file is staged
+    in `export_dir` (if given) and recorded while later files are still
+    downloading (see `process_download`).
+
+        limit, max_bytes - Retrieve at most limit new files and max_bytes
+            bytes if either is > 0 (see scheduler.limit_downloads)
+        order - scheduler.ORDERING_POLICIES entry for new files
+        max_rate - Bandwidth cap in bytes/second shared by all
+            connections
+        mlsd_lines - MLSD listing of `server_dir`, if it has already
+            been fetched
         connection - an ftplib.FTP object
+        workers - number of simultaneous FTP connections to download with
+        connection_factory - callable returning a new logged-in
+            ftplib.FTP object; required if workers > 1
+        commit_every, commit_interval - commit recorded downloads after
+            this many files or seconds (see
+            nlm_downloads_db.DownloadRecorder)
+
+    Only entries that changed since the last run are considered, and
+    nothing is done if the listing is unchanged (see `check_listing`).
+    Archives whose content is already held under another ID are reused
+    rather than downloaded (see `reuse_local_copies`); they don't count
+    towards `limit` or `max_bytes`.
 
     Returns a dict with the fields from FTPFileParams supplemented by
     the following keys:
@@ -102,131 +637,307 @@ def retrieve_nlm_files(
         observed_md5 - calculated md5 has for the referenced file
         output_path - path on local machine for the referenced file
     """
+    if workers > 1 and connection_factory is None:
+        raise ValueError('connection_factory is required when workers > 1')
     connection.cwd(server_dir)
-    # Not pretty, but I'm just getting a list of all the IDs I've
-    # already downloaded. This shouldn't ever exceed a few thousand
-    local_nlm_records = ftp_db.get_downloaded_file_unique_ids(db_con)
     retrieved_files = []
     output_dir = path.abspath(output_dir)
+    recorder = ftp_db.DownloadRecorder(
+        db_con, batch_size=commit_every, max_delay=commit_interval)
+    if mlsd_lines is None:
+        # The listing must be closed before the connection is reused
+        # for downloads
+        with closing(iter_mlsd_lines(connection, server_dir)) as lines:
+            mlsd_lines = list(lines)
+    update = check_listing(server_dir, mlsd_lines, db_con)
+    if update is None:
+        return retrieved_files
     try:
-        # Parsing the file listing should be done line-wise but ftplib
-        # complains when the NLM server changes mode from BINARY to
-        # ASCII and back again.  Using StringIO is a workaround.
-        #
-        # Eventually, should try using ftplib sendcmd to change mode
-        # before requesting a test file and reset the mode before
-        # requesting a binary file.
-        file_listing = io.StringIO()
-        connection.retrbinary('MLSD %s' % server_dir, file_listing.write)
-        file_listing.seek(0)
-
-        for i, file_info in enumerate(
-                get_file_listing(file_listing.readlines(), server_dir)):
-            if limit > 0 and i > limit:
-                break
-            if file_info.unique_file_id in local_nlm_records:
-                continue
-            output_path = path.join(output_dir, file_info.filename)
-            with open(output_path, 'wb+') as new_file:
-                connection.retrbinary(
-                    'RETR %s' % file_info.filename, new_file.write)
-                new_file.seek(0)
-                observed_md5 = hashlib.md5()
-                observed_md5.update(new_file.read())
-            file_info._replace(
-                download_date=time.strftime('%Y%m%d%H%M%S'),
-                observed_md5=observed_md5.digest(),
-                output_path=output_path)
+        bucket = scheduler.TokenBucket(max_rate) if max_rate else None
+        md5_files = [
+            download_file(connection, f, output_dir, metrics, bucket)
+            for f in md5_files_to_fetch(update, db_con)]
+        update, reused = reuse_local_copies(
+            update, output_dir, db_con, md5_files, metrics)
+        for file_info in md5_files + reused:
+            retrieved_files.append(file_info)
+            process_download(file_info, recorder, export_dir, metrics)
+
+        files_to_download = schedule_downloads(
+            update, output_dir, limit, max_bytes, order)
+
+        if workers > 1:
+            downloads = download_files_in_parallel(
+                files_to_download, server_dir, output_dir,
+                connection_factory, workers, metrics, bucket)
+        else:
+            downloads = (
+                download_file(connection, f, output_dir, metrics, bucket)
+                for f in files_to_download)
+        for file_info in run_in_background(downloads, queue_size):
             retrieved_files.append(file_info)
+            process_download(file_info, recorder, export_dir, metrics)
     finally:
         # Record successful downloads even after a download failure
-        ftp_db.record_downloads(retrieved_files, db_con)
+        recorder.flush()
+        save_listing_snapshot(update, retrieved_files, db_con)
     return retrieved_files
 
 
-def send_smtp_email(from_addr, to_addr, msg, server_cfg):
-    """Send msg to to_addr using the parameters in server_cfg"""
-    smtp_params = get_smtp_parameters(server_cfg)
-    smtp_con = get_server_reference(*smtp_params)
+def connect_to_smtp(server_cfg):
+    """Return an SMTP connection configured by the file `server_cfg`"""
+    return get_server_reference(*get_smtp_parameters(server_cfg))
 
-    smtp_con.sendmail(
-        from_addr, to_addr,
-        """From: {from_addr}\r\n
-           To: {to_addr}\r\n
 
-           {msg}
-        """.format(from_addr=from_addr, to_addr=to_addr, msg=msg))
+def get_notifier(args):
+    """Return a notifications.Notifier for the email settings in `args`,
+    or None if emails are disabled
+    """
+    if not args.email_debugging:
+        return None
+    return notifications.Notifier(
+        functools.partial(connect_to_smtp, args.smtp_cfg),
+        args.from_email, args.to_email, batch_delay=args.email_batch_delay)
 
 
 def move_files_for_export(exports_list, export_dir, db_con):
-    """Move downloaded files to the export directory.
+    """Stage downloaded files in the export directory.
 
        Uses ftp_update_db to update database files after successfully
-       moving all files.
+       staging all files (see `export_file`).
     """
-    for export in exports_list:
-        shutil.move(
-            export.output_path,
-            path.join(export_dir, path.basename(export.output_path)))
-    ftp_db.record_files_to_export(
-        [e.referenced_record for e in exports_list], db_con)
+    exports = [(export.unique_file_id, export_file(export, export_dir))
+               for export in exports_list]
+    ftp_db.record_exports(exports, db_con)
+
+
+def send_failure_email(notifier, targets, traceback_text):
+    """Queue the traceback of a failed download with `notifier`, if any"""
+    if notifier is None:
+        return
+    notifier.notify(
+        'NLM download failed',
+        """
+        At {date}, attempt to download new files from
+        {server_dir} failed.
+
+        Traceback text: {traceback_text}
+        """.format(date=time.strftime('%Y%m%d%H%M%S'),
+                   server_dir=', '.join(t.server_dir for t in targets),
+                   traceback_text=traceback_text))
+
+
+def report_update(args, db_con, targets, retrieved_files, notifier=None):
+    """Verify checksums, build the requested indexes, queue a summary of
+    `retrieved_files` with `notifier` and check the export directories
+    of `targets` after an update
+    """
+    success_email_text = "Downloaded all new files from %s. \n" % \
+        ', '.join(t.server_dir for t in targets)
+
+    checksums = ftp_db.verify_archive_checksums(
+        db_con, rehash=args.audit_md5)
+    ftp_db.withdraw_exports(checksums.mismatched, db_con)
+    db_con.commit()
+    # Archives from this update were checked as they were recorded (see
+    # `nlm_downloads_db.DownloadRecorder`)
+    retrieved_records = {ftp_db.get_record_name(f.filename)
+                         for f in retrieved_files} - {None}
+    mismatched = sorted(set(checksums.mismatched).union(
+        ftp_db.get_mismatched_archives(retrieved_records, db_con)))
+    if mismatched or checksums.missing:
+        success_email_text += """
+        Archives failing md5 verification:\n%s
+        Archives missing from disk:\n%s
+        """ % ('\n'.join(mismatched),
+               '\n'.join(checksums.missing))
+
+    if args.index_pmids:
+        index_report = pmid_index.index_archives(db_con)
+        if index_report.failed:
+            success_email_text += """
+        Archives that couldn't be indexed:\n%s
+        """ % '\n'.join('%s: %s' % failure
+                         for failure in index_report.failed)
+
+    if args.index_offsets:
+        offset_report = gzip_index.index_archive_offsets(db_con)
+        if offset_report.failed:
+            success_email_text += """
+        Archives that couldn't be indexed for random access:\n%s
+        """ % '\n'.join('%s: %s' % failure
+                         for failure in offset_report.failed)
+
+    # Files are moved to the export directory as they're downloaded
+    success_email_text += """
+
+        Moved the following files to the export directory:\n%s
+        """ % '\n'.join([f.filename for f in retrieved_files])
+
+    if notifier is not None:
+        notifier.notify(
+            'NLM update processed',
+            """
+
+        Finished processing an update at {date}.
+
+        {success_email_text}
+        """.format(date=time.strftime('%Y%m%d%H%M%S'),
+                   success_email_text=success_email_text))
+
+    # Check if the files that were moved to the export directory
+    # are still there or have been deleted (this would happen
+    # subsequent to a successful rsync download)
+    for export_dir in sorted({t.export_dir for t in targets}):
+        ftp_db.check_exported_file_directory(export_dir, db_con)
+
+
+def run_recorder(db_con, server_dir):
+    """Return a RunMetrics `on_finish` callback storing each run's
+    totals in the downloads database (see `planner`)
+    """
+    def record(totals):
+        ftp_db.record_download_run(server_dir, totals, db_con)
+        db_con.commit()
+    return record
+
+
+def run_as_daemon(args, ftp_params, db_con, target, notifier=None):
+    """Keep polling the NLM server, reporting each update (see
+    `daemon.run_daemon`)
+    """
+    def on_error(error):
+        send_failure_email(notifier, [target], traceback.format_exc())
+
+    daemon.run_daemon(
+        functools.partial(connect_to_nlm, ftp_params),
+        target.server_dir, target.output_dir, db_con,
+        min_interval=args.poll_interval,
+        max_interval=args.max_poll_interval,
+        on_update=functools.partial(
+            report_update, args, db_con, [target], notifier=notifier),
+        on_error=on_error,
+        metrics_factory=functools.partial(
+            run_metrics.RunMetrics, args.metrics_log,
+            args.prometheus_textfile,
+            labels={'server_dir': target.server_dir},
+            on_finish=run_recorder(db_con, target.server_dir)),
+        limit=args.limit, workers=args.workers,
+        export_dir=target.export_dir, max_bytes=args.limit_bytes,
+        order=args.order, max_rate=args.max_rate)
 
 
 def main(args):
-    """Connect to the NLM server and download all new files"""
+    """Connect to the NLM server and download all new files
+
+    Each of `args.server_data_dir` is a
+    SERVER_DIR[:OUTPUT_DIR[:EXPORT_DIR]] specification (see
+    `directory_sync.parse_sync_target`). Several directories are synced
+    together over a shared pool of `args.workers` connections.
+    """
+
+    if args.watch_exports:
+        with ftp_db.initialize_database_connection(
+                args.download_database) as db_con:
+            export_watcher.watch_export_directory(
+                args.export_dir, db_con, output_dir=args.output_dir)
+        return
+
+    targets = [
+        directory_sync.parse_sync_target(
+            spec, args.output_dir, args.export_dir)
+        for spec in args.server_data_dir]
 
     # FTP connection
-    nlm_netrc = netrc.netrc(file=path.expanduser(args.netrc))
-    assert len(nlm_netrc.hosts.keys()
-               ) == 1, "The netrc file should contain only one record"
-    for server, params in nlm_netrc.hosts.items():
-        ftp_params = FTPConnectionParams(*([server] + list(params)))
-    ftp_connection = ftplib.FTP(
-        host=ftp_params.host, user=ftp_params.user, passwd=ftp_params.password)
+    ftp_params = get_ftp_connection_params(args.netrc)
 
-    with ftp_db.initialize_database_connection(
-            args.download_database) as db_con:
-        try:
-            retrieved_files = retrieve_nlm_files(
-                connection=ftp_connection, server_dir=args.server_data_dir,
-                output_dir=args.output_dir, limit=args.limit, db_con=db_con)
-        except Exception:
-            if args.email_debugging:
-                send_smtp_email(
-                    args.from_email, args.to_email, server_cfg=args.smtp_cfg,
-                    msg="""
-                    At {date}, attempt to download new files from
-                    {server_dir} failed.
-
-                    Traceback text: {traceback_text}
-                    """.format(date=time.strftime('%Y%m%d%H%M%S'),
-                               server_dir=args.server_data_dir,
-                               traceback_text=traceback.format_exc()))
-            raise
-        success_email_text = "Downloaded all new files from %s. \n" % \
-            args.server_data_dir
+    if args.daemon and len(targets) > 1:
+        raise ValueError('Daemon mode syncs a single server directory')
 
-        move_files_for_export(retrieved_files, args.output_dir, db_con)
-        success_email_text += """
+    if args.plan:
+        print_plan(args, ftp_params, targets)
+        return
 
-            Moved the following files to the export directory:\n%s
-            """ % '\n'.join([f.filename for f in retrieved_files])
+    # Emails are sent in the background; whatever is still queued gets
+    # a bounded amount of time to go out at exit
+    notifier = get_notifier(args)
+    try:
+        if args.daemon:
+            with ftp_db.initialize_database_connection(
+                    args.download_database) as db_con:
+                run_as_daemon(args, ftp_params, db_con, targets[0], notifier)
+        else:
+            download_new_files(args, ftp_params, targets, notifier)
+    finally:
+        if notifier is not None:
+            notifier.close()
 
-        send_smtp_email(
-            args.from_email, args.to_email, server_cfg=args.smtp_cfg,
-            msg="""
 
-            Finished processing an update at {date}.
+def print_plan(args, ftp_params, targets):
+    """Print what a run would download without downloading it (see
+    `planner.plan_downloads`) in `args.plan_format`
+    """
+    connection = connect_to_nlm(ftp_params)
+    try:
+        with ftp_db.initialize_database_connection(
+                args.download_database) as db_con:
+            plan = planner.plan_downloads(
+                connection, targets, db_con, limit=args.limit,
+                max_bytes=args.limit_bytes, order=args.order)
+    finally:
+        connection.quit()
+    if args.plan_format == 'json':
+        print(json.dumps(planner.plan_as_dict(plan), indent=2))
+    else:
+        print(planner.format_plan(plan))
 
-            {success_email_text}
-            """.format(date=time.strftime('%Y%m%d%H%M%S'),
-                       success_email_text=success_email_text))
 
-        # Check if the files that were moved to the export directory
-        # are still there or have been deleted (this would happen
-        # subsequent to a successful rsync download)
-        ftp_db.check_exported_file_directory(
-            os.listdir(args.export_dir), db_con)
+def download_new_files(args, ftp_params, targets, notifier=None):
+    """Download new files from every SyncTarget in `targets` once and
+    report the update
+    """
+    server_dirs = ','.join(t.server_dir for t in targets)
+    with ftp_db.initialize_database_connection(
+            args.download_database) as db_con:
+        metrics = run_metrics.RunMetrics(
+            args.metrics_log, args.prometheus_textfile,
+            labels={'server_dir': server_dirs},
+            on_finish=run_recorder(db_con, server_dirs))
+        try:
+            if len(targets) > 1:
+                retrieved_files = [
+                    file_info for files in directory_sync.retrieve_directories(
+                        targets, db_con,
+                        functools.partial(connect_to_nlm, ftp_params),
+                        workers=args.workers, limit=args.limit,
+                        max_bytes=args.limit_bytes, order=args.order,
+                        max_rate=args.max_rate, metrics=metrics).values()
+                    for file_info in files]
+            elif args.backend == 'asyncio':
+                retrieved_files = async_download.retrieve_nlm_files(
+                    ftp_params, server_dir=targets[0].server_dir,
+                    output_dir=targets[0].output_dir, limit=args.limit,
+                    db_con=db_con, concurrency=args.workers,
+                    export_dir=targets[0].export_dir, metrics=metrics,
+                    max_bytes=args.limit_bytes, order=args.order,
+                    max_rate=args.max_rate)
+            else:
+                retrieved_files = retrieve_nlm_files(
+                    connection=connect_to_nlm(ftp_params),
+                    server_dir=targets[0].server_dir,
+                    output_dir=targets[0].output_dir, limit=args.limit,
+                    db_con=db_con, workers=args.workers,
+                    connection_factory=functools.partial(
+                        connect_to_nlm, ftp_params),
+                    export_dir=targets[0].export_dir, metrics=metrics,
+                    max_bytes=args.limit_bytes, order=args.order,
+                    max_rate=args.max_rate)
+        except Exception:
+            metrics.finish(success=False)
+            send_failure_email(notifier, targets, traceback.format_exc())
+            raise
+        metrics.finish(success=True)
+        report_update(args, db_con, targets, retrieved_files, notifier)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+export_watcher.py
+=================
+
+Long-running watcher for the export directory. When the application
+server removes exported archives, the downloads database is updated
+(see `nlm_downloads_db.check_exported_file_directory`) and the local
+copies of those archives are deleted.
+
+Changes are detected with inotify on Linux and by polling directory
+snapshots elsewhere. If the export directory itself is removed or
+moved (e.g., a share is unmounted), the watcher waits for it to come
+back and then starts watching it again.
+
+(c) 2014, Edward J. Stronge
+Available under the GPLv3 - see LICENSE for details.
+"""
+import ctypes
+import ctypes.util
+import os
+from os import path
+import select
+import struct
+import time
+
+from . import nlm_downloads_db as ftp_db
+
+
+# From <sys/inotify.h>
+IN_MOVED_FROM = 0x00000040
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+REMOVAL_EVENTS = IN_MOVED_FROM | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+# Events meaning the watch no longer follows the directory's path
+LOST_EVENTS = IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED
+
+# struct inotify_event, without its variable-length name
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class DirectoryGoneError(FileNotFoundError):
+    """The watched directory was removed or moved away"""
+
+
+def _load_libc():
+    """Return libc if it provides inotify, otherwise None"""
+    try:
+        libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class InotifyWatcher(object):
+    """Wait for files to be removed from `directory` using inotify"""
+
+    def __init__(self, directory, libc=None):
+        self.libc = libc or _load_libc()
+        if self.libc is None:
+            raise OSError('inotify is not available')
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        watch = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(directory), REMOVAL_EVENTS)
+        if watch < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+    def wait(self, timeout):
+        """Return True if files were removed within `timeout` seconds
+
+        Raises DirectoryGoneError if the directory itself was removed
+        or moved.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        # Drain every queued event; apart from the directory going
+        # away, only the fact that something changed matters
+        mask = 0
+        while True:
+            try:
+                events = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            if not events:
+                break
+            offset = 0
+            while offset < len(events):
+                _, event_mask, _, name_length = EVENT_HEADER.unpack_from(
+                    events, offset)
+                mask |= event_mask
+                offset += EVENT_HEADER.size + name_length
+        if mask & LOST_EVENTS:
+            raise DirectoryGoneError('watched directory was removed')
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """Detect changes to `directory` by comparing mtime snapshots"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.snapshot = self.take_snapshot()
+
+    def take_snapshot(self):
+        with os.scandir(self.directory) as entries:
+            return {entry.name: entry.stat().st_mtime_ns
+                    for entry in entries if entry.is_file()}
+
+    def wait(self, timeout):
+        """Return True if `directory` changed, checking after `timeout`
+        seconds
+
+        Raises DirectoryGoneError if the directory no longer exists.
+        """
+        time.sleep(timeout)
+        try:
+            snapshot = self.take_snapshot()
+        except FileNotFoundError:
+            raise DirectoryGoneError(
+                'watched directory was removed') from None
+        changed = snapshot != self.snapshot
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+def get_watcher(directory, use_inotify=None):
+    """Return an InotifyWatcher if possible, else a PollingWatcher
+
+    Set `use_inotify` to False to force polling or True to require
+    inotify.
+    """
+    if use_inotify is not False:
+        try:
+            return InotifyWatcher(directory)
+        except OSError:
+            if use_inotify:
+                raise
+    return PollingWatcher(directory)
+
+
+def remove_local_copies(download_locations, output_dir):
+    """Delete downloaded copies of consumed archives from `output_dir`
+
+    Only files inside `output_dir` are removed. Returns the paths
+    deleted.
+    """
+    output_dir = path.abspath(output_dir)
+    removed = []
+    for location in download_locations:
+        location = path.abspath(location)
+        if path.dirname(location) != output_dir:
+            continue
+        try:
+            os.remove(location)
+        except FileNotFoundError:
+            continue
+        removed.append(location)
+    return removed
+
+
+def process_export_changes(export_dir, db_con, output_dir=None):
+    """Record archives consumed from `export_dir` and, if `output_dir` is
+    given, delete their local copies. Returns the paths deleted.
+    """
+    consumed = ftp_db.check_exported_file_directory(export_dir, db_con)
+    db_con.commit()
+    if output_dir is None:
+        return []
+    return remove_local_copies(consumed, output_dir)
+
+
+def watch_export_directory(
+        export_dir, db_con, output_dir=None, poll_interval=5.0,
+        use_inotify=None, should_stop=None):
+    """Update the downloads database whenever files leave `export_dir`
+
+    Runs until `should_stop()` returns True (forever by default).
+    Consumed archives' local copies in `output_dir` are deleted as they
+    are detected. With inotify, `poll_interval` only bounds how often
+    `should_stop` is checked.
+
+    `export_dir` must exist at startup. If it is later removed or moved
+    away, nothing is recorded until a directory is back at that path,
+    which is then checked every `poll_interval` seconds.
+    """
+    watcher = get_watcher(export_dir, use_inotify)
+    try:
+        # Catch up on anything consumed while the watcher wasn't running
+        process_export_changes(export_dir, db_con, output_dir)
+        while should_stop is None or not should_stop():
+            try:
+                if watcher is None:
+                    watcher = get_watcher(export_dir, use_inotify)
+                    process_export_changes(export_dir, db_con, output_dir)
+                elif watcher.wait(poll_interval):
+                    process_export_changes(export_dir, db_con, output_dir)
+            except FileNotFoundError:
+                # The directory went away; watch it again once it is back
+                if watcher is not None:
+                    watcher.close()
+                    watcher = None
+                time.sleep(poll_interval)
+    finally:
+        if watcher is not None:
+            watcher.close()
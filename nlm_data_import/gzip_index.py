@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+gzip_index.py
+=============
+
+Random access into downloaded archives, after zlib's zran.c example.
+
+While an archive is decompressed once, seek points are recorded at
+deflate block boundaries roughly every `span` bytes of output, each
+with the 32 KiB of output preceding it. The uncompressed offset and
+length of every MedlineCitation are recorded too. A single citation
+can then be extracted by resuming decompression at the nearest seek
+point instead of at the start of the archive.
+
+Block boundaries are only reported by zlib's inflate with Z_BLOCK, and
+resuming mid-byte needs inflatePrime; Python's zlib module exposes
+neither, so libz is called through ctypes. Without libz, only citation
+offsets are recorded and extraction decompresses from the start of the
+archive.
+
+(c) 2014, Edward J. Stronge
+Available under the GPLv3 - see LICENSE for details.
+"""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+import ctypes
+import ctypes.util
+import functools
+from os import path
+import re
+import zlib
+
+from . import nlm_downloads_db as ftp_db
+
+# Default distance between seek points, in uncompressed bytes. Each
+# point stores a 32 KiB window, so smaller spans trade database size
+# for lookup speed.
+SEEK_POINT_SPAN = 4 * 1024 * 1024
+
+WINDOW_SIZE = 32 * 1024
+READ_SIZE = 64 * 1024
+
+# From <zlib.h>
+Z_OK = 0
+Z_NO_FLUSH = 0
+Z_STREAM_END = 1
+Z_BUF_ERROR = -5
+Z_BLOCK = 5
+
+# One MedlineCitation; group 1 is its PMID (always its first child)
+CITATION_PATTERN = re.compile(
+    rb'<MedlineCitation[\s>][^<]*<PMID[^>]*>\s*(\d+)\s*</PMID>'
+    rb'.*?</MedlineCitation>', re.DOTALL)
+
+# `bits` is the number of bits of the byte before `compressed_offset`
+# that belong to the block starting here; `window` is the output
+# preceding the point
+SeekPoint = namedtuple(
+    'SeekPoint', 'uncompressed_offset compressed_offset bits window')
+
+# `citations` holds (pmid, uncompressed offset, length) tuples
+ArchiveIndex = namedtuple('ArchiveIndex', 'points citations error')
+
+OffsetIndexReport = namedtuple('OffsetIndexReport', 'indexed missing failed')
+
+
+class ZStream(ctypes.Structure):
+    _fields_ = [
+        ('next_in', ctypes.c_void_p),
+        ('avail_in', ctypes.c_uint),
+        ('total_in', ctypes.c_ulong),
+        ('next_out', ctypes.c_void_p),
+        ('avail_out', ctypes.c_uint),
+        ('total_out', ctypes.c_ulong),
+        ('msg', ctypes.c_char_p),
+        ('state', ctypes.c_void_p),
+        ('zalloc', ctypes.c_void_p),
+        ('zfree', ctypes.c_void_p),
+        ('opaque', ctypes.c_void_p),
+        ('data_type', ctypes.c_int),
+        ('adler', ctypes.c_ulong),
+        ('reserved', ctypes.c_ulong),
+    ]
+
+
+@functools.lru_cache(maxsize=None)
+def _load_libz():
+    """Return libz, or None if it can't be loaded"""
+    try:
+        libz = ctypes.CDLL(ctypes.util.find_library('z') or 'libz.so.1')
+        libz.zlibVersion.restype = ctypes.c_char_p
+        libz.inflateInit2_.argtypes = [
+            ctypes.POINTER(ZStream), ctypes.c_int, ctypes.c_char_p,
+            ctypes.c_int]
+        libz.inflate.argtypes = [ctypes.POINTER(ZStream), ctypes.c_int]
+        libz.inflateEnd.argtypes = [ctypes.POINTER(ZStream)]
+        libz.inflatePrime.argtypes = [
+            ctypes.POINTER(ZStream), ctypes.c_int, ctypes.c_int]
+        libz.inflateSetDictionary.argtypes = [
+            ctypes.POINTER(ZStream), ctypes.c_char_p, ctypes.c_uint]
+    except (OSError, AttributeError):
+        return None
+    return libz
+
+
+def _inflate_with_seek_points(archive, span, libz):
+    """Decompress the gzip file `archive`, yielding ('data', bytes) for
+    its output and ('point', SeekPoint) at block boundaries at least
+    `span` bytes apart
+    """
+    stream = ZStream()
+    # 15 + 16: a gzip stream with the largest window
+    ret = libz.inflateInit2_(
+        ctypes.byref(stream), 31, libz.zlibVersion(),
+        ctypes.sizeof(stream))
+    if ret != Z_OK:
+        raise zlib.error('inflateInit2 failed (%d)' % ret)
+    output = ctypes.create_string_buffer(READ_SIZE)
+    history = bytearray()
+    total_in = total_out = 0
+    last_point = None
+    try:
+        while True:
+            chunk = archive.read(READ_SIZE)
+            if not chunk:
+                raise EOFError('Compressed file ended before the end of'
+                               ' the stream')
+            input_buffer = ctypes.create_string_buffer(chunk, len(chunk))
+            stream.next_in = ctypes.addressof(input_buffer)
+            stream.avail_in = len(chunk)
+            # Inflate may hold output back while the buffer is full, even
+            # with the input used up
+            while stream.avail_in or not stream.avail_out:
+                stream.next_out = ctypes.addressof(output)
+                stream.avail_out = READ_SIZE
+                avail_in = stream.avail_in
+                ret = libz.inflate(ctypes.byref(stream), Z_BLOCK)
+                if ret not in (Z_OK, Z_STREAM_END, Z_BUF_ERROR):
+                    raise zlib.error('inflate failed (%d): %s' % (
+                        ret, stream.msg))
+                total_in += avail_in - stream.avail_in
+                produced = READ_SIZE - stream.avail_out
+                if produced:
+                    data = ctypes.string_at(output, produced)
+                    total_out += produced
+                    history += data
+                    del history[:-WINDOW_SIZE]
+                    yield 'data', data
+                if ret == Z_STREAM_END:
+                    return
+                # Bit 7 of data_type marks the end of a block header or
+                # of the gzip header; bit 6 marks the last block
+                at_boundary = stream.data_type & 128 and \
+                    not stream.data_type & 64
+                if at_boundary and (
+                        last_point is None or
+                        total_out - last_point >= span):
+                    yield 'point', SeekPoint(
+                        total_out, total_in, stream.data_type & 7,
+                        bytes(history))
+                    last_point = total_out
+    finally:
+        libz.inflateEnd(ctypes.byref(stream))
+
+
+def _inflate(archive):
+    """Decompress the gzip file `archive` with Python's zlib, yielding
+    ('data', bytes) for its output
+    """
+    decompressor = zlib.decompressobj(31)
+    while not decompressor.eof:
+        chunk = archive.read(READ_SIZE)
+        if not chunk:
+            raise EOFError(
+                'Compressed file ended before the end of the stream')
+        yield 'data', decompressor.decompress(chunk)
+
+
+def build_archive_index(archive_path, span=SEEK_POINT_SPAN):
+    """Return an ArchiveIndex of seek points and citation offsets for
+    the gzipped archive `archive_path`
+    """
+    libz = _load_libz()
+    points = []
+    citations = []
+    # Output not yet searched for complete citations, starting at
+    # uncompressed offset `base`
+    pending = b''
+    base = 0
+    try:
+        with open(archive_path, 'rb') as archive:
+            if libz is None:
+                events = _inflate(archive)
+            else:
+                events = _inflate_with_seek_points(archive, span, libz)
+            for event, value in events:
+                if event == 'point':
+                    points.append(value._replace(
+                        window=zlib.compress(value.window)))
+                    continue
+                pending += value
+                searched = 0
+                for match in CITATION_PATTERN.finditer(pending):
+                    citations.append((
+                        int(match.group(1)), base + match.start(),
+                        match.end() - match.start()))
+                    searched = match.end()
+                # Keep any incomplete citation for the next block
+                start = pending.find(b'<MedlineCitation', searched)
+                if start < 0:
+                    start = max(searched, len(pending) - 16)
+                base += start
+                pending = pending[start:]
+    except (OSError, EOFError, zlib.error) as error:
+        return ArchiveIndex(None, None, str(error))
+    return ArchiveIndex(points, citations, None)
+
+
+def _resume_inflate(archive, point, libz):
+    """Yield the output of the gzip file `archive` from SeekPoint
+    `point` onwards
+    """
+    stream = ZStream()
+    # -15: a raw deflate stream with the largest window
+    ret = libz.inflateInit2_(
+        ctypes.byref(stream), -15, libz.zlibVersion(),
+        ctypes.sizeof(stream))
+    if ret != Z_OK:
+        raise zlib.error('inflateInit2 failed (%d)' % ret)
+    output = ctypes.create_string_buffer(READ_SIZE)
+    try:
+        if point.bits:
+            # The block starts in the high `bits` bits of the previous byte
+            archive.seek(point.compressed_offset - 1)
+            byte = archive.read(1)
+            if not byte:
+                raise EOFError('Compressed file ended before the seek point')
+            libz.inflatePrime(
+                ctypes.byref(stream), point.bits,
+                byte[0] >> (8 - point.bits))
+        else:
+            archive.seek(point.compressed_offset)
+        window = zlib.decompress(point.window)
+        if window:
+            libz.inflateSetDictionary(
+                ctypes.byref(stream), window, len(window))
+        while True:
+            chunk = archive.read(READ_SIZE)
+            if not chunk:
+                raise EOFError('Compressed file ended before the end of'
+                               ' the stream')
+            input_buffer = ctypes.create_string_buffer(chunk, len(chunk))
+            stream.next_in = ctypes.addressof(input_buffer)
+            stream.avail_in = len(chunk)
+            while stream.avail_in or not stream.avail_out:
+                stream.next_out = ctypes.addressof(output)
+                stream.avail_out = READ_SIZE
+                ret = libz.inflate(ctypes.byref(stream), Z_NO_FLUSH)
+                if ret not in (Z_OK, Z_STREAM_END, Z_BUF_ERROR):
+                    raise zlib.error('inflate failed (%d): %s' % (
+                        ret, stream.msg))
+                produced = READ_SIZE - stream.avail_out
+                if produced:
+                    yield ctypes.string_at(output, produced)
+                if ret == Z_STREAM_END:
+                    return
+    finally:
+        libz.inflateEnd(ctypes.byref(stream))
+
+
+def read_uncompressed(archive_path, offset, length, point=None):
+    """Return `length` bytes at uncompressed `offset` in the gzipped
+    archive `archive_path`, resuming from SeekPoint `point` if given
+    """
+    libz = _load_libz()
+    with open(archive_path, 'rb') as archive:
+        if point is None or libz is None:
+            decompressor = zlib.decompressobj(31)
+            chunks = (decompressor.decompress(chunk) for chunk in iter(
+                lambda: archive.read(READ_SIZE), b''))
+            skip = offset
+        else:
+            chunks = _resume_inflate(archive, point, libz)
+            skip = offset - point.uncompressed_offset
+
+        output = bytearray()
+        needed = skip + length
+        with closing(chunks):
+            for chunk in chunks:
+                output += chunk
+                if len(output) >= needed:
+                    break
+    return bytes(output[skip:needed])
+
+
+def _archive_path(archive):
+    for location in (archive['download_location'],
+                     archive['export_location']):
+        if location and path.exists(location):
+            return location
+    return None
+
+
+def index_archive_offsets(db_con, span=SEEK_POINT_SPAN, processes=None):
+    """Build seek points and citation offsets for every archive not yet
+    indexed (or reissued since)
+
+    Archives are decompressed on `processes` worker processes and their
+    indexes committed one at a time. Returns an OffsetIndexReport.
+    """
+    archives = []
+    missing = []
+    for archive in ftp_db.get_archives_without_offsets(db_con):
+        archive_path = _archive_path(archive)
+        if archive_path is None:
+            missing.append(archive['record_name'])
+        else:
+            archives.append((archive, archive_path))
+
+    indexed = []
+    failed = []
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = executor.map(
+            functools.partial(build_archive_index, span=span),
+            [archive_path for _, archive_path in archives])
+        for (archive, _), index in zip(archives, results):
+            if index.error is not None:
+                failed.append((archive['record_name'], index.error))
+                continue
+            ftp_db.record_archive_offsets(
+                archive['record_name'], archive['unique_file_id'],
+                index.points, index.citations, db_con)
+            db_con.commit()
+            indexed.append(archive['record_name'])
+    return OffsetIndexReport(indexed, missing, failed)
+
+
+def extract_citation(pmid, db_con, record_name=None):
+    """Return the MedlineCitation element for `pmid` as bytes, or None
+
+    The citation is read from archive `record_name`, by default the
+    latest archive holding `pmid` (see
+    `nlm_downloads_db.get_pmid_location`); None is returned if that
+    archive deletes it or its offsets haven't been indexed.
+    """
+    if record_name is None:
+        location = ftp_db.get_pmid_location(pmid, db_con)
+        if location is None or location.deleted:
+            return None
+        record_name = location.record_name
+    citation = ftp_db.get_citation_offset(record_name, pmid, db_con)
+    if citation is None:
+        return None
+    archive_path = _archive_path(citation)
+    if archive_path is None:
+        raise FileNotFoundError(
+            'No local copy of %s is available' % record_name)
+    point = ftp_db.get_seek_point(
+        record_name, citation['uncompressed_offset'], db_con)
+    return read_uncompressed(
+        archive_path, citation['uncompressed_offset'], citation['length'],
+        point and SeekPoint(
+            point['uncompressed_offset'], point['compressed_offset'],
+            point['bits'], point['window']))
@@ -1,4 +1,3 @@
-
 """
 nlm_data_tests.py
 =================
@@ -7,19 +6,166 @@ Basic tests for archives downloaded from NLM. All test parameters
 are taken from archive descriptions; see
 http://www.nlm.nih.gov/bsd/licensee/2014_stats/baseline_doc.html for
 details.
+
+Archives are streamed with `etree.iterparse` and processed elements
+are discarded, so memory use doesn't depend on archive size.
+
+DTDs are read from a local cache directory (see `load_dtd`), so
+validation doesn't need network access once the cache is populated.
+Call `load_dtd(system_id, allow_network=True)` once on a host with
+network access to fill the cache.
 """
 
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import gzip
+import io
 import os
 from os import path
+import re
+from urllib.parse import quote
+from urllib.request import urlopen
 
 from lxml import etree
 
 
 _2014_MEDLINE_FILES_DIRECTORY = path.join(
     path.dirname(__file__), '../data/2014')
-MEDLINE_FILES = [
-    path.join(_2014_MEDLINE_FILES_DIRECTORY, p) for p in os.listdir(
-        _2014_MEDLINE_FILES_DIRECTORY)]
+if path.isdir(_2014_MEDLINE_FILES_DIRECTORY):
+    MEDLINE_FILES = [
+        path.join(_2014_MEDLINE_FILES_DIRECTORY, p) for p in os.listdir(
+            _2014_MEDLINE_FILES_DIRECTORY)]
+else:
+    MEDLINE_FILES = []
+
+MAX_RECORDS_PER_FILE = 30000
+
+DTD_CACHE_DIRECTORY = path.expanduser('~/.nlm_dtd_cache')
+
+# Top-level elements of a MedlineCitationSet; each is validated
+# separately against the DTD
+CITATION_SET_ELEMENTS = ('MedlineCitation', 'DeleteCitation')
+
+# example - <!DOCTYPE MedlineCitationSet PUBLIC "-//NLM//DTD Medline
+#     Citation, 1st January, 2014//EN"
+#     "http://www.nlm.nih.gov/databases/dtd/nlmmedlinecitationset_140101.dtd">
+DOCTYPE_PATTERN = re.compile(
+    br'<!DOCTYPE\s+\S+\s+(?:PUBLIC\s+(["\'])[^"\']*\1|SYSTEM)\s+'
+    br'(["\'])(?P<system_id>[^"\']+)\2')
+
+ValidationResult = namedtuple(
+    'ValidationResult',
+    'medline_xml n_records has_30k_or_fewer_records valid_xml error')
+
+# etree.DTD objects parsed by this process, keyed by system ID and cache
+# directory
+_LOADED_DTDS = {}
+
+
+class DTDUnavailableError(LookupError):
+    """Raised when an archive's DTD can't be loaded, e.g. because it isn't
+    cached and network access is disabled
+    """
+
+
+def open_medline_file(medline_xml):
+    """Open medline_xml for reading, decompressing `.gz` files"""
+    if medline_xml.endswith('.gz'):
+        return gzip.open(medline_xml, 'rb')
+    return open(medline_xml, 'rb')
+
+
+def cached_dtd_path(system_id, cache_dir=DTD_CACHE_DIRECTORY):
+    """Return the path at which the DTD `system_id` is cached"""
+    return path.join(cache_dir, quote(system_id, safe=''))
+
+
+def fetch_dtd(system_id, cache_dir=DTD_CACHE_DIRECTORY):
+    """Download the DTD `system_id` into `cache_dir`"""
+    os.makedirs(cache_dir, exist_ok=True)
+    cached_path = cached_dtd_path(system_id, cache_dir)
+    with urlopen(system_id) as response:
+        dtd_data = response.read()
+    with open(cached_path + '.part', 'wb') as cached_file:
+        cached_file.write(dtd_data)
+    os.replace(cached_path + '.part', cached_path)
+    return cached_path
+
+
+class DTDCacheResolver(etree.Resolver):
+    """Resolve DTDs (and the files they include) from a cache directory
+
+    Missing files are downloaded into the cache if `allow_network` is
+    true. Cached files keep their original URL as base URL so relative
+    references inside them are looked up in the cache too.
+    """
+
+    def __init__(self, cache_dir=DTD_CACHE_DIRECTORY, allow_network=False):
+        super().__init__()
+        self.cache_dir = cache_dir
+        self.allow_network = allow_network
+
+    def resolve(self, system_url, public_id, context):
+        cached_path = cached_dtd_path(system_url, self.cache_dir)
+        if not path.exists(cached_path):
+            if not self.allow_network:
+                return None
+            fetch_dtd(system_url, self.cache_dir)
+        with open(cached_path, 'rb') as cached_file:
+            return self.resolve_string(
+                cached_file.read(), context, base_url=system_url)
+
+
+def load_dtd(system_id, cache_dir=DTD_CACHE_DIRECTORY, allow_network=False):
+    """Return an etree.DTD for `system_id`, parsed once per process
+
+    The DTD is read from `cache_dir`; if it isn't cached and
+    `allow_network` is false, DTDUnavailableError is raised.
+    """
+    key = (system_id, cache_dir)
+    if key not in _LOADED_DTDS:
+        if not allow_network and \
+                not path.exists(cached_dtd_path(system_id, cache_dir)):
+            raise DTDUnavailableError(
+                '%s is not cached in %s' % (system_id, cache_dir))
+        parser = etree.XMLParser(
+            load_dtd=True, no_network=True, resolve_entities=True)
+        parser.resolvers.add(DTDCacheResolver(cache_dir, allow_network))
+        stub_document = '<!DOCTYPE MedlineCitationSet SYSTEM "%s">' \
+            '<MedlineCitationSet/>' % system_id
+        tree = etree.parse(io.BytesIO(stub_document.encode()), parser)
+        _LOADED_DTDS[key] = tree.docinfo.externalDTD
+    return _LOADED_DTDS[key]
+
+
+def get_dtd_system_id(medline_xml):
+    """Return the system ID from medline_xml's DOCTYPE"""
+    with open_medline_file(medline_xml) as medline_file:
+        match = DOCTYPE_PATTERN.search(medline_file.read(4096))
+    if match is None:
+        raise DTDUnavailableError('%s does not reference a DTD' % medline_xml)
+    return match.group('system_id').decode()
+
+
+def iter_medline_citations(medline_xml, tags=('MedlineCitation',)):
+    """Yield each element of medline_xml with a tag in `tags` in turn
+
+    Each element is cleared, along with its already-processed siblings,
+    once the caller moves on to the next one.
+    """
+    with open_medline_file(medline_xml) as medline_file:
+        for _, element in etree.iterparse(
+                medline_file, tag=tags, huge_tree=True):
+            yield element
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+
+def count_medline_citations(medline_xml):
+    """Return the number of MedlineCitation elements in medline_xml"""
+    return sum(1 for _ in iter_medline_citations(medline_xml))
 
 
 def has_30k_or_fewer_records(medline_xml, parser=None, tree=None):
@@ -28,16 +174,93 @@ def has_30k_or_fewer_records(medline_xml, parser=None, tree=None):
     Medline XML records contain at most 30k MedlineCitation elements.
     This is a simple check for all new files.
     """
+    if tree is not None:
+        n_records = sum(1 for _ in tree.iter('MedlineCitation'))
+    else:
+        n_records = count_medline_citations(medline_xml)
+    return n_records <= MAX_RECORDS_PER_FILE
 
 
-def is_valid_xml(medline_xml, parser=None, tree=None):
+def is_valid_xml(medline_xml, parser=None, tree=None,
+                 dtd_cache_dir=DTD_CACHE_DIRECTORY, allow_network=False):
     """Return whether medline_xml is valid by checking its dtd
 
-    Validates medline_xml using its internally referenced DTD.
+    Validates medline_xml using its referenced DTD, loaded from the
+    local DTD cache (see `load_dtd`). Unless `tree` is given, the file
+    is streamed and each top-level citation element is validated in
+    turn.
     """
-    if parser is None:
-        parser = etree.XMLParser(load_dtd=True, no_network=False)
-    if tree is None:
-        tree = etree.parse(medline_xml, parser)
-    dtd = tree.docinfo.externalDTD
-    return dtd.validate(tree)
+    dtd = load_dtd(
+        get_dtd_system_id(medline_xml), dtd_cache_dir, allow_network)
+    if tree is not None:
+        return dtd.validate(tree)
+    return all(dtd.validate(element) for element in
+               iter_medline_citations(medline_xml, CITATION_SET_ELEMENTS))
+
+
+def validate_archive(medline_xml, dtd_cache_dir=DTD_CACHE_DIRECTORY,
+                     check_dtd=True):
+    """Run the streaming checks on medline_xml; return a ValidationResult
+
+    Records are counted and, if `check_dtd` is true, validated against
+    the cached DTD in a single pass. Parse, I/O and DTD cache errors are
+    reported in the result's `error` field rather than raised.
+    """
+    n_records = 0
+    valid_xml = None
+    try:
+        if check_dtd:
+            dtd = load_dtd(get_dtd_system_id(medline_xml), dtd_cache_dir)
+            valid_xml = True
+        for element in iter_medline_citations(
+                medline_xml, CITATION_SET_ELEMENTS):
+            if element.tag == 'MedlineCitation':
+                n_records += 1
+            if check_dtd and valid_xml:
+                valid_xml = dtd.validate(element)
+    except (etree.XMLSyntaxError, OSError, EOFError,
+            DTDUnavailableError) as error:
+        return ValidationResult(medline_xml, None, False, False, str(error))
+    return ValidationResult(
+        medline_xml, n_records, n_records <= MAX_RECORDS_PER_FILE,
+        valid_xml, None)
+
+
+def validate_archives(medline_files=None, processes=None,
+                      dtd_cache_dir=DTD_CACHE_DIRECTORY, check_dtd=True):
+    """Validate medline_files (default MEDLINE_FILES) on a process pool
+
+    Each worker process parses the DTD once and reuses it for every
+    file it handles. Returns a list of ValidationResults in the order of
+    medline_files.
+    """
+    if medline_files is None:
+        medline_files = MEDLINE_FILES
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(
+            functools.partial(
+                validate_archive, dtd_cache_dir=dtd_cache_dir,
+                check_dtd=check_dtd),
+            medline_files))
+
+
+def format_report(results):
+    """Return a per-file text report for a list of ValidationResults"""
+    lines = []
+    for result in results:
+        if result.error is not None:
+            status = 'ERROR: %s' % result.error
+        elif not result.has_30k_or_fewer_records:
+            status = 'FAILED: more than %d records' % MAX_RECORDS_PER_FILE
+        elif result.valid_xml is False:
+            status = 'FAILED: invalid according to DTD'
+        else:
+            status = 'OK'
+        lines.append('%s\t%s\t%s' % (
+            path.basename(result.medline_xml),
+            '-' if result.n_records is None else result.n_records, status))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    print(format_report(validate_archives()))
@@ -8,62 +8,192 @@ Database functions related to maintaining the list of processed NLM archives.
 (c) 2014, Edward J. Stronge.
 Available under the GPLv3 - see LICENSE for details.
 """
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import os
 from os import path
 import re
 import sqlite3
+import time
 
 
 # example - medline14n0746.xml.gz.md5
 MEDLINE_ARCHIVE_PATTERN = re.compile(r'medline\d{2}n\d{4}')
 
+# example - MD5(medline14n0746.xml.gz)= 2f7b3c1b4d1e0e8c7a9b6f5d4c3b2a19
+NLM_MD5_PATTERN = re.compile(r'\s*MD5\((?P<filename>[^)]+)\)\s*=\s*'
+                             r'(?P<md5>[0-9a-fA-F]{32})\s*$')
+
+# Values of nlm_archives.md5_verified
+MD5_UNVERIFIED = 0
+MD5_VERIFIED = 1
+MD5_MISMATCH = -1
+
+ChecksumReport = namedtuple('ChecksumReport', 'verified mismatched missing')
+
+PMIDLocation = namedtuple(
+    'PMIDLocation', 'pmid record_name deleted download_location')
+
 
 def initialize_database_connection(db_file):
     """Return a connection to `db_file`.
 
     If the file does not exist it is created and intialized with
     `DOWNLOADED_FILES_SCHEMA`.
+
+    The database uses write-ahead logging so readers (e.g., export
+    monitoring scripts) never block the downloader. With WAL,
+    `synchronous=NORMAL` keeps every commit safe from application
+    crashes while only syncing to disk at checkpoints.
+
+    The connection may be used from a thread other than the one that
+    opened it (see `async_download`), but only from one at a time.
     """
     if not path.exists(db_file):
-        db_con = sqlite3.connect(db_file)
+        db_con = sqlite3.connect(db_file, check_same_thread=False)
         db_con.executescript(DOWNLOADED_FILES_SCHEMA)
         db_con.commit()
     else:
-        db_con = sqlite3.connect(db_file)
+        db_con = sqlite3.connect(db_file, check_same_thread=False)
+    db_con.execute("PRAGMA journal_mode=WAL")
+    db_con.execute("PRAGMA synchronous=NORMAL")
+    # Objects added after the original schema; safe to re-run on
+    # existing databases
+    db_con.executescript(SCHEMA_ADDITIONS)
     db_con.text_factory = str
     db_con.row_factory = sqlite3.Row
     return db_con
 
 
+def get_record_name(filename):
+    """Return the archive record name referenced by `filename`, or None
+
+    e.g., 'medline14n0746' for 'medline14n0746.xml.gz.md5'
+    """
+    referenced_record = MEDLINE_ARCHIVE_PATTERN.match(filename)
+    if referenced_record is None:
+        return None
+    return referenced_record.group(0)
+
+
 def get_downloaded_file_unique_ids(db_con):
     """Returns a set of identifers for previously downloaded files."""
-    select_statements = (
-        "SELECT unique_file_id FROM nlm_archives",
-        "SELECT unique_file_id FROM md5_checksums",
-        "SELECT unique_file_id FROM archive_notes")
-    downloaded_files = set()
-    for stmt in select_statements:
-        for row in db_con.execute(stmt):
-            downloaded_files.add(row['unique_file_id'])
-    return downloaded_files
+    return {row['unique_file_id'] for row in db_con.execute(
+        "SELECT unique_file_id FROM downloaded_file_ids")}
+
+
+def get_new_files(file_listing, db_con):
+    """Yield the entries of `file_listing` that haven't been downloaded.
+
+    `file_listing` is a sequence of `FTPFileParams`. Their unique IDs are
+    bulk-loaded into a temporary table and compared against the
+    `downloaded_file_ids` view with an indexed anti-join, so the
+    download history never has to be loaded into memory. Entries are
+    yielded in listing order.
+    """
+    file_listing = list(file_listing)
+    db_con.execute(CREATE_LISTED_FILES_TABLE)
+    db_con.execute("DELETE FROM temp.listed_files")
+    db_con.executemany(
+        "INSERT INTO temp.listed_files (position, unique_file_id)"
+        " VALUES (?, ?)",
+        ((i, f.unique_file_id) for i, f in enumerate(file_listing)))
+    for row in db_con.execute(GET_NEW_LISTED_FILES).fetchall():
+        yield file_listing[row['position']]
+
+
+def listing_digest(mlsd_lines):
+    """Return a digest identifying the directory listing `mlsd_lines`"""
+    digest = hashlib.sha1()
+    for line in sorted(mlsd_lines):
+        digest.update(line.encode('utf-8') + b'\n')
+    return digest.hexdigest()
+
+
+def get_listing_digest(server_dir, db_con):
+    """Return the digest of the last fully processed listing of
+    `server_dir`, or None
+    """
+    row = db_con.execute(
+        "SELECT digest FROM listing_snapshots WHERE server_dir = ?",
+        (server_dir,)).fetchone()
+    return row['digest'] if row is not None else None
+
+
+def _load_snapshot_listing(file_listing, db_con, pending=()):
+    db_con.execute(CREATE_SNAPSHOT_LISTING_TABLE)
+    db_con.execute("DELETE FROM temp.snapshot_listing")
+    db_con.executemany(
+        "INSERT OR REPLACE INTO temp.snapshot_listing (position, filename,"
+        " unique_file_id, modification_date, size, pending)"
+        " VALUES (?, ?, ?, ?, ?, ?)",
+        ((i, f.filename, f.unique_file_id, f.modification_date,
+          int(f.size) if f.size else None, f.filename in pending)
+         for i, f in enumerate(file_listing)))
+
+
+def get_listing_changes(server_dir, file_listing, db_con):
+    """Return the entries of `file_listing` that differ from the stored
+    snapshot of `server_dir`
+
+    Returns a list of (FTPFileParams, reissued) pairs in listing order.
+    `reissued` is True for names already in the snapshot whose
+    modification date or size has changed.
+    """
+    file_listing = list(file_listing)
+    _load_snapshot_listing(file_listing, db_con)
+    return [(file_listing[row['position']], bool(row['reissued']))
+            for row in db_con.execute(
+                GET_CHANGED_LISTED_FILES, {'server_dir': server_dir})]
+
+
+def get_files_to_download(server_dir, file_listing, db_con):
+    """Return the entries of `file_listing` that need downloading
+
+    Only entries that changed since the last snapshot of `server_dir`
+    are considered (see `get_listing_changes`). Reissued files are
+    always returned; other entries are returned if their unique ID
+    hasn't been downloaded. Returns (files, names of reissued files).
+    """
+    changes = get_listing_changes(server_dir, file_listing, db_con)
+    new_files = set(get_new_files(
+        [f for f, reissued in changes if not reissued], db_con))
+    return ([f for f, reissued in changes if reissued or f in new_files],
+            {f.filename for f, reissued in changes if reissued})
+
+
+def save_listing_snapshot(server_dir, file_listing, db_con, digest=None,
+                          pending=()):
+    """Store `file_listing` as the snapshot of `server_dir`
+
+    Entries named in `pending` (files still to be downloaded) keep their
+    previous snapshot state so they are picked up again next time. The
+    `digest` is only stored if nothing is pending.
+    """
+    _load_snapshot_listing(file_listing, db_con, set(pending))
+    params = {'server_dir': server_dir,
+              'digest': None if pending else digest,
+              'listed_date': time.strftime('%Y%m%d%H%M%S')}
+    db_con.execute(DELETE_UNLISTED_ENTRIES, params)
+    db_con.execute(SAVE_LISTING_ENTRIES, params)
+    db_con.execute(SAVE_LISTING_SNAPSHOT, params)
 
 
 def record_downloads(downloads_list, db_con):
     """Update downloaded files database with files from downloads_list.
 
-    `downloads_list` is a collection of dictionaries with keys from
-    `FTPFileParams`, augmented with the key `download_date`.
+    `downloads_list` is a collection of `FTPFileParams` namedtuples
+    with the `download_date`, `observed_md5` and `output_path` fields
+    filled in.
     """
     download_types = {'archive': [], 'hash': [], 'note': []}
     for download in downloads_list:
-        download = vars(download)
+        download = download._asdict()
 
         download['export_location'] = ''
-        referenced_record = MEDLINE_ARCHIVE_PATTERN.match(download['filename'])
-        if referenced_record is not None:
-            download['referenced_record'] = referenced_record.group(0)
-        else:
-            # This can only happen for notes - see the DB schema
-            download['referenced_record'] = None
+        # Can only be None for notes - see the DB schema
+        download['referenced_record'] = get_record_name(download['filename'])
         filename = download['filename']
 
         if filename.endswith('.xml.gz'):
@@ -80,27 +210,383 @@ def record_downloads(downloads_list, db_con):
 
         else:
             download_types['note'].append(download)
+    # A file downloaded again under the same name was reissued by NLM;
+    # its new record replaces the old one
+    for table, downloads in (('nlm_archives', download_types['archive']),
+                             ('md5_checksums', download_types['hash']),
+                             ('archive_notes', download_types['note'])):
+        db_con.executemany(
+            DELETE_PREVIOUS_DOWNLOAD_SQL.format(table=table),
+            ((d['filename'],) for d in downloads))
     db_con.executemany(NEW_ARCHIVE_SQL, download_types['archive'])
     # TODO Enforce foreign key constraints on hashes and notes. See
     # the FK_support branch
     db_con.executemany(NEW_HASH_SQL, download_types['hash'])
+    db_con.executemany(NEW_MD5_MODIFICATION_DATE, download_types['hash'])
+    # A new checksum file may settle an earlier mismatch
+    db_con.executemany(
+        RESET_MD5_VERIFIED,
+        ((d['referenced_record'],) for d in download_types['hash']))
     db_con.executemany(NEW_NOTE_SQL, download_types['note'])
 
 
-def record_files_to_export(exported_record_names, db_con):
-    """Mark files in exports_list as having been moved to the export directory.
+class DownloadRecorder(object):
+    """Record downloads to `db_con` as they complete.
+
+    Downloads passed to `add` are written with `record_downloads` and
+    committed once `batch_size` downloads are waiting or `max_delay`
+    seconds have passed since the last commit. The default commits each
+    download, so an interrupted run loses at most the file in progress.
+    Call `flush` (or use the recorder as a context manager) to commit
+    whatever remains.
+
+    Each flush also records export locations passed to `add` and checks
+    newly recorded archives against their md5 files, withdrawing the
+    exports of any that fail (see `withdraw_exports`).
+    """
+
+    def __init__(self, db_con, batch_size=1, max_delay=None):
+        self.db_con = db_con
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.pending = []
+        self.pending_exports = []
+        self.last_commit = time.monotonic()
+
+    def add(self, download, export_location=None):
+        self.pending.append(download)
+        if export_location is not None:
+            self.pending_exports.append(
+                (download.unique_file_id, export_location))
+        if len(self.pending) >= self.batch_size or (
+                self.max_delay is not None and
+                time.monotonic() - self.last_commit >= self.max_delay):
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            record_downloads(self.pending, self.db_con)
+            record_exports(self.pending_exports, self.db_con)
+            checksums = verify_archive_checksums(self.db_con)
+            withdraw_exports(checksums.mismatched, self.db_con)
+            self.db_con.commit()
+            self.pending = []
+            self.pending_exports = []
+        self.last_commit = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+
+def parse_nlm_md5(md5_value):
+    """Return the hex digest from the contents of an NLM `.md5` file
+
+    Returns None if `md5_value` isn't in the `MD5(file)= hex` format.
+    """
+    match = NLM_MD5_PATTERN.match(md5_value)
+    if match is None:
+        return None
+    return match.group('md5').lower()
+
+
+def md5_of_file(file_path, blocksize=64 * 1024):
+    """Return the hex md5 digest of `file_path`, or None if it's missing"""
+    observed_md5 = hashlib.md5()
+    try:
+        with open(file_path, 'rb') as archive:
+            for block in iter(lambda: archive.read(blocksize), b''):
+                observed_md5.update(block)
+    except FileNotFoundError:
+        return None
+    return observed_md5.hexdigest()
+
+
+def rehash_archives(db_con, processes=None):
+    """Recompute `observed_md5` for every archive still on disk
+
+    Files are hashed in parallel on a pool of `processes` worker
+    processes. Returns the record names of archives that couldn't be
+    found at their download or export location.
+    """
+    archives = db_con.execute(GET_ARCHIVE_LOCATIONS).fetchall()
+    missing = []
+    updates = []
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        download_md5s = executor.map(
+            md5_of_file, [a['download_location'] for a in archives],
+            chunksize=8)
+        for archive, observed_md5 in zip(archives, download_md5s):
+            if observed_md5 is None and archive['export_location']:
+                observed_md5 = md5_of_file(archive['export_location'])
+            if observed_md5 is None:
+                missing.append(archive['record_name'])
+            else:
+                updates.append((observed_md5, archive['id']))
+    db_con.executemany(SET_OBSERVED_MD5, updates)
+    return missing
+
+
+def _describes_earlier_version(checksum_row):
+    """Return True if the `.md5` file in `checksum_row` was published
+    before its archive, i.e. it belongs to an earlier version of an
+    archive NLM has since reissued
+
+    Checksum files recorded without a modification date are trusted.
+    """
+    md5_modified = (checksum_row['md5_modification_date'] or '')[:14]
+    archive_modified = (checksum_row['modification_date'] or '')[:14]
+    return bool(md5_modified and archive_modified and
+                md5_modified < archive_modified)
+
+
+def verify_archive_checksums(db_con, rehash=False, processes=None):
+    """Compare archives' observed md5 hashes to NLM's published values
+
+    Archives are joined to their `.md5` records by record name; archives
+    whose checksum file hasn't been downloaded yet are left unverified,
+    as are mismatches against a checksum file older than the archive (a
+    reissued archive fetched before its new `.md5`). Recording a new
+    `.md5` file resets its archive to unverified (see
+    `record_downloads`).
+    `md5_verified` is set to MD5_VERIFIED or MD5_MISMATCH in bulk.
+
+    If `rehash` is true, every archive on disk is rehashed first (see
+    `rehash_archives`) and all archives are rechecked, not just
+    unverified ones.
+
+    Returns a ChecksumReport with lists of record names.
+    """
+    missing = rehash_archives(db_con, processes) if rehash else []
+    missing_records = set(missing)
+    query = GET_ARCHIVE_CHECKSUMS if rehash else GET_UNVERIFIED_CHECKSUMS
+    verified = []
+    mismatched = []
+    updates = []
+    for row in db_con.execute(query).fetchall():
+        if row['record_name'] in missing_records:
+            continue
+        observed_md5 = row['observed_md5']
+        if isinstance(observed_md5, bytes):
+            # Archives recorded before hex digests were stored
+            observed_md5 = observed_md5.hex()
+        if observed_md5.lower() == parse_nlm_md5(row['md5_value']):
+            verified.append(row['record_name'])
+            updates.append((MD5_VERIFIED, row['id']))
+        elif _describes_earlier_version(row):
+            # Wait for the reissued archive's own checksum file
+            continue
+        else:
+            mismatched.append(row['record_name'])
+            updates.append((MD5_MISMATCH, row['id']))
+    db_con.executemany(SET_MD5_VERIFIED, updates)
+    return ChecksumReport(verified, mismatched, missing)
+
+
+def get_mismatched_archives(record_names, db_con):
+    """Return the archives among `record_names` that failed md5
+    verification
+    """
+    return [name for name in record_names
+            if db_con.execute(
+                IS_MD5_MISMATCH, (name, MD5_MISMATCH)).fetchone()]
+
+
+def withdraw_exports(record_names, db_con):
+    """Remove the staged exports of archives `record_names` (e.g., ones
+    failing md5 verification) so the application never retrieves them
+
+    Exports the application has already retrieved are left alone.
+    Returns the export paths removed.
+    """
+    removed = []
+    for name in record_names:
+        for archive in db_con.execute(GET_STAGED_EXPORTS, (name,)).fetchall():
+            try:
+                os.remove(archive['export_location'])
+            except FileNotFoundError:
+                pass
+            else:
+                removed.append(archive['export_location'])
+            db_con.execute(CLEAR_EXPORT_LOCATION, (archive['id'],))
+    return removed
+
+
+def has_archive_of_size(size, db_con):
+    """Return True if an archive of `size` bytes has been recorded"""
+    return db_con.execute(HAS_ARCHIVE_OF_SIZE, (size,)).fetchone() is not None
+
+
+def get_md5_value(unique_file_id, db_con):
+    """Return the contents of the recorded `.md5` file `unique_file_id`,
+    or None if it hasn't been downloaded
+    """
+    row = db_con.execute(GET_MD5_VALUE, (unique_file_id,)).fetchone()
+    return row and row['md5_value']
+
+
+def get_archive_copies(size, observed_md5, db_con):
+    """Return the locations of recorded archives of `size` bytes whose
+    observed md5 is `observed_md5`, most recently downloaded first
+
+    Archives whose checksum didn't match NLM's are left out.
+    """
+    return db_con.execute(
+        GET_ARCHIVE_COPIES, (size, observed_md5.lower(), MD5_MISMATCH)
+    ).fetchall()
+
+
+def get_unindexed_archives(db_con):
+    """Return archives whose PMIDs haven't been indexed, in record order
+
+    Archives reissued since they were indexed are included again.
+    """
+    return db_con.execute(GET_UNINDEXED_ARCHIVES).fetchall()
+
+
+def record_pmid_locations(record_name, unique_file_id, citations,
+                          deleted_pmids, db_con):
+    """Index the PMIDs found in archive `record_name`
+
+    `citations` and `deleted_pmids` are the PMIDs of the archive's
+    MedlineCitation and DeleteCitation entries. Every archive mentioning
+    a PMID is kept and the latest one is chosen when querying, so
+    archives can be indexed (and re-indexed) in any order. Rows from an
+    earlier version of the same archive are replaced.
     """
-    db_con.executemany(SET_READY_FOR_EXPORT, exported_record_names)
+    db_con.execute(
+        "DELETE FROM pmid_locations WHERE record_name = ?", (record_name,))
+    db_con.executemany(
+        NEW_PMID_LOCATION, ((pmid, record_name, 0) for pmid in citations))
+    db_con.executemany(
+        NEW_PMID_LOCATION, ((pmid, record_name, 1) for pmid in deleted_pmids))
+    db_con.execute(SET_ARCHIVE_INDEXED, {
+        'record_name': record_name, 'unique_file_id': unique_file_id,
+        'n_citations': len(citations), 'n_deleted': len(deleted_pmids),
+        'indexed_date': time.strftime('%Y%m%d%H%M%S')})
 
 
-def check_exported_file_directory(export_dir_files, db_con):
+def get_pmid_location(pmid, db_con):
+    """Return a PMIDLocation for the latest archive mentioning `pmid`,
+    or None if it hasn't been indexed
+
+    `deleted` is true if that archive deletes the citation.
+    """
+    row = db_con.execute(GET_PMID_LOCATION, (pmid,)).fetchone()
+    if row is None:
+        return None
+    return PMIDLocation(
+        row['pmid'], row['record_name'], bool(row['deleted']),
+        row['download_location'])
+
+
+def get_archives_without_offsets(db_con):
+    """Return archives without seek points and citation offsets (see
+    `gzip_index`), including archives reissued since they were indexed
+    """
+    return db_con.execute(GET_ARCHIVES_WITHOUT_OFFSETS).fetchall()
+
+
+def record_archive_offsets(record_name, unique_file_id, seek_points,
+                           citations, db_con):
+    """Replace the seek points and citation offsets of `record_name`
+
+    `seek_points` are gzip_index.SeekPoint tuples and `citations`
+    (pmid, uncompressed offset, length) tuples.
+    """
+    db_con.execute(
+        "DELETE FROM archive_seek_points WHERE record_name = ?",
+        (record_name,))
+    db_con.execute(
+        "DELETE FROM citation_offsets WHERE record_name = ?",
+        (record_name,))
+    db_con.executemany(
+        NEW_SEEK_POINT_SQL,
+        ((record_name, p.uncompressed_offset, p.compressed_offset, p.bits,
+          p.window) for p in seek_points))
+    db_con.executemany(
+        NEW_CITATION_OFFSET_SQL,
+        ((record_name, pmid, offset, length)
+         for pmid, offset, length in citations))
+    db_con.execute(SET_ARCHIVE_OFFSETS_INDEXED, {
+        'record_name': record_name, 'unique_file_id': unique_file_id,
+        'n_seek_points': len(seek_points),
+        'indexed_date': time.strftime('%Y%m%d%H%M%S')})
+
+
+def get_citation_offset(record_name, pmid, db_con):
+    """Return the offset, length and archive locations of `pmid` in
+    `record_name`, or None
+    """
+    return db_con.execute(
+        GET_CITATION_OFFSET, (record_name, pmid)).fetchone()
+
+
+def get_seek_point(record_name, uncompressed_offset, db_con):
+    """Return the last seek point of `record_name` at or before
+    `uncompressed_offset`, or None
+    """
+    return db_con.execute(
+        GET_SEEK_POINT, (record_name, uncompressed_offset)).fetchone()
+
+
+def record_download_run(server_dir, totals, db_con):
+    """Store the run_metrics `totals` of a run syncing `server_dir`"""
+    db_con.execute(NEW_DOWNLOAD_RUN_SQL, {
+        'run_id': totals['run_id'], 'server_dir': server_dir,
+        'success': int(totals['success']), 'files': totals['files'],
+        'bytes': totals['bytes'], 'seconds': totals['seconds'],
+        'finished': time.strftime(
+            '%Y%m%d%H%M%S', time.localtime(totals['finished']))})
+
+
+def get_download_throughput(db_con, n_runs=10):
+    """Return the bytes per second achieved over the last `n_runs`
+    runs that downloaded anything, or None without any history
+    """
+    row = db_con.execute(GET_DOWNLOAD_THROUGHPUT, (n_runs,)).fetchone()
+    if not row['seconds']:
+        return None
+    return row['bytes'] / row['seconds']
+
+
+def record_exports(exports, db_con):
+    """Mark archives as staged for export in one batch
+
+    `exports` is a sequence of (unique_file_id, export_location) pairs.
+    Pairs that don't refer to an archive (e.g., checksum files) are
+    ignored.
+    """
+    db_con.executemany(SET_EXPORT_LOCATION, exports)
+
+
+def check_exported_file_directory(export_dir, db_con):
     """Determine if the exported files have been removed by the application
     server.
+
+    The names of files currently in `export_dir` are loaded into a
+    temporary table; every archive exported to `export_dir` that is no
+    longer present is marked `downloaded_by_application` with a single
+    UPDATE. Returns the `download_location` of each archive
+    marked.
     """
-    # Look for all files that were moved for export; diff vs files
-    # that are currently in export dir; set downloaded by
-    # downloaded_by_application value
-    #files_ready_for_export = db_con.execute(GET_EXPORTED_RECORDS)
+    db_con.execute(CREATE_EXPORT_DIR_FILES_TABLE)
+    db_con.execute("DELETE FROM temp.export_dir_files")
+    with os.scandir(export_dir) as entries:
+        db_con.executemany(
+            "INSERT OR IGNORE INTO temp.export_dir_files (filename)"
+            " VALUES (?)",
+            ((entry.name,) for entry in entries if entry.is_file()))
+    # Only archives exported to this directory can have been retrieved
+    # from it
+    params = {'export_dir': path.join(export_dir, ''),
+              'abs_export_dir': path.join(path.abspath(export_dir), '')}
+    consumed = [row['download_location'] for row in
+                db_con.execute(GET_DOWNLOADED_BY_APPLICATION, params)]
+    db_con.execute(SET_DOWNLOADED_BY_APPLICATION, params)
+    return consumed
 
 
 ##############
@@ -120,6 +606,10 @@ DOWNLOADED_FILES_SCHEMA = """
          '1' if the archive is no longer in the export directory after
          having been transferred.
 
+     md5_verified
+         '1' if observed_md5 matches the hash in the archive's .md5
+         file, '-1' if it doesn't and '0' if it hasn't been checked.
+
     */
     CREATE TABLE nlm_archives (
         id INTEGER PRIMARY KEY,
@@ -162,6 +652,283 @@ DOWNLOADED_FILES_SCHEMA = """
     );
     """
 
+SCHEMA_ADDITIONS = """
+    /* downloaded_file_ids
+
+    Every unique_file_id already recorded. Each table has a UNIQUE index
+    on unique_file_id, which SQLite uses for lookups through the view.
+    */
+    CREATE VIEW IF NOT EXISTS downloaded_file_ids AS
+        SELECT unique_file_id FROM nlm_archives
+        UNION ALL
+        SELECT unique_file_id FROM md5_checksums
+        UNION ALL
+        SELECT unique_file_id FROM archive_notes;
+
+    CREATE INDEX IF NOT EXISTS md5_checksums_referenced_record
+        ON md5_checksums (referenced_record);
+
+    CREATE INDEX IF NOT EXISTS nlm_archives_transferred_for_output
+        ON nlm_archives (transferred_for_output, downloaded_by_application);
+
+    CREATE INDEX IF NOT EXISTS nlm_archives_filename
+        ON nlm_archives (filename);
+    CREATE INDEX IF NOT EXISTS nlm_archives_record_name
+        ON nlm_archives (record_name);
+    CREATE INDEX IF NOT EXISTS nlm_archives_size
+        ON nlm_archives (size, observed_md5);
+    CREATE INDEX IF NOT EXISTS md5_checksums_filename
+        ON md5_checksums (filename);
+    CREATE INDEX IF NOT EXISTS archive_notes_filename
+        ON archive_notes (filename);
+
+    /* pmid_locations, indexed_archives
+
+    Every archive mentioning each PMID (deleted is 1 if that archive's
+    DeleteCitation removes it; the latest record name holds the current
+    version), and the version of each archive that has been indexed.
+    */
+    CREATE TABLE IF NOT EXISTS pmid_locations (
+        pmid INTEGER NOT NULL,
+        record_name TEXT NOT NULL,
+        deleted INTEGER NOT NULL,
+        PRIMARY KEY (pmid, record_name)
+    ) WITHOUT ROWID;
+
+    CREATE INDEX IF NOT EXISTS pmid_locations_record_name
+        ON pmid_locations (record_name);
+
+    CREATE TABLE IF NOT EXISTS indexed_archives (
+        record_name TEXT PRIMARY KEY,
+        unique_file_id TEXT NOT NULL,
+        n_citations INTEGER NOT NULL,
+        n_deleted INTEGER NOT NULL,
+        indexed_date TEXT NOT NULL
+    ) WITHOUT ROWID;
+
+    /* archive_seek_points, citation_offsets, offset_indexed_archives
+
+    Random access into gzipped archives (see gzip_index.py). window is
+    the zlib-compressed output preceding a seek point; bits is the
+    number of bits of the byte before compressed_offset that belong to
+    the point's deflate block.
+    */
+    CREATE TABLE IF NOT EXISTS archive_seek_points (
+        record_name TEXT NOT NULL,
+        uncompressed_offset INTEGER NOT NULL,
+        compressed_offset INTEGER NOT NULL,
+        bits INTEGER NOT NULL,
+        window BLOB NOT NULL,
+        PRIMARY KEY (record_name, uncompressed_offset)
+    );
+
+    CREATE TABLE IF NOT EXISTS citation_offsets (
+        record_name TEXT NOT NULL,
+        pmid INTEGER NOT NULL,
+        uncompressed_offset INTEGER NOT NULL,
+        length INTEGER NOT NULL,
+        PRIMARY KEY (record_name, pmid)
+    ) WITHOUT ROWID;
+
+    CREATE TABLE IF NOT EXISTS offset_indexed_archives (
+        record_name TEXT PRIMARY KEY,
+        unique_file_id TEXT NOT NULL,
+        n_seek_points INTEGER NOT NULL,
+        indexed_date TEXT NOT NULL
+    ) WITHOUT ROWID;
+
+    /* listing_snapshots, listing_entries
+
+    The last processed MLSD listing of each server directory. digest is
+    NULL while files from that listing remain to be downloaded.
+    */
+    CREATE TABLE IF NOT EXISTS listing_snapshots (
+        server_dir TEXT PRIMARY KEY,
+        digest TEXT,
+        listed_date TEXT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS listing_entries (
+        server_dir TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        unique_file_id TEXT NOT NULL,
+        modification_date TEXT,
+        size INTEGER,
+        PRIMARY KEY (server_dir, filename)
+    ) WITHOUT ROWID;
+
+    /* md5_modification_dates
+
+    MLSD modify fact of each recorded .md5 file, so a checksum file
+    older than its archive (one describing an earlier version of a
+    reissued archive) isn't used to verify it.
+    */
+    CREATE TABLE IF NOT EXISTS md5_modification_dates (
+        unique_file_id TEXT PRIMARY KEY,
+        modification_date TEXT
+    ) WITHOUT ROWID;
+
+    /* download_runs
+
+    Totals of each download run (see run_metrics.RunMetrics.totals),
+    used to estimate how long later runs will take.
+    */
+    CREATE TABLE IF NOT EXISTS download_runs (
+        run_id TEXT NOT NULL,
+        server_dir TEXT NOT NULL,
+        success INTEGER NOT NULL,
+        files INTEGER NOT NULL,
+        bytes INTEGER NOT NULL,
+        seconds REAL NOT NULL,
+        finished TEXT NOT NULL
+    );
+    """
+
+CREATE_LISTED_FILES_TABLE = """
+    CREATE TEMP TABLE IF NOT EXISTS listed_files (
+        position INTEGER PRIMARY KEY,
+        unique_file_id TEXT NOT NULL
+    );
+    """
+
+GET_NEW_LISTED_FILES = """
+    SELECT position
+    FROM temp.listed_files AS listed
+    WHERE NOT EXISTS (
+        SELECT 1 FROM downloaded_file_ids AS downloaded
+        WHERE downloaded.unique_file_id = listed.unique_file_id)
+    ORDER BY position;
+    """
+
+CREATE_SNAPSHOT_LISTING_TABLE = """
+    CREATE TEMP TABLE IF NOT EXISTS snapshot_listing (
+        position INTEGER PRIMARY KEY,
+        filename TEXT NOT NULL,
+        unique_file_id TEXT NOT NULL,
+        modification_date TEXT,
+        size INTEGER,
+        pending INTEGER NOT NULL
+    );
+    """
+
+GET_CHANGED_LISTED_FILES = """
+    SELECT listed.position,
+        snapshot.filename IS NOT NULL AND (
+            snapshot.modification_date IS NOT listed.modification_date
+            OR snapshot.size IS NOT listed.size) AS reissued
+    FROM temp.snapshot_listing AS listed
+    LEFT JOIN listing_entries AS snapshot
+        ON snapshot.server_dir = :server_dir
+        AND snapshot.filename = listed.filename
+    WHERE snapshot.filename IS NULL
+        OR snapshot.unique_file_id IS NOT listed.unique_file_id
+        OR snapshot.modification_date IS NOT listed.modification_date
+        OR snapshot.size IS NOT listed.size
+    ORDER BY listed.position;
+    """
+
+DELETE_UNLISTED_ENTRIES = """
+    DELETE FROM listing_entries
+    WHERE server_dir = :server_dir
+        AND filename NOT IN (SELECT filename FROM temp.snapshot_listing);
+    """
+
+SAVE_LISTING_ENTRIES = """
+    INSERT OR REPLACE INTO listing_entries (server_dir, filename,
+        unique_file_id, modification_date, size)
+    SELECT :server_dir, filename, unique_file_id, modification_date, size
+    FROM temp.snapshot_listing
+    WHERE NOT pending;
+    """
+
+SAVE_LISTING_SNAPSHOT = """
+    INSERT OR REPLACE INTO listing_snapshots (server_dir, digest,
+        listed_date)
+    VALUES (:server_dir, :digest, :listed_date);
+    """
+
+GET_UNINDEXED_ARCHIVES = """
+    SELECT archives.record_name, archives.unique_file_id,
+        archives.download_location, archives.export_location
+    FROM nlm_archives AS archives
+    LEFT JOIN indexed_archives AS indexed
+        ON indexed.record_name = archives.record_name
+    WHERE indexed.unique_file_id IS NOT archives.unique_file_id
+    ORDER BY archives.record_name;
+    """
+
+NEW_PMID_LOCATION = """
+    INSERT OR REPLACE INTO pmid_locations (pmid, record_name, deleted)
+    VALUES (?, ?, ?);
+    """
+
+SET_ARCHIVE_INDEXED = """
+    INSERT OR REPLACE INTO indexed_archives (record_name, unique_file_id,
+        n_citations, n_deleted, indexed_date)
+    VALUES (:record_name, :unique_file_id, :n_citations, :n_deleted,
+        :indexed_date);
+    """
+
+GET_PMID_LOCATION = """
+    SELECT locations.pmid, locations.record_name, locations.deleted,
+        archives.download_location
+    FROM pmid_locations AS locations
+    LEFT JOIN nlm_archives AS archives
+        ON archives.record_name = locations.record_name
+    WHERE locations.pmid = ?
+    ORDER BY locations.record_name DESC
+    LIMIT 1;
+    """
+
+GET_ARCHIVES_WITHOUT_OFFSETS = """
+    SELECT archives.record_name, archives.unique_file_id,
+        archives.download_location, archives.export_location
+    FROM nlm_archives AS archives
+    LEFT JOIN offset_indexed_archives AS indexed
+        ON indexed.record_name = archives.record_name
+    WHERE indexed.unique_file_id IS NOT archives.unique_file_id
+    ORDER BY archives.record_name;
+    """
+
+NEW_SEEK_POINT_SQL = """
+    INSERT INTO archive_seek_points (record_name, uncompressed_offset,
+        compressed_offset, bits, window)
+    VALUES (?, ?, ?, ?, ?);
+    """
+
+NEW_CITATION_OFFSET_SQL = """
+    INSERT OR REPLACE INTO citation_offsets (record_name, pmid,
+        uncompressed_offset, length)
+    VALUES (?, ?, ?, ?);
+    """
+
+SET_ARCHIVE_OFFSETS_INDEXED = """
+    INSERT OR REPLACE INTO offset_indexed_archives (record_name,
+        unique_file_id, n_seek_points, indexed_date)
+    VALUES (:record_name, :unique_file_id, :n_seek_points, :indexed_date);
+    """
+
+GET_CITATION_OFFSET = """
+    SELECT citations.uncompressed_offset, citations.length,
+        archives.download_location, archives.export_location
+    FROM citation_offsets AS citations
+    JOIN nlm_archives AS archives
+        ON archives.record_name = citations.record_name
+    WHERE citations.record_name = ? AND citations.pmid = ?;
+    """
+
+GET_SEEK_POINT = """
+    SELECT uncompressed_offset, compressed_offset, bits, window
+    FROM archive_seek_points
+    WHERE record_name = ? AND uncompressed_offset <= ?
+    ORDER BY uncompressed_offset DESC
+    LIMIT 1;
+    """
+
+DELETE_PREVIOUS_DOWNLOAD_SQL = """
+    DELETE FROM {table} WHERE filename = ?;
+    """
+
 NEW_ARCHIVE_SQL = """
     INSERT INTO nlm_archives (size, record_name, filename, unique_file_id,
         modification_date, observed_md5, md5_verified, download_date,
@@ -190,20 +957,137 @@ NEW_NOTE_SQL = """
             :download_date);
     """
 
-SET_READY_FOR_EXPORT = """
+SET_EXPORT_LOCATION = """
     UPDATE nlm_archives
-    SET transferred_for_output=1
-    WHERE record_name=:referenced_record;
+    SET transferred_for_output=1, export_location=?2
+    WHERE unique_file_id=?1;
+    """
+
+CREATE_EXPORT_DIR_FILES_TABLE = """
+    CREATE TEMP TABLE IF NOT EXISTS export_dir_files (
+        filename TEXT PRIMARY KEY
+    ) WITHOUT ROWID;
     """
 
-GET_EXPORTED_RECORDS = """
-    SELECT filename
+GET_DOWNLOADED_BY_APPLICATION = """
+    SELECT download_location
     FROM nlm_archives
-    WHERE transferred_for_output=1;
+    WHERE transferred_for_output=1
+        AND downloaded_by_application=0
+        AND export_location IN (:export_dir || filename,
+                                :abs_export_dir || filename)
+        AND filename NOT IN (SELECT filename FROM temp.export_dir_files);
     """
 
 SET_DOWNLOADED_BY_APPLICATION = """
     UPDATE nlm_archives
     SET downloaded_by_application=1
-    WHERE record_name=:referenced_record;
+    WHERE transferred_for_output=1
+        AND downloaded_by_application=0
+        AND export_location IN (:export_dir || filename,
+                                :abs_export_dir || filename)
+        AND filename NOT IN (SELECT filename FROM temp.export_dir_files);
+    """
+
+GET_ARCHIVE_LOCATIONS = """
+    SELECT id, record_name, download_location, export_location
+    FROM nlm_archives;
+    """
+
+SET_OBSERVED_MD5 = """
+    UPDATE nlm_archives
+    SET observed_md5=?
+    WHERE id=?;
+    """
+
+GET_ARCHIVE_CHECKSUMS = """
+    SELECT nlm_archives.id, nlm_archives.record_name,
+        nlm_archives.observed_md5, nlm_archives.modification_date,
+        md5_checksums.md5_value,
+        md5_dates.modification_date AS md5_modification_date
+    FROM nlm_archives
+    JOIN md5_checksums
+        ON md5_checksums.referenced_record = nlm_archives.record_name
+    LEFT JOIN md5_modification_dates AS md5_dates
+        ON md5_dates.unique_file_id = md5_checksums.unique_file_id;
+    """
+
+GET_UNVERIFIED_CHECKSUMS = """
+    SELECT nlm_archives.id, nlm_archives.record_name,
+        nlm_archives.observed_md5, nlm_archives.modification_date,
+        md5_checksums.md5_value,
+        md5_dates.modification_date AS md5_modification_date
+    FROM nlm_archives
+    JOIN md5_checksums
+        ON md5_checksums.referenced_record = nlm_archives.record_name
+    LEFT JOIN md5_modification_dates AS md5_dates
+        ON md5_dates.unique_file_id = md5_checksums.unique_file_id
+    WHERE nlm_archives.md5_verified = 0;
+    """
+
+NEW_MD5_MODIFICATION_DATE = """
+    INSERT OR REPLACE INTO md5_modification_dates (unique_file_id,
+        modification_date)
+    VALUES (:unique_file_id, :modification_date);
+    """
+
+RESET_MD5_VERIFIED = """
+    UPDATE nlm_archives
+    SET md5_verified=0
+    WHERE record_name=?;
+    """
+
+SET_MD5_VERIFIED = """
+    UPDATE nlm_archives
+    SET md5_verified=?
+    WHERE id=?;
+    """
+
+IS_MD5_MISMATCH = """
+    SELECT 1 FROM nlm_archives WHERE record_name = ? AND md5_verified = ?;
+    """
+
+GET_STAGED_EXPORTS = """
+    SELECT id, export_location
+    FROM nlm_archives
+    WHERE record_name = ? AND transferred_for_output = 1
+        AND downloaded_by_application = 0 AND export_location != '';
+    """
+
+CLEAR_EXPORT_LOCATION = """
+    UPDATE nlm_archives
+    SET transferred_for_output=0, export_location=''
+    WHERE id=?;
+    """
+
+HAS_ARCHIVE_OF_SIZE = """
+    SELECT 1 FROM nlm_archives WHERE size = ? LIMIT 1;
+    """
+
+GET_MD5_VALUE = """
+    SELECT md5_value FROM md5_checksums WHERE unique_file_id = ?;
+    """
+
+GET_ARCHIVE_COPIES = """
+    SELECT record_name, filename, download_location, export_location
+    FROM nlm_archives
+    WHERE size = ? AND observed_md5 = ? AND md5_verified != ?
+    ORDER BY download_date DESC;
+    """
+
+NEW_DOWNLOAD_RUN_SQL = """
+    INSERT INTO download_runs (run_id, server_dir, success, files, bytes,
+        seconds, finished)
+
+        VALUES (:run_id, :server_dir, :success, :files, :bytes, :seconds,
+            :finished);
+    """
+
+GET_DOWNLOAD_THROUGHPUT = """
+    SELECT sum(bytes) AS bytes, sum(seconds) AS seconds
+    FROM (SELECT bytes, seconds
+          FROM download_runs
+          WHERE bytes > 0
+          ORDER BY finished DESC
+          LIMIT ?);
     """
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+notifications.py
+================
+
+Email notifications for download runs, delivered from a background
+thread so that a slow or failing mail server never holds up (or fails)
+a download.
+
+Events passed to `Notifier.notify` are queued. A worker thread waits
+`batch_delay` seconds after the first event for others to arrive and
+sends them together as one message, over an SMTP connection that is
+kept open between batches (checked with NOOP before reuse and reopened
+if the server has dropped it).
+
+(c) 2014, Edward J. Stronge
+Available under the GPLv3 - see LICENSE for details.
+"""
+from collections import namedtuple
+from email.message import EmailMessage
+from email.utils import formatdate
+import queue
+import threading
+import time
+
+Notification = namedtuple('Notification', 'subject body')
+
+# Queued by `Notifier.close` to stop the worker
+_STOP = object()
+
+
+def format_message(from_addr, to_addr, notifications):
+    """Return an EmailMessage combining `notifications`"""
+    message = EmailMessage()
+    message['From'] = from_addr
+    message['To'] = to_addr
+    message['Date'] = formatdate(localtime=True)
+    if len(notifications) == 1:
+        message['Subject'] = notifications[0].subject
+        message.set_content(notifications[0].body)
+    else:
+        message['Subject'] = '%s (and %d more)' % (
+            notifications[0].subject, len(notifications) - 1)
+        message.set_content('\n\n'.join(
+            '== %s ==\n%s' % notification
+            for notification in notifications))
+    return message
+
+
+class Notifier(object):
+    """Sends queued notifications from `from_addr` to `to_addr`
+
+    `connection_factory` returns a connected smtplib.SMTP (or an object
+    with its `sendmail`, `noop` and `quit` methods). Notifications
+    arriving within `batch_delay` seconds of the first are combined, up
+    to `max_batch` of them. A batch that can't be sent is retried
+    `retries` times over a fresh connection, `retry_delay` seconds
+    apart, and then dropped; `sent` and `failed` count batches and
+    `last_error` holds the latest delivery error. The connection is
+    closed after `idle_timeout` seconds without notifications.
+    """
+
+    def __init__(self, connection_factory, from_addr, to_addr,
+                 batch_delay=5, max_batch=50, retries=2, retry_delay=5,
+                 idle_timeout=300):
+        self.connection_factory = connection_factory
+        self.from_addr = from_addr
+        self.to_addr = to_addr
+        self.batch_delay = batch_delay
+        self.max_batch = max_batch
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.idle_timeout = idle_timeout
+        self.sent = 0
+        self.failed = 0
+        self.last_error = None
+        self.connection = None
+        self.events = queue.Queue()
+        self.closed = False
+        # A daemon thread, so an unresponsive server can't keep the
+        # process alive
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def notify(self, subject, body):
+        """Queue a notification; never blocks"""
+        if not self.closed:
+            self.events.put(Notification(subject, body))
+
+    def close(self, timeout=30):
+        """Send queued notifications, waiting at most `timeout` seconds
+
+        Returns True if everything queued was handled in time.
+        """
+        if not self.closed:
+            self.closed = True
+            self.events.put(_STOP)
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _next_batch(self):
+        """Return the next batch of notifications, [] if the connection
+        has been idle for `idle_timeout`, or None once closed
+        """
+        try:
+            first = self.events.get(timeout=self.idle_timeout)
+        except queue.Empty:
+            return []
+        if first is _STOP:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.batch_delay
+        while len(batch) < self.max_batch:
+            try:
+                event = self.events.get(
+                    timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if event is _STOP:
+                # Send what has arrived straight away, then stop
+                self.events.put(_STOP)
+                break
+            batch.append(event)
+        return batch
+
+    def _run(self):
+        try:
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    return
+                if batch:
+                    self._send(batch)
+                else:
+                    self._disconnect()
+        finally:
+            self._disconnect()
+
+    def _get_connection(self):
+        if self.connection is not None:
+            try:
+                self.connection.noop()
+            except Exception:
+                self._disconnect()
+        if self.connection is None:
+            self.connection = self.connection_factory()
+        return self.connection
+
+    def _disconnect(self):
+        if self.connection is None:
+            return
+        try:
+            self.connection.quit()
+        except Exception:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+        self.connection = None
+
+    def _send(self, batch):
+        message = format_message(self.from_addr, self.to_addr, batch)
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.retry_delay)
+            # Whatever the mail server (or SMTP library) raises, the
+            # notification is given up rather than the worker stopping
+            try:
+                self._get_connection().sendmail(
+                    self.from_addr, [self.to_addr], message.as_string())
+            except Exception as error:
+                self.last_error = error
+                self._disconnect()
+            else:
+                self.sent += 1
+                return
+        self.failed += 1
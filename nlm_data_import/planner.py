@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+planner.py
+==========
+
+Dry run of a download. Each server directory is listed and compared
+with the downloads database just as a real run would, and the files
+that would be fetched are reported with their total size, the time the
+transfer should take at the throughput of recent runs and whether the
+local directories have room for them. Nothing is downloaded and the
+database is left unchanged.
+
+Archives that turn out to be re-published copies of files already held
+are only recognised once their `.md5` files are fetched (see
+`download_nlm_data.reuse_local_copies`), so a real run may transfer
+less than planned.
+
+(c) 2014, Edward J. Stronge
+Available under the GPLv3 - see LICENSE for details.
+"""
+from collections import namedtuple
+import datetime
+import os
+from os import path
+import shutil
+
+from . import directory_sync
+from . import download_nlm_data as downloader
+from . import nlm_downloads_db as ftp_db
+from . import scheduler
+
+# Files to fetch for a directory_sync.SyncTarget. `transfer_bytes`
+# leaves out the parts of partial downloads that would be resumed.
+DirectoryPlan = namedtuple(
+    'DirectoryPlan', 'target files total_bytes transfer_bytes')
+
+# Space needed and free on the filesystem holding `path`
+DiskRequirement = namedtuple('DiskRequirement', 'path required free')
+
+# `bytes_per_second` and `eta_seconds` are None without download history
+DownloadPlan = namedtuple(
+    'DownloadPlan',
+    'directories total_bytes transfer_bytes bytes_per_second eta_seconds'
+    ' disks')
+
+
+def plan_directory(connection, target, db_con, limit=0, max_bytes=0,
+                   order='listing'):
+    """Return a DirectoryPlan of the files a run would download for
+    SyncTarget `target`; arguments are as for
+    `download_nlm_data.retrieve_nlm_files`
+    """
+    mlsd_lines = directory_sync.fetch_listing(connection, target.server_dir)
+    update = downloader.check_listing(target.server_dir, mlsd_lines, db_con)
+    if update is None:
+        return DirectoryPlan(target, [], 0, 0)
+    files = scheduler.limit_downloads(
+        scheduler.order_downloads(update.files_to_download, order),
+        limit, max_bytes)
+
+    total_bytes = transfer_bytes = 0
+    for file_info in files:
+        size = int(file_info.size) if file_info.size else 0
+        total_bytes += size
+        # Shorter local copies are resumed unless NLM reissued the file
+        # (see `download_nlm_data.download_file`)
+        local_path = path.join(target.output_dir, file_info.filename)
+        if file_info.filename not in update.reissued and \
+                path.exists(local_path) and path.getsize(local_path) < size:
+            transfer_bytes += size - path.getsize(local_path)
+        else:
+            transfer_bytes += size
+    return DirectoryPlan(target, files, total_bytes, transfer_bytes)
+
+
+def _existing_directory(directory):
+    """Return `directory` or its nearest existing parent"""
+    directory = path.abspath(directory)
+    while not path.isdir(directory):
+        directory = path.dirname(directory)
+    return directory
+
+
+def disk_requirements(directory_plans):
+    """Return a DiskRequirement for each filesystem written to by
+    `directory_plans`
+
+    Downloads need their transfer size in the output directory.
+    Exports are hard links if the export directory is on the output
+    directory's filesystem and full copies otherwise.
+    """
+    required = {}
+
+    def add(directory, n_bytes):
+        directory = _existing_directory(directory)
+        device = os.stat(directory).st_dev
+        required.setdefault(device, [directory, 0])[1] += n_bytes
+        return device
+
+    for plan in directory_plans:
+        output_device = add(plan.target.output_dir, plan.transfer_bytes)
+        if plan.target.export_dir:
+            export_dir = _existing_directory(plan.target.export_dir)
+            add(export_dir, 0 if os.stat(export_dir).st_dev == output_device
+                else plan.total_bytes)
+    return [DiskRequirement(directory, n_bytes,
+                            shutil.disk_usage(directory).free)
+            for directory, n_bytes in required.values()]
+
+
+def plan_downloads(connection, targets, db_con, limit=0, max_bytes=0,
+                   order='listing', n_runs=10):
+    """Return a DownloadPlan for syncing each SyncTarget in `targets`
+
+    The transfer time is estimated from the throughput of the last
+    `n_runs` runs recorded in the downloads database. `connection` is
+    a logged-in ftplib.FTP object; other arguments are as for
+    `directory_sync.retrieve_directories`.
+    """
+    directories = [
+        plan_directory(connection, target, db_con, limit, max_bytes, order)
+        for target in targets]
+    total_bytes = sum(d.total_bytes for d in directories)
+    transfer_bytes = sum(d.transfer_bytes for d in directories)
+    bytes_per_second = ftp_db.get_download_throughput(db_con, n_runs)
+    if not transfer_bytes:
+        eta_seconds = 0
+    elif bytes_per_second:
+        eta_seconds = transfer_bytes / bytes_per_second
+    else:
+        eta_seconds = None
+    return DownloadPlan(
+        directories, total_bytes, transfer_bytes, bytes_per_second,
+        eta_seconds, disk_requirements(directories))
+
+
+def plan_as_dict(plan):
+    """Return DownloadPlan `plan` as a JSON-serialisable dict"""
+    return {
+        'directories': [{
+            'server_dir': d.target.server_dir,
+            'output_dir': d.target.output_dir,
+            'export_dir': d.target.export_dir,
+            'files': [{
+                'filename': f.filename,
+                'size': int(f.size) if f.size else None,
+                'modification_date': f.modification_date,
+                'unique_file_id': f.unique_file_id} for f in d.files],
+            'total_bytes': d.total_bytes,
+            'transfer_bytes': d.transfer_bytes,
+        } for d in plan.directories],
+        'files': sum(len(d.files) for d in plan.directories),
+        'total_bytes': plan.total_bytes,
+        'transfer_bytes': plan.transfer_bytes,
+        'bytes_per_second': plan.bytes_per_second,
+        'eta_seconds': plan.eta_seconds,
+        'disks': [{
+            'path': disk.path,
+            'required': disk.required,
+            'free': disk.free,
+            'sufficient': disk.free >= disk.required,
+        } for disk in plan.disks],
+    }
+
+
+def format_plan(plan):
+    """Return DownloadPlan `plan` as a human-readable report"""
+    lines = []
+    for directory in plan.directories:
+        lines.append('%s -> %s: %d files, %s bytes' % (
+            directory.target.server_dir, directory.target.output_dir,
+            len(directory.files), format(directory.total_bytes, ',')))
+        lines.extend(
+            '    %-40s %15s' % (
+                f.filename, format(int(f.size), ',') if f.size else '?')
+            for f in directory.files)
+
+    lines.append('Total: %d files, %s bytes (%s to transfer)' % (
+        sum(len(d.files) for d in plan.directories),
+        format(plan.total_bytes, ','), format(plan.transfer_bytes, ',')))
+    if plan.eta_seconds is None:
+        lines.append('Estimated time: unknown (no download history)')
+    elif plan.bytes_per_second:
+        lines.append('Estimated time: %s at %s bytes/second' % (
+            datetime.timedelta(seconds=round(plan.eta_seconds)),
+            format(round(plan.bytes_per_second), ',')))
+    else:
+        lines.append('Estimated time: 0:00:00')
+    for disk in plan.disks:
+        lines.append('Disk space on %s: %s bytes needed, %s free%s' % (
+            disk.path, format(disk.required, ','), format(disk.free, ','),
+            '' if disk.free >= disk.required else ' - NOT ENOUGH SPACE'))
+    return '\n'.join(lines)
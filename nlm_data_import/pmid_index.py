@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+pmid_index.py
+=============
+
+Post-download stage indexing which archive holds the latest version of
+each PMID (see `nlm_downloads_db.get_pmid_location`).
+
+Archives are stream-decompressed and parsed with `iterparse` on a pool
+of worker processes, so neither a whole archive nor its parse tree is
+ever held in memory. Each archive's PMIDs are written to the downloads
+database in bulk as soon as it has been parsed.
+
+(c) 2014, Edward J. Stronge
+Available under the GPLv3 - see LICENSE for details.
+"""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+from os import path
+from xml.etree import ElementTree
+
+from . import nlm_downloads_db as ftp_db
+
+# PMIDs found in one archive; `error` is set if it couldn't be read
+ArchivePMIDs = namedtuple('ArchivePMIDs', 'citations deleted error')
+
+IndexReport = namedtuple('IndexReport', 'indexed missing failed')
+
+
+def extract_pmids(archive_path):
+    """Return the ArchivePMIDs of the MedlineCitation and DeleteCitation
+    entries in the gzipped archive `archive_path`
+    """
+    citations = []
+    deleted = []
+    try:
+        with gzip.open(archive_path, 'rb') as archive:
+            events = ElementTree.iterparse(archive, events=('start', 'end'))
+            _, root = next(events)
+            for event, element in events:
+                if event != 'end':
+                    continue
+                if element.tag == 'MedlineCitation':
+                    citations.append(int(element.findtext('PMID')))
+                elif element.tag == 'DeleteCitation':
+                    deleted.extend(
+                        int(pmid.text) for pmid in element.iter('PMID'))
+                else:
+                    continue
+                # Drop every finished citation from the tree
+                root.clear()
+    except (OSError, EOFError, ElementTree.ParseError,
+            TypeError, ValueError) as error:
+        return ArchivePMIDs(None, None, str(error))
+    return ArchivePMIDs(citations, deleted, None)
+
+
+def _archive_path(archive):
+    """Return the download or export location of `archive` that exists"""
+    for location in (archive['download_location'],
+                     archive['export_location']):
+        if location and path.exists(location):
+            return location
+    return None
+
+
+def index_archives(db_con, processes=None):
+    """Index the PMIDs of every archive not yet indexed
+
+    Archives are parsed on `processes` worker processes and committed
+    one at a time, so an interrupted run keeps its progress. Returns an
+    IndexReport listing the record names indexed, missing from disk and
+    unreadable (with their errors).
+    """
+    archives = []
+    missing = []
+    for archive in ftp_db.get_unindexed_archives(db_con):
+        archive_path = _archive_path(archive)
+        if archive_path is None:
+            missing.append(archive['record_name'])
+        else:
+            archives.append((archive, archive_path))
+
+    indexed = []
+    failed = []
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = executor.map(
+            extract_pmids, [archive_path for _, archive_path in archives])
+        for (archive, _), pmids in zip(archives, results):
+            if pmids.error is not None:
+                failed.append((archive['record_name'], pmids.error))
+                continue
+            ftp_db.record_pmid_locations(
+                archive['record_name'], archive['unique_file_id'],
+                pmids.citations, pmids.deleted, db_con)
+            db_con.commit()
+            indexed.append(archive['record_name'])
+    return IndexReport(indexed, missing, failed)
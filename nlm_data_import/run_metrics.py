@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+run_metrics.py
+==============
+
+Per-file and per-run measurements for download runs. Metrics can be
+appended to a JSON-lines log and written to a Prometheus
+textfile-collector file (see
+https://github.com/prometheus/node_exporter#textfile-collector).
+
+(c) 2014, Edward J. Stronge
+Available under the GPLv3 - see LICENSE for details.
+"""
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+import json
+import os
+from os import path
+import threading
+import time
+
+# Stages timed for each file, in pipeline order. `reuse` stands in for
+# `download` when a copy already held is staged instead (see
+# `download_nlm_data.reuse_local_copies`); `queue` is the time a
+# downloaded file waits before being processed.
+STAGES = ('reuse', 'download', 'queue', 'export', 'record')
+
+
+def timed(metrics, filename, stage, n_bytes=None):
+    """`metrics.timed(...)`, or a no-op if `metrics` is None"""
+    if metrics is None:
+        return nullcontext()
+    return metrics.timed(filename, stage, n_bytes)
+
+
+class FileMetrics(object):
+    """Measurements for a single downloaded file"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.bytes = 0
+        self.retries = 0
+        self.stage_seconds = {}
+        self.stage_finished = {}
+
+    def as_dict(self):
+        download_seconds = self.stage_seconds.get('download', 0)
+        return {
+            'filename': self.filename,
+            'bytes': self.bytes,
+            'retries': self.retries,
+            'download_seconds': download_seconds,
+            'bytes_per_second': (
+                self.bytes / download_seconds if download_seconds else None),
+            'stage_seconds': self.stage_seconds}
+
+
+class RunMetrics(object):
+    """Collects FileMetrics for one run; safe to use from several threads
+
+    `jsonl_path` and `prometheus_path` are optional output files; each
+    completed file is appended to the JSON-lines log as it finishes and
+    run totals are written by `finish`, which also passes them to
+    `on_finish` if it is given.
+    """
+
+    def __init__(self, jsonl_path=None, prometheus_path=None, labels=None,
+                 on_finish=None):
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.labels = labels or {}
+        self.on_finish = on_finish
+        self.run_id = time.strftime('%Y%m%d%H%M%S')
+        self.started = time.time()
+        self.files = {}
+        # Retries of the whole run rather than of a single file
+        self.retries = 0
+        self.lock = threading.Lock()
+
+    def file(self, filename):
+        with self.lock:
+            if filename not in self.files:
+                self.files[filename] = FileMetrics(filename)
+            return self.files[filename]
+
+    @contextmanager
+    def timed(self, filename, stage, n_bytes=None):
+        """Time the enclosed block as `stage` of `filename`"""
+        start = time.perf_counter()
+        yield
+        finished = time.perf_counter()
+        file_metrics = self.file(filename)
+        with self.lock:
+            file_metrics.stage_seconds[stage] = \
+                file_metrics.stage_seconds.get(stage, 0) + finished - start
+            file_metrics.stage_finished[stage] = finished
+            if n_bytes is not None:
+                file_metrics.bytes += n_bytes
+
+    def record_queue_wait(self, filename):
+        """Record the time since `filename` finished downloading"""
+        file_metrics = self.file(filename)
+        with self.lock:
+            downloaded = file_metrics.stage_finished.get('download')
+            if downloaded is not None:
+                file_metrics.stage_seconds['queue'] = \
+                    time.perf_counter() - downloaded
+
+    def record_retry(self, filename=None):
+        """Count a retried transfer of `filename`, or a retry of the
+        whole run if no filename is given
+        """
+        if filename is None:
+            with self.lock:
+                self.retries += 1
+            return
+        file_metrics = self.file(filename)
+        with self.lock:
+            file_metrics.retries += 1
+
+    def file_done(self, filename):
+        """Append the measurements for `filename` to the JSON-lines log"""
+        self._write_jsonl(dict(
+            self.file(filename).as_dict(), event='file', run_id=self.run_id,
+            **self.labels))
+
+    def totals(self, success=True):
+        with self.lock:
+            files = list(self.files.values())
+        stage_seconds = defaultdict(float)
+        for file_metrics in files:
+            for stage, seconds in file_metrics.stage_seconds.items():
+                stage_seconds[stage] += seconds
+        elapsed = time.time() - self.started
+        total_bytes = sum(f.bytes for f in files)
+        return {
+            'run_id': self.run_id,
+            'success': success,
+            'files': len(files),
+            'bytes': total_bytes,
+            'retries': self.retries + sum(f.retries for f in files),
+            'seconds': elapsed,
+            'bytes_per_second': total_bytes / elapsed if elapsed else 0,
+            'stage_seconds': dict(stage_seconds),
+            'finished': time.time()}
+
+    def finish(self, success=True):
+        """Write run totals to the configured outputs; return them"""
+        totals = self.totals(success)
+        self._write_jsonl(dict(totals, event='run', **self.labels))
+        if self.prometheus_path:
+            write_prometheus_textfile(
+                self.prometheus_path, totals, self.labels)
+        if self.on_finish is not None:
+            self.on_finish(totals)
+        return totals
+
+    def _write_jsonl(self, record):
+        if not self.jsonl_path:
+            return
+        with self.lock:
+            with open(self.jsonl_path, 'a') as log:
+                log.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\').replace(
+            '"', r'\"')) for name, value in sorted(labels.items()))
+
+
+def write_prometheus_textfile(prometheus_path, totals, labels=None):
+    """Write run `totals` in the Prometheus text exposition format
+
+    The file is written under a temporary name and renamed so the
+    collector never reads a partial file.
+    """
+    labels = labels or {}
+    gauges = (
+        ('files', 'Files downloaded in the last run', totals['files']),
+        ('bytes', 'Bytes downloaded in the last run', totals['bytes']),
+        ('retries', 'Retried transfers in the last run', totals['retries']),
+        ('seconds', 'Duration of the last run', totals['seconds']),
+        ('bytes_per_second', 'Download throughput of the last run',
+         totals['bytes_per_second']),
+        ('success', '1 if the last run succeeded', int(totals['success'])),
+        ('timestamp_seconds', 'Time the last run finished',
+         totals['finished']))
+    lines = []
+    for name, help_text, value in gauges:
+        metric = 'nlm_download_last_run_%s' % name
+        lines.extend((
+            '# HELP %s %s' % (metric, help_text),
+            '# TYPE %s gauge' % metric,
+            '%s%s %s' % (metric, _format_labels(labels), value)))
+    metric = 'nlm_download_last_run_stage_seconds'
+    lines.extend((
+        '# HELP %s Time spent in each stage, summed over files' % metric,
+        '# TYPE %s gauge' % metric))
+    for stage in STAGES:
+        lines.append('%s%s %s' % (
+            metric, _format_labels(dict(labels, stage=stage)),
+            totals['stage_seconds'].get(stage, 0)))
+
+    temp_path = path.join(
+        path.dirname(path.abspath(prometheus_path)),
+        '.%s.tmp' % path.basename(prometheus_path))
+    with open(temp_path, 'w') as textfile:
+        textfile.write('\n'.join(lines) + '\n')
+    os.replace(temp_path, prometheus_path)
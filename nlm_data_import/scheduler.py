@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+scheduler.py
+============
+
+Ordering, limits and bandwidth throttling for pending downloads.
+
+Files are scheduled by archive record: an archive is always fetched
+before its `.md5` and notes files, and `ORDERING_POLICIES` decide the
+order of the records themselves.
+
+(c) 2014, Edward J. Stronge
+Available under the GPLv3 - see LICENSE for details.
+"""
+import threading
+import time
+
+from . import nlm_downloads_db as ftp_db
+
+
+def _record_key(file_info):
+    """Group key for `file_info`: its archive record, or its own name"""
+    return ftp_db.get_record_name(file_info.filename) or file_info.filename
+
+
+def _file_rank(file_info):
+    """0 for archives, 1 for their .md5 files and 2 for anything else"""
+    record_name = ftp_db.get_record_name(file_info.filename)
+    if record_name is not None:
+        if file_info.filename == record_name + '.xml.gz':
+            return 0
+        if file_info.filename == record_name + '.xml.gz.md5':
+            return 1
+    return 2
+
+
+def _size(file_info):
+    return int(file_info.size) if file_info.size else 0
+
+
+# Each policy is a (key, reverse) pair: key maps the files of one
+# record to a sort key for the record, sorted in descending order if
+# reverse is True. Records with equal keys keep their listing order.
+ORDERING_POLICIES = {
+    'listing': None,
+    'archives_first': (lambda files: 0, False),
+    # MLSD modify facts are YYYYMMDDHHMMSS timestamps, optionally with
+    # fractional seconds (RFC 3659), so they sort as strings
+    'newest_first': (
+        lambda files: max(f.modification_date or '' for f in files), True),
+    'smallest_first': (lambda files: sum(_size(f) for f in files), False),
+}
+
+
+def order_downloads(files_to_download, policy='listing'):
+    """Return `files_to_download` ordered according to `policy`
+
+        listing - the server's listing order, unchanged
+        archives_first - listing order of records, with each archive
+            before its .md5 and notes files
+        newest_first - most recently modified records first (e.g. the
+            latest update files)
+        smallest_first - smallest records first, so many archives
+            become available quickly
+    """
+    try:
+        record_order = ORDERING_POLICIES[policy]
+    except KeyError:
+        raise ValueError('Unknown ordering policy %r' % policy)
+    files_to_download = list(files_to_download)
+    if record_order is None:
+        return files_to_download
+
+    records = {}
+    for file_info in files_to_download:
+        records.setdefault(_record_key(file_info), []).append(file_info)
+    key, reverse = record_order
+    ordered_records = sorted(records.values(), key=key, reverse=reverse)
+    return [file_info for files in ordered_records
+            for file_info in sorted(files, key=_file_rank)]
+
+
+def limit_downloads(files_to_download, max_files=0, max_bytes=0):
+    """Return the first files of `files_to_download` within the limits
+
+    At most `max_files` files totalling at most `max_bytes` bytes are
+    kept; a limit of 0 disables it. Files that would take the total
+    over `max_bytes` are skipped and later, smaller files considered
+    instead, so files larger than `max_bytes` are never downloaded.
+    """
+    selected = []
+    total_bytes = 0
+    for file_info in files_to_download:
+        if max_files > 0 and len(selected) >= max_files:
+            break
+        size = _size(file_info)
+        if max_bytes > 0 and total_bytes + size > max_bytes:
+            continue
+        selected.append(file_info)
+        total_bytes += size
+    return selected
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket limiting throughput to `rate` bytes/second
+
+    Bursts of up to `capacity` bytes (default: one second's worth) pass
+    without delay. A single bucket can be shared by several connections
+    to cap their combined bandwidth.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def reserve(self, n_bytes):
+        """Take `n_bytes` tokens; return the seconds to wait before using
+        them
+
+        Tokens may go negative, so later callers wait for earlier
+        reservations to be paid off.
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n_bytes
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def consume(self, n_bytes):
+        """Block until `n_bytes` may be transferred"""
+        delay = self.reserve(n_bytes)
+        if delay:
+            time.sleep(delay)
+
+
+def throttled_writer(write, bucket):
+    """Wrap the retrbinary callback `write` so blocks pass through
+    `bucket`
+    """
+    if bucket is None:
+        return write
+
+    def throttled_write(block):
+        bucket.consume(len(block))
+        write(block)
+    return throttled_write
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+benchmarks.py
+=============
+
+Timing checks for the archive downloading module. These aren't run as
+part of the test suite; run them with
+
+    python -m nlm_data_import.test.benchmarks [-o results.json]
+        [-c baseline.json]
+
+Transfer, database and export benchmarks run against a local FTP
+server (see `ftp_server`) serving a generated tree that mimics an NLM
+data directory, so no network access is needed. Results can be saved
+as JSON and compared with a previous run to catch regressions.
+
+(c) 2014, Edward J. Stronge
+Available under the GPLv3 - see LICENSE for details.
+"""
+import argparse
+import json
+import os
+from os import path
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+from .. import download_nlm_data as downloader
+from .. import nlm_downloads_db as downloads_db
+from .ftp_server import FTPServer, LocalFTPServer, generate_nlm_tree
+
+# Metrics where a larger value is an improvement; all others are
+# durations
+HIGHER_IS_BETTER = (
+    'transfer_bytes_per_second', 'per_file_bytes_per_second',
+    'db_inserts_per_second')
+
+
+def synthetic_mlsd_listing(n_lines):
+    """Return `n_lines` MLSD lines resembling an NLM directory listing
+
+    Every fourth file is an md5 checksum and every hundredth a
+    stats.html file that get_file_listing should skip.
+    """
+    lines = []
+    for i in range(n_lines):
+        if i % 100 == 99:
+            filename = 'medline14n%04d.stats.html' % i
+        elif i % 4 == 3:
+            filename = 'medline14n%04d.xml.gz.md5' % i
+        else:
+            filename = 'medline14n%04d.xml.gz' % i
+        lines.append(
+            'modify=20131125174213;perm=adfr;size=%d;type=file;'
+            'unique=46%010X;UNIX.group=183;UNIX.mode=0644;UNIX.owner=505;'
+            ' %s\r\n' % (24847843 + i, i, filename))
+    return lines
+
+
+def benchmark_listing(n_lines=100000, repeat=3):
+    """Time parse_mlsd and get_file_listing on a synthetic listing
+
+    Returns a dict of best-of-`repeat` timings in seconds.
+    """
+    listing = synthetic_mlsd_listing(n_lines)
+    timings = {}
+
+    def best_of(func):
+        return min(timeit.repeat(func, number=1, repeat=repeat))
+
+    timings['parse_mlsd'] = best_of(
+        lambda: [downloader.parse_mlsd(line) for line in listing])
+    timings['parse_mlsd_general'] = best_of(
+        lambda: [downloader._parse_mlsd_facts(line) for line in listing])
+    timings['get_file_listing'] = best_of(
+        lambda: list(downloader.get_file_listing(listing)))
+    # Before get_file_listing rejected bare strings, retrieve_nlm_files
+    # passed the server directory as skip_patterns, compiling one
+    # pattern per character.
+    server_dir_patterns = tuple('/nlmdata/.medleasebaseline/gz/')
+    timings['get_file_listing_per_character_patterns'] = best_of(
+        lambda: list(downloader.get_file_listing(
+            listing, server_dir_patterns)))
+    return timings
+
+
+def benchmark_transfers(n_archives=1000, archive_size=64 * 1024, workers=4,
+                        n_sample_files=20):
+    """Time listing, downloading, recording and exporting a synthetic tree
+
+    Returns a dict of metrics; durations are in seconds and rates in
+    bytes or records per second.
+    """
+    if FTPServer is None:
+        raise RuntimeError('pyftpdlib is required for transfer benchmarks')
+    work_dir = tempfile.mkdtemp()
+    try:
+        server_root = path.join(work_dir, 'server')
+        generate_nlm_tree(
+            path.join(server_root, 'gz'), n_archives, archive_size)
+        output_dir = path.join(work_dir, 'output')
+        export_dir = path.join(work_dir, 'export')
+        sample_dir = path.join(work_dir, 'sample')
+        for directory in (output_dir, export_dir, sample_dir):
+            os.mkdir(directory)
+        metrics = {}
+
+        with LocalFTPServer(server_root) as server:
+            connection = server.connect()
+
+            start = time.perf_counter()
+            listing = list(downloader.get_file_listing(
+                downloader.iter_mlsd_lines(connection, '/gz')))
+            metrics['listing_seconds'] = time.perf_counter() - start
+            metrics['listing_entries'] = len(listing)
+
+            connection.cwd('/gz')
+            sample = [f for f in listing
+                      if f.filename.endswith('.xml.gz')][:n_sample_files]
+            durations = []
+            for file_info in sample:
+                start = time.perf_counter()
+                downloader.download_file(connection, file_info, sample_dir)
+                durations.append(time.perf_counter() - start)
+            metrics['per_file_seconds'] = sum(durations) / len(durations)
+            metrics['per_file_bytes_per_second'] = \
+                archive_size / metrics['per_file_seconds']
+
+            db_con = downloads_db.initialize_database_connection(
+                path.join(work_dir, 'downloads.db'))
+            start = time.perf_counter()
+            retrieved = downloader.retrieve_nlm_files(
+                connection, '/gz', output_dir, db_con, workers=workers,
+                connection_factory=server.connect)
+            elapsed = time.perf_counter() - start
+            connection.quit()
+        metrics['transfer_seconds'] = elapsed
+        metrics['transfer_bytes_per_second'] = sum(
+            int(f.size) for f in retrieved) / elapsed
+
+        records_db = downloads_db.initialize_database_connection(
+            path.join(work_dir, 'records.db'))
+        start = time.perf_counter()
+        downloads_db.record_downloads(retrieved, records_db)
+        records_db.commit()
+        metrics['db_inserts_per_second'] = \
+            len(retrieved) / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        downloader.move_files_for_export(retrieved, export_dir, records_db)
+        records_db.commit()
+        metrics['export_seconds'] = time.perf_counter() - start
+        records_db.close()
+        db_con.close()
+        return metrics
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    """Return (metric, baseline, current) tuples for metrics that are
+    more than `tolerance` worse than in `baseline`
+    """
+    regressions = []
+    for name, current in sorted(results.items()):
+        previous = baseline.get(name)
+        if not previous or name == 'listing_entries':
+            continue
+        if name in HIGHER_IS_BETTER:
+            worse = current < previous * (1 - tolerance)
+        else:
+            worse = current > previous * (1 + tolerance)
+        if worse:
+            regressions.append((name, previous, current))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('-o', '--output', help='Save results as JSON')
+    parser.add_argument(
+        '-c', '--compare', help='JSON results from a previous run')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.2)
+    parser.add_argument('-n', '--archives', type=int, default=1000)
+    parser.add_argument('-s', '--archive_size', type=int, default=64 * 1024)
+    parser.add_argument('-w', '--workers', type=int, default=4)
+    parser.add_argument(
+        '--listing_only', action='store_true',
+        help='Only run the synthetic listing parser benchmarks')
+    args = parser.parse_args()
+
+    results = benchmark_listing()
+    if not args.listing_only:
+        results.update(benchmark_transfers(
+            args.archives, args.archive_size, args.workers))
+    for name, value in sorted(results.items()):
+        print('%-45s %14.3f' % (name, value))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare_results(
+                results, json.load(baseline), args.tolerance)
+        for name, previous, current in regressions:
+            print('REGRESSION %s: %.3f -> %.3f' % (name, previous, current))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
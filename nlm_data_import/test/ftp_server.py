@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+ftp_server.py
+=============
+
+Local stand-in for the NLM FTP server, used by the tests and
+benchmarks. Requires pyftpdlib.
+
+(c) 2014, Edward J. Stronge
+Available under the GPLv3 - see LICENSE for details.
+"""
+import ftplib
+import hashlib
+import logging
+import os
+import threading
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import FTPServer
+except ImportError:
+    FTPServer = None
+
+from .. import download_nlm_data as downloader
+
+
+class LocalFTPServer(object):
+    """pyftpdlib server for `root_dir` running in a background thread"""
+
+    def __init__(self, root_dir, user='nlm', password='nlm'):
+        # Stops pyftpdlib from configuring logging for every command
+        pyftpdlib_logger = logging.getLogger('pyftpdlib')
+        if not pyftpdlib_logger.handlers:
+            pyftpdlib_logger.addHandler(logging.NullHandler())
+        authorizer = DummyAuthorizer()
+        authorizer.add_user(user, password, root_dir, perm='elr')
+
+        class Handler(FTPHandler):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                # The NLM server sends the unique fact by default
+                self._current_facts = ['type', 'size', 'modify', 'unique']
+
+        Handler.authorizer = authorizer
+        self.server = FTPServer(('127.0.0.1', 0), Handler)
+        self.port = self.server.socket.getsockname()[1]
+        self.params = downloader.FTPConnectionParams(
+            '127.0.0.1', user, None, password)
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={'timeout': 0.05})
+
+    def connect(self):
+        """Return a logged-in ftplib.FTP connection to the server"""
+        connection = ftplib.FTP()
+        connection.connect(self.params.host, self.port)
+        connection.login(self.params.user, self.params.password)
+        return connection
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.close_all()
+        self.thread.join()
+
+
+def generate_nlm_tree(directory, n_archives, archive_size, year=14):
+    """Fill `directory` with files mimicking an NLM data directory
+
+    Each archive gets a `.md5` file in NLM's format; every tenth
+    archive also gets a notes file, and a stats.html file is added to
+    the directory. Archive contents are random bytes. Returns the total
+    number of bytes written.
+    """
+    os.makedirs(directory, exist_ok=True)
+    total_bytes = 0
+    for i in range(1, n_archives + 1):
+        name = 'medline%02dn%04d.xml.gz' % (year, i)
+        data = os.urandom(archive_size)
+        files = {
+            name: data,
+            name + '.md5': (
+                'MD5(%s)= %s\n' % (name, hashlib.md5(data).hexdigest())
+                ).encode()}
+        if i % 10 == 0:
+            files['medline%02dn%04d.notes.txt' % (year, i)] = \
+                b'Retracted citations\n'
+        for filename, contents in files.items():
+            with open(os.path.join(directory, filename), 'wb') as f:
+                f.write(contents)
+            total_bytes += len(contents)
+    with open(os.path.join(directory, 'stats.html'), 'w') as stats:
+        stats.write('<html><body>%d archives</body></html>' % n_archives)
+    return total_bytes
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+smtp_server.py
+==============
+
+Local stand-in for a mail server, used to test notifications. Speaks
+just enough SMTP for smtplib and can be made slow, reject messages or
+drop connections.
+
+(c) 2014, Edward J. Stronge
+Available under the GPLv3 - see LICENSE for details.
+"""
+import email
+import smtplib
+import socketserver
+import threading
+import time
+
+
+class LocalSMTPServer(object):
+    """SMTP server on localhost running in a background thread
+
+        delay - seconds to wait before accepting each message
+        reject - number of messages to refuse (with a 451) first
+        drop_after - close each connection after this many messages
+
+    Accepted messages are parsed into `messages`; `connections` counts
+    the connections opened.
+    """
+
+    def __init__(self, delay=0, reject=0, drop_after=None):
+        self.delay = delay
+        self.reject = reject
+        self.drop_after = drop_after
+        self.messages = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        smtp_server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(line.encode('ascii') + b'\r\n')
+
+            def handle(self):
+                with smtp_server.lock:
+                    smtp_server.connections += 1
+                accepted = 0
+                self.reply('220 localhost ready')
+                for line in self.rfile:
+                    command = line.decode('ascii').strip().upper()
+                    if command.startswith(('EHLO', 'HELO')):
+                        self.reply('250 localhost')
+                    elif command.startswith(
+                            ('MAIL', 'RCPT', 'RSET', 'NOOP')):
+                        self.reply('250 OK')
+                    elif command == 'DATA':
+                        self.reply('354 End data with <CR><LF>.<CR><LF>')
+                        data = self.read_data()
+                        time.sleep(smtp_server.delay)
+                        if not smtp_server.accept(data):
+                            self.reply('451 Try again later')
+                            continue
+                        self.reply('250 OK')
+                        accepted += 1
+                        if accepted == smtp_server.drop_after:
+                            return
+                    elif command == 'QUIT':
+                        self.reply('221 Bye')
+                        return
+                    else:
+                        self.reply('500 Unknown command')
+
+            def read_data(self):
+                lines = []
+                for line in self.rfile:
+                    if line == b'.\r\n':
+                        break
+                    # Undo dot-stuffing
+                    lines.append(line[1:] if line.startswith(b'.') else line)
+                return b''.join(lines).replace(b'\r\n', b'\n')
+
+        self.server = socketserver.ThreadingTCPServer(
+            ('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+
+    def accept(self, data):
+        with self.lock:
+            if self.reject:
+                self.reject -= 1
+                return False
+            self.messages.append(email.message_from_bytes(data))
+            return True
+
+    def connect(self):
+        """Return an smtplib.SMTP connection to the server"""
+        return smtplib.SMTP('127.0.0.1', self.port, timeout=5)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
@@ -8,14 +8,62 @@ Test suite for the archive downloading module
 (c) 2014, Edward J. Stronge
 Available under the GPLv3 - see LICENSE for details.
 """
+import argparse
+import asyncio
 from collections import namedtuple
+import ftplib
+import gzip
+import hashlib
+import json
 import os
 import shutil
+import socket
 import tempfile
+import time
 import unittest
 
+try:
+    from .. import nlm_data_tests
+except ImportError:
+    nlm_data_tests = None
+
+from .. import async_download
+from .. import daemon
+from .. import directory_sync
+from .. import export_watcher
+from .. import gzip_index
+from .. import notifications
+from .. import run_metrics
+from .. import scheduler
 from .. import nlm_downloads_db as downloads_db
+from .. import planner
+from .. import pmid_index
 from .. import download_nlm_data as downloader
+from .ftp_server import FTPServer, LocalFTPServer
+from .smtp_server import LocalSMTPServer
+
+
+class FakeFTPConnection(object):
+    """Minimal stand-in for ftplib.FTP serving files from a dict"""
+
+    def __init__(self, files):
+        self.files = files
+        self.cwd_calls = []
+        self.closed = False
+
+    def cwd(self, dirname):
+        self.cwd_calls.append(dirname)
+
+    def retrbinary(self, cmd, callback, blocksize=8192, rest=None):
+        data = self.files[cmd.split(' ', 1)[1]][rest or 0:]
+        for i in range(0, len(data), blocksize):
+            callback(data[i:i + blocksize])
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
 
 
 class TestNLMDatabase(unittest.TestCase):
@@ -170,6 +218,25 @@ class TestNLMDatabase(unittest.TestCase):
             downloads_db.get_downloaded_file_unique_ids(self.test_db),
             unique_ids)
 
+    def test_get_new_files(self):
+        """Test that only files missing from the database are returned,
+        in listing order
+        """
+        self.populate_test_db()
+        listing = [
+            downloader.FTPFileParams('', '1', unique_id, name, '', '', '')
+            for unique_id, name in (
+                ('new2', 'b.xml.gz'), ('unique1', 'nlm1.xml.tar.gz'),
+                ('unique-hash3', 'nlm3.xml.tar.gz.md5'),
+                ('repeated-note1', 'special-note.txt'),
+                ('new1', 'a.xml.gz'))]
+
+        new_files = downloads_db.get_new_files(listing, self.test_db)
+        self.assertListEqual(list(new_files), [listing[0], listing[4]])
+        # The temporary table is reset on each call
+        self.assertListEqual(
+            list(downloads_db.get_new_files(listing[1:4], self.test_db)), [])
+
     def test_record_downloads(self):
         """Test whether we correctly update the downloads database
         with newly downloaded files.
@@ -177,6 +244,207 @@ class TestNLMDatabase(unittest.TestCase):
         records = self.generate_ftp_file_params()
         downloads_db.record_downloads(records, self.test_db)
 
+    def test_check_exported_file_directory(self):
+        """Test that archives removed from the export directory are
+        marked as downloaded by the application
+        """
+        self.populate_test_db()
+        downloads_db.record_exports(
+            [('unique%d' % i, os.path.join('exports', 'nlm%d.xml.tar.gz' % i))
+             for i in (1, 2, 3)], self.test_db)
+        os.mkdir('exports')
+        open(os.path.join('exports', 'nlm2.xml.tar.gz'), 'w').close()
+
+        self.assertListEqual(
+            downloads_db.check_exported_file_directory(
+                'exports', self.test_db),
+            ['downloads/', 'downloads/'])
+        self.assertDictEqual(
+            dict(tuple(row) for row in self.test_db.execute(
+                'SELECT record_name, downloaded_by_application'
+                ' FROM nlm_archives')),
+            {'nlm1': 1, 'nlm2': 0, 'nlm3': 1, 'nlm4': 0, 'nlm5': 0})
+        # Already-marked archives aren't updated again
+        self.assertListEqual(
+            downloads_db.check_exported_file_directory(
+                'exports', self.test_db),
+            [])
+
+    def test_check_exported_file_directory_per_directory(self):
+        """Test that scanning one export directory leaves archives
+        exported to another alone
+        """
+        self.populate_test_db()
+        downloads_db.record_exports(
+            [('unique1', os.path.join(self.temp_dir, 'exp_a',
+                                      'nlm1.xml.tar.gz')),
+             ('unique2', os.path.join('exp_b', 'nlm2.xml.tar.gz'))],
+            self.test_db)
+        os.mkdir('exp_a')
+        os.mkdir('exp_b')
+        open(os.path.join('exp_b', 'nlm2.xml.tar.gz'), 'w').close()
+
+        # Relative and absolute spellings of a directory are equivalent
+        self.assertListEqual(
+            downloads_db.check_exported_file_directory(
+                'exp_a', self.test_db),
+            ['downloads/'])
+        self.assertListEqual(
+            downloads_db.check_exported_file_directory(
+                os.path.join(self.temp_dir, 'exp_b'), self.test_db),
+            [])
+        self.assertDictEqual(
+            dict(tuple(row) for row in self.test_db.execute(
+                'SELECT record_name, downloaded_by_application'
+                ' FROM nlm_archives WHERE transferred_for_output = 1')),
+            {'nlm1': 1, 'nlm2': 0})
+
+    def test_parse_nlm_md5(self):
+        self.assertEqual(
+            downloads_db.parse_nlm_md5(
+                'MD5(medline14n0745.xml.gz)= '
+                '0123456789ABCDEF0123456789abcdef\n'),
+            '0123456789abcdef0123456789abcdef')
+        self.assertIsNone(downloads_db.parse_nlm_md5('745 hash'))
+
+    def test_verify_archive_checksums(self):
+        """Test that archives are checked against their .md5 records,
+        optionally rehashing the archives on disk
+        """
+        contents = {name: os.urandom(2000) for name in ('a', 'b', 'c')}
+        for name, data in contents.items():
+            with open('medline14n000%s.xml.gz' % name, 'wb') as archive:
+                archive.write(data)
+        for name, observed, published in (
+                ('a', contents['a'], contents['a']),
+                ('b', contents['b'], b'changed'),
+                ('c', b'stale', contents['c'])):
+            record = 'medline14n000%s' % name
+            self.test_db.execute(downloads_db.NEW_ARCHIVE_SQL, {
+                'size': 2000, 'referenced_record': record,
+                'filename': record + '.xml.gz', 'unique_file_id': record,
+                'modification_date': '', 'md5_verified': 0,
+                'observed_md5': hashlib.md5(observed).hexdigest(),
+                'download_date': '',
+                'output_path': os.path.abspath(record + '.xml.gz'),
+                'transferred_for_output': 0, 'export_location': '',
+                'downloaded_by_application': 0})
+            self.test_db.execute(downloads_db.NEW_HASH_SQL, {
+                'referenced_record': record, 'unique_file_id': record + 'md5',
+                'md5_value': 'MD5(%s.xml.gz)= %s\n' % (
+                    record, hashlib.md5(published).hexdigest()),
+                'download_date': '', 'filename': record + '.xml.gz.md5',
+                'checksum_file_deleted': 0})
+
+        def verification_states():
+            return dict(tuple(row) for row in self.test_db.execute(
+                'SELECT record_name, md5_verified FROM nlm_archives'))
+
+        report = downloads_db.verify_archive_checksums(self.test_db)
+        self.assertListEqual(report.verified, ['medline14n000a'])
+        self.assertListEqual(
+            sorted(report.mismatched), ['medline14n000b', 'medline14n000c'])
+        self.assertDictEqual(verification_states(), {
+            'medline14n000a': 1, 'medline14n000b': -1, 'medline14n000c': -1})
+
+        os.remove('medline14n000a.xml.gz')
+        report = downloads_db.verify_archive_checksums(
+            self.test_db, rehash=True, processes=2)
+        self.assertListEqual(report.verified, ['medline14n000c'])
+        self.assertListEqual(report.mismatched, ['medline14n000b'])
+        self.assertListEqual(report.missing, ['medline14n000a'])
+        self.assertDictEqual(verification_states(), {
+            'medline14n000a': 1, 'medline14n000b': -1, 'medline14n000c': 1})
+
+    def test_new_md5_file_resets_verification(self):
+        """Test that recording a new .md5 file rechecks its archive"""
+        data = os.urandom(2000)
+        downloads = []
+        for filename, contents in (
+                ('medline14n0001.xml.gz', data),
+                ('medline14n0001.xml.gz.md5', b'MD5(x)= ' + b'0' * 32),
+                ('medline14n0001.xml.gz.md5', 'MD5(x)= {}\n'.format(
+                    hashlib.md5(data).hexdigest()).encode())):
+            with open(filename, 'wb') as downloaded:
+                downloaded.write(contents)
+            downloads.append(downloader.FTPFileParams(
+                '20140101000000', str(len(contents)),
+                'unique%d' % len(downloads), filename, '20140101000000',
+                hashlib.md5(contents).hexdigest(), os.path.abspath(filename)))
+            downloads_db.record_downloads(downloads[-1:], self.test_db)
+            report = downloads_db.verify_archive_checksums(self.test_db)
+        self.assertListEqual(report.verified, ['medline14n0001'])
+
+    def test_download_recorder_batches_commits(self):
+        """Test that downloads are committed in batches of batch_size"""
+        db_file = os.path.join(self.temp_dir, 'downloads.db')
+        db_con = downloads_db.initialize_database_connection(db_file)
+        self.addCleanup(db_con.close)
+        self.assertEqual(
+            db_con.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        reader = downloads_db.initialize_database_connection(db_file)
+        self.addCleanup(reader.close)
+
+        def committed_ids():
+            return downloads_db.get_downloaded_file_unique_ids(reader)
+
+        records = self.generate_ftp_file_params()
+        with downloads_db.DownloadRecorder(db_con, batch_size=2) as recorder:
+            recorder.add(records[0])
+            self.assertSetEqual(committed_ids(), set())
+            recorder.add(records[1])
+            self.assertSetEqual(
+                committed_ids(), {'4600001UE9FE', '4600001UE9FF'})
+            recorder.add(records[3])
+        self.assertSetEqual(
+            committed_ids(),
+            {'4600001UE9FE', '4600001UE9FF', '4400001UEA02'})
+
+
+    def test_listing_snapshot(self):
+        """Test that only changed entries are returned and that reissued
+        files are detected by name
+        """
+        db_con = downloads_db.initialize_database_connection(':memory:')
+
+        def entry(name, unique, modify='20140101000000', size='100'):
+            return downloader.FTPFileParams(
+                modify, size, unique, name, '', '', '')
+
+        listing = [entry('medline14n0001.xml.gz', 'u1'),
+                   entry('medline14n0002.xml.gz', 'u2'),
+                   entry('medline14n0003.xml.gz', 'u3')]
+        self.assertListEqual(
+            downloads_db.get_listing_changes('/gz', listing, db_con),
+            [(f, False) for f in listing])
+        downloads_db.save_listing_snapshot(
+            '/gz', listing, db_con, 'digest1',
+            pending=['medline14n0003.xml.gz'])
+        # Pending files leave the snapshot incomplete
+        self.assertIsNone(downloads_db.get_listing_digest('/gz', db_con))
+        self.assertListEqual(
+            downloads_db.get_listing_changes('/gz', listing, db_con),
+            [(listing[2], False)])
+
+        downloads_db.save_listing_snapshot('/gz', listing, db_con, 'digest1')
+        self.assertEqual(
+            downloads_db.get_listing_digest('/gz', db_con), 'digest1')
+        self.assertIsNone(downloads_db.get_listing_digest('/other', db_con))
+        new_listing = [
+            entry('medline14n0001.xml.gz', 'u1'),
+            entry('medline14n0002.xml.gz', 'u2', size='120'),
+            entry('medline14n0004.xml.gz', 'u4')]
+        self.assertListEqual(
+            downloads_db.get_listing_changes('/gz', new_listing, db_con),
+            [(new_listing[1], True), (new_listing[2], False)])
+
+        # Removed entries are dropped from the snapshot
+        downloads_db.save_listing_snapshot('/gz', new_listing, db_con)
+        self.assertListEqual(
+            [row[0] for row in db_con.execute(
+                'SELECT filename FROM listing_entries ORDER BY filename')],
+            [f.filename for f in new_listing])
+
 
 class TestNLMDownloader(unittest.TestCase):
     """
@@ -230,3 +498,1381 @@ class TestNLMDownloader(unittest.TestCase):
                                           self.PARSED_TEST_LINES):
             self.assertTupleEqual(
                 downloader.parse_mlsd(test_line), parsed_line)
+
+    def test_parse_mlsd_fallback(self):
+        """Test lines the fast path can't handle: reordered facts and
+        directories without a size fact
+        """
+        self.assertTupleEqual(
+            downloader.parse_mlsd(
+                'unique=4600001UE9FE;type=file;size=24847843;'
+                'modify=20131125174213; medline14n0745.xml.gz\r\n'),
+            self.PARSED_TEST_LINES[0])
+        self.assertIsNone(downloader.parse_mlsd(
+            'modify=20131125174213;perm=flcdmpe;type=dir;unique=46U2; old'))
+        self.assertIsNone(downloader.parse_mlsd(
+            'modify=20131125174213;perm=adfr;size=4096;type=cdir;'
+            'unique=46U2; .'))
+
+    def test_get_file_listing_rejects_string_patterns(self):
+        """A bare string would be compiled one character at a time"""
+        with self.assertRaises(TypeError):
+            list(downloader.get_file_listing(
+                self.TEST_FTP_LINES, '/nlmdata/.medleasebaseline/gz/'))
+
+    def test_hashing_writer(self):
+        """Test that blocks are written and hashed in a single pass"""
+        blocks = [os.urandom(100) for _ in range(5)]
+        hasher = hashlib.md5()
+        with tempfile.TemporaryFile() as output_file:
+            write = downloader.hashing_writer(output_file, hasher)
+            for block in blocks:
+                write(block)
+            output_file.seek(0)
+            self.assertEqual(output_file.read(), b''.join(blocks))
+        self.assertEqual(
+            hasher.hexdigest(), hashlib.md5(b''.join(blocks)).hexdigest())
+
+    def test_download_file_leaves_staged_export_intact(self):
+        """Test that downloading a file again doesn't overwrite a copy
+        hard-linked into the export directory
+        """
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        local_path = os.path.join(temp_dir, 'medline14n0001.xml.gz.md5')
+        export_path = os.path.join(temp_dir, 'exported.md5')
+        with open(local_path, 'wb') as local_copy:
+            local_copy.write(b'AAAA')
+        os.link(local_path, export_path)
+
+        connection = FakeFTPConnection({'medline14n0001.xml.gz.md5': b'BBBB'})
+        downloader.download_file(
+            connection,
+            downloader.FTPFileParams(
+                '', '4', 'u2', 'medline14n0001.xml.gz.md5', '', '', ''),
+            temp_dir)
+
+        with open(local_path, 'rb') as local_copy:
+            self.assertEqual(local_copy.read(), b'BBBB')
+        with open(export_path, 'rb') as exported:
+            self.assertEqual(exported.read(), b'AAAA')
+
+    def test_download_file_resumes_partial_download(self):
+        """Test that a partial local file is completed with a REST offset"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        data = os.urandom(10000)
+        with open(os.path.join(temp_dir, 'medline14n0001.xml.gz'), 'wb') \
+                as partial_file:
+            partial_file.write(data[:3000])
+
+        connection = FakeFTPConnection({'medline14n0001.xml.gz': data})
+        rest_offsets = []
+        retrbinary = connection.retrbinary
+
+        def recording_retrbinary(cmd, callback, blocksize=8192, rest=None):
+            rest_offsets.append(rest)
+            retrbinary(cmd, callback, blocksize, rest)
+        connection.retrbinary = recording_retrbinary
+
+        metrics = run_metrics.RunMetrics()
+        file_info = downloader.download_file(
+            connection,
+            downloader.FTPFileParams(
+                '', str(len(data)), 'u1', 'medline14n0001.xml.gz',
+                '', '', ''),
+            temp_dir, metrics)
+
+        self.assertEqual(rest_offsets, [3000])
+        self.assertEqual(metrics.file('medline14n0001.xml.gz').retries, 1)
+        self.assertEqual(file_info.observed_md5, hashlib.md5(data).hexdigest())
+        with open(file_info.output_path, 'rb') as local_file:
+            self.assertEqual(local_file.read(), data)
+
+    def test_download_file_incomplete(self):
+        """Test that a short transfer is not reported as complete"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        connection = FakeFTPConnection({'medline14n0001.xml.gz': b'short'})
+        with self.assertRaises(downloader.IncompleteDownloadError):
+            downloader.download_file(
+                connection,
+                downloader.FTPFileParams(
+                    '', '100', 'u1', 'medline14n0001.xml.gz', '', '', ''),
+                temp_dir)
+
+    def test_export_file(self):
+        """Test staging by hard link and by in-kernel copy"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        export_dir = os.path.join(temp_dir, 'exports')
+        os.mkdir(export_dir)
+        data = os.urandom(300000)
+        local_path = os.path.join(temp_dir, 'medline14n0001.xml.gz')
+        with open(local_path, 'wb') as local_file:
+            local_file.write(data)
+        file_info = downloader.FTPFileParams(
+            '', str(len(data)), 'u1', 'medline14n0001.xml.gz', '', '',
+            local_path)
+
+        linked = downloader.export_file(file_info, export_dir)
+        self.assertTrue(os.path.samefile(linked, local_path))
+
+        copied = downloader.export_file(
+            file_info, export_dir, allow_link=False)
+        self.assertEqual(linked, copied)
+        self.assertFalse(os.path.samefile(copied, local_path))
+        with open(copied, 'rb') as exported:
+            self.assertEqual(exported.read(), data)
+        self.assertListEqual(
+            os.listdir(export_dir), ['medline14n0001.xml.gz'])
+
+    def test_run_in_background(self):
+        """Test ordering, backpressure and error propagation"""
+        produced = []
+
+        def producer():
+            for i in range(10):
+                produced.append(i)
+                yield i
+
+        consumed = []
+        for item in downloader.run_in_background(producer(), queue_size=2):
+            consumed.append(item)
+            if item == 0:
+                time.sleep(0.1)
+                # The producer can't get further than the queue allows
+                self.assertLessEqual(len(produced), 4)
+        self.assertListEqual(consumed, list(range(10)))
+
+        def failing_producer():
+            yield 1
+            raise ValueError('download failed')
+
+        with self.assertRaises(ValueError):
+            list(downloader.run_in_background(failing_producer()))
+
+    def test_download_files_in_parallel(self):
+        """Test that a pool of connections downloads every file once"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        server_files = {
+            'medline14n%04d.xml.gz' % i: os.urandom(1000 + i)
+            for i in range(20)}
+        to_download = [
+            downloader.FTPFileParams(
+                '', str(len(data)), name, name, '', '', '')
+            for name, data in server_files.items()]
+        connections = []
+
+        def connection_factory():
+            connections.append(FakeFTPConnection(server_files))
+            return connections[-1]
+
+        downloaded = list(downloader.download_files_in_parallel(
+            to_download, 'server', temp_dir, connection_factory, workers=4))
+
+        self.assertEqual(
+            sorted(f.filename for f in downloaded), sorted(server_files))
+        for file_info in downloaded:
+            self.assertEqual(
+                file_info.observed_md5,
+                hashlib.md5(server_files[file_info.filename]).hexdigest())
+            with open(file_info.output_path, 'rb') as local_file:
+                self.assertEqual(
+                    local_file.read(), server_files[file_info.filename])
+        self.assertTrue(1 <= len(connections) <= 4)
+        self.assertTrue(all(c.closed for c in connections))
+        self.assertTrue(all(c.cwd_calls == ['server'] for c in connections))
+
+    def test_download_files_in_parallel_stops_with_consumer(self):
+        """Test that queued downloads are cancelled if the consumer stops"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        server_files = {
+            'medline14n%04d.xml.gz' % i: os.urandom(1000 + i)
+            for i in range(20)}
+        to_download = [
+            downloader.FTPFileParams(
+                '', str(len(data)), name, name, '', '', '')
+            for name, data in server_files.items()]
+
+        class SlowFTPConnection(FakeFTPConnection):
+            def retrbinary(self, *args, **kwargs):
+                time.sleep(0.05)
+                super().retrbinary(*args, **kwargs)
+
+        with self.assertRaises(ValueError):
+            for _ in downloader.run_in_background(
+                    downloader.download_files_in_parallel(
+                        to_download, 'server', temp_dir,
+                        lambda: SlowFTPConnection(server_files), workers=2),
+                    queue_size=1):
+                raise ValueError('export failed')
+        self.assertLess(len(os.listdir(temp_dir)), 10)
+
+
+@unittest.skipIf(FTPServer is None, 'pyftpdlib is required')
+class TestAsyncDownloader(unittest.TestCase):
+    """Test the asyncio download backend against a local FTP server"""
+
+    def setUp(self):
+        self.server_root = tempfile.mkdtemp()
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.server_root)
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        os.mkdir(os.path.join(self.server_root, 'gz'))
+        self.server_files = {}
+        for i in range(12):
+            name = 'medline14n%04d.xml.gz' % i
+            self.server_files[name] = os.urandom(50000 + i)
+            self.server_files[name + '.md5'] = (
+                'MD5(%s)= %s\n' % (
+                    name, hashlib.md5(self.server_files[name]).hexdigest())
+                ).encode()
+        self.server_files['gz.stats.html'] = b'<html></html>'
+        for name, data in self.server_files.items():
+            with open(os.path.join(self.server_root, 'gz', name), 'wb') as f:
+                f.write(data)
+        self.db_con = downloads_db.initialize_database_connection(':memory:')
+
+    def test_retrieve_nlm_files(self):
+        with LocalFTPServer(self.server_root) as server:
+            retrieved = async_download.retrieve_nlm_files(
+                server.params, '/gz', self.output_dir, self.db_con,
+                concurrency=4, port=server.port)
+            # Everything is recorded, so a second run finds nothing new
+            self.assertListEqual(
+                async_download.retrieve_nlm_files(
+                    server.params, '/gz', self.output_dir, self.db_con,
+                    concurrency=4, port=server.port),
+                [])
+
+        expected = set(self.server_files) - {'gz.stats.html'}
+        self.assertSetEqual({f.filename for f in retrieved}, expected)
+        for file_info in retrieved:
+            data = self.server_files[file_info.filename]
+            self.assertEqual(
+                file_info.observed_md5, hashlib.md5(data).hexdigest())
+            with open(file_info.output_path, 'rb') as local_file:
+                self.assertEqual(local_file.read(), data)
+
+    def test_refused_transfer_closes_data_connection(self):
+        async def transfer(params, port):
+            client = await async_download.AsyncFTP.connect(
+                params.host, port, params.user, params.password)
+            try:
+                with self.assertRaises(ftplib.error_perm):
+                    await client.open_transfer('RETR /gz/missing.xml.gz')
+                self.assertIsNone(client._data_writer)
+                # The client is still usable
+                data = await client.open_transfer('RETR /gz/gz.stats.html')
+                contents = await data.read()
+                await client.finish_transfer()
+                return contents
+            finally:
+                await client.quit()
+
+        with LocalFTPServer(self.server_root) as server:
+            self.assertEqual(
+                asyncio.run(transfer(server.params, server.port)),
+                self.server_files['gz.stats.html'])
+
+    def test_threaded_pipeline_exports_each_file(self):
+        """Test that the threaded backend records, verifies and exports
+        files as they arrive
+        """
+        export_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, export_dir)
+        with LocalFTPServer(self.server_root) as server:
+            connection = server.connect()
+            retrieved = downloader.retrieve_nlm_files(
+                connection, '/gz', self.output_dir, self.db_con,
+                workers=3, connection_factory=server.connect,
+                export_dir=export_dir, queue_size=2)
+            connection.quit()
+
+        self.assertEqual(len(retrieved), 24)
+        self.assertSetEqual(
+            set(os.listdir(export_dir)),
+            set(self.server_files) - {'gz.stats.html'})
+        # Exports are hard links to the local copies
+        for name in os.listdir(export_dir):
+            self.assertTrue(os.path.samefile(
+                os.path.join(export_dir, name),
+                os.path.join(self.output_dir, name)))
+        self.assertSetEqual(
+            {tuple(row) for row in self.db_con.execute(
+                'SELECT md5_verified, transferred_for_output,'
+                ' export_location = ? || filename'
+                ' FROM nlm_archives', (export_dir + os.sep,))},
+            {(1, 1, 1)})
+
+    def test_checksum_mismatch_withdraws_export(self):
+        """Test that an archive failing its md5 is taken out of the export
+        directory and reported
+        """
+        export_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, export_dir)
+        bad = 'medline14n0004.xml.gz'
+        with open(os.path.join(self.server_root, 'gz', bad + '.md5'),
+                  'w') as md5_file:
+            md5_file.write('MD5(%s)= %s\n' % (bad, '0' * 32))
+        with LocalFTPServer(self.server_root) as server:
+            connection = server.connect()
+            retrieved = downloader.retrieve_nlm_files(
+                connection, '/gz', self.output_dir, self.db_con,
+                export_dir=export_dir, order='archives_first')
+            connection.quit()
+
+        self.assertNotIn(bad, os.listdir(export_dir))
+        self.assertIn('medline14n0005.xml.gz', os.listdir(export_dir))
+        self.assertEqual(
+            tuple(self.db_con.execute(
+                'SELECT md5_verified, transferred_for_output, export_location'
+                ' FROM nlm_archives WHERE filename = ?', (bad,)).fetchone()),
+            (-1, 0, ''))
+
+        notifications = []
+
+        class RecordingNotifier(object):
+            def notify(self, subject, body):
+                notifications.append(body)
+
+        args = argparse.Namespace(
+            audit_md5=False, index_pmids=False, index_offsets=False)
+        downloader.report_update(
+            args, self.db_con,
+            [directory_sync.SyncTarget('/gz', self.output_dir, export_dir)],
+            retrieved, RecordingNotifier())
+        failing = notifications[0].split(
+            'failing md5 verification:')[1].split('Archives missing')[0]
+        self.assertListEqual(failing.split(), ['medline14n0004'])
+
+    def test_reissued_archive_verified_against_new_md5(self):
+        """Test that a reissued archive downloaded before its new .md5 file
+        isn't failed against the stale checksum
+        """
+        export_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, export_dir)
+        name = 'medline14n0003.xml.gz'
+        gz_dir = os.path.join(self.server_root, 'gz')
+        with LocalFTPServer(self.server_root) as server:
+            connection = server.connect()
+            downloader.retrieve_nlm_files(
+                connection, '/gz', self.output_dir, self.db_con,
+                export_dir=export_dir)
+
+            data = os.urandom(60000)
+            reissued = {
+                name: data,
+                name + '.md5': ('MD5(%s)= %s\n' % (
+                    name, hashlib.md5(data).hexdigest())).encode()}
+            published = time.time() + 3600
+            for filename, contents in reissued.items():
+                staged = os.path.join(self.server_root, filename)
+                with open(staged, 'wb') as f:
+                    f.write(contents)
+                os.utime(staged, (published, published))
+            for filename in reissued:
+                os.replace(os.path.join(self.server_root, filename),
+                           os.path.join(gz_dir, filename))
+            downloader.retrieve_nlm_files(
+                connection, '/gz', self.output_dir, self.db_con,
+                export_dir=export_dir, order='archives_first')
+            connection.quit()
+
+        self.assertEqual(
+            self.db_con.execute(
+                'SELECT md5_verified FROM nlm_archives WHERE filename = ?',
+                (name,)).fetchone()[0], 1)
+        with open(os.path.join(export_dir, name), 'rb') as exported:
+            self.assertEqual(exported.read(), data)
+
+    def test_retrieve_nlm_files_resumes(self):
+        name = 'medline14n0003.xml.gz'
+        with open(os.path.join(self.output_dir, name), 'wb') as partial:
+            partial.write(self.server_files[name][:1234])
+        with LocalFTPServer(self.server_root) as server:
+            retrieved = async_download.retrieve_nlm_files(
+                server.params, '/gz', self.output_dir, self.db_con,
+                concurrency=2, port=server.port)
+        file_info = [f for f in retrieved if f.filename == name][0]
+        self.assertEqual(
+            file_info.observed_md5,
+            hashlib.md5(self.server_files[name]).hexdigest())
+
+    def test_listing_snapshot_short_circuits(self):
+        """Test that unchanged listings are skipped and reissued files are
+        downloaded again
+        """
+        with LocalFTPServer(self.server_root) as server:
+            connection = server.connect()
+            first = downloader.retrieve_nlm_files(
+                connection, '/gz', self.output_dir, self.db_con)
+            self.assertEqual(len(first), 24)
+            self.assertListEqual(
+                downloader.retrieve_nlm_files(
+                    connection, '/gz', self.output_dir, self.db_con), [])
+
+            name = 'medline14n0003.xml.gz'
+            reissued_data = os.urandom(70000)
+            with open(os.path.join(self.server_root, 'gz', name),
+                      'wb') as f:
+                f.write(reissued_data)
+            reissued = downloader.retrieve_nlm_files(
+                connection, '/gz', self.output_dir, self.db_con)
+            connection.quit()
+
+        self.assertListEqual([f.filename for f in reissued], [name])
+        with open(reissued[0].output_path, 'rb') as local_file:
+            self.assertEqual(local_file.read(), reissued_data)
+        self.assertListEqual(
+            [tuple(row) for row in self.db_con.execute(
+                'SELECT size, observed_md5 FROM nlm_archives'
+                ' WHERE filename = ?', (name,))],
+            [(70000, hashlib.md5(reissued_data).hexdigest())])
+
+    def test_republished_archives_are_reused(self):
+        """Test that archives NLM re-publishes unchanged are staged from
+        the local copies rather than downloaded again
+        """
+        gz_dir = os.path.join(self.server_root, 'gz')
+        restamped = 'medline14n0005.xml.gz'
+        moved, new_name = 'medline14n0003.xml.gz', 'medline14n0103.xml.gz'
+        republished = {
+            restamped: self.server_files[restamped],
+            new_name: self.server_files[moved],
+            new_name + '.md5': self.server_files[moved + '.md5']}
+        with LocalFTPServer(self.server_root) as server:
+            connection = server.connect()
+            downloader.retrieve_nlm_files(
+                connection, '/gz', self.output_dir, self.db_con)
+
+            # Every file is written before any is replaced, so each gets
+            # a new inode and therefore a new unique fact
+            for name, data in republished.items():
+                with open(os.path.join(self.server_root, name), 'wb') as f:
+                    f.write(data)
+            for name in republished:
+                os.replace(os.path.join(self.server_root, name),
+                           os.path.join(gz_dir, name))
+            for name in (moved, moved + '.md5'):
+                os.remove(os.path.join(gz_dir, name))
+            metrics = run_metrics.RunMetrics()
+            retrieved = downloader.retrieve_nlm_files(
+                connection, '/gz', self.output_dir, self.db_con,
+                metrics=metrics)
+            connection.quit()
+
+        self.assertSetEqual(
+            {f.filename for f in retrieved},
+            {restamped, new_name, new_name + '.md5'})
+        for name in (restamped, new_name):
+            self.assertNotIn('download', metrics.file(name).stage_seconds)
+            self.assertIn('reuse', metrics.file(name).stage_seconds)
+        prometheus_file = os.path.join(self.output_dir, 'nlm.prom')
+        run_metrics.write_prometheus_textfile(
+            prometheus_file, metrics.totals())
+        with open(prometheus_file) as textfile:
+            self.assertIn(
+                'nlm_download_last_run_stage_seconds{stage="reuse"} %s'
+                % metrics.totals()['stage_seconds']['reuse'],
+                textfile.read().splitlines())
+        self.assertTrue(os.path.samefile(
+            os.path.join(self.output_dir, new_name),
+            os.path.join(self.output_dir, moved)))
+        with open(os.path.join(self.output_dir, restamped), 'rb') as f:
+            self.assertEqual(f.read(), self.server_files[restamped])
+        self.assertListEqual(
+            [tuple(row) for row in self.db_con.execute(
+                'SELECT filename, md5_verified FROM nlm_archives'
+                ' WHERE filename IN (?, ?) ORDER BY filename',
+                (restamped, new_name))],
+            [(restamped, 1), (new_name, 1)])
+
+    def test_run_metrics(self):
+        """Test that per-file timings and run totals are written"""
+        export_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, export_dir)
+        metrics_log = os.path.join(self.output_dir, 'metrics.jsonl')
+        prometheus_file = os.path.join(self.output_dir, 'nlm.prom')
+        metrics = run_metrics.RunMetrics(
+            metrics_log, prometheus_file, labels={'server_dir': '/gz'})
+        with LocalFTPServer(self.server_root) as server:
+            async_download.retrieve_nlm_files(
+                server.params, '/gz', self.output_dir, self.db_con,
+                concurrency=4, port=server.port, export_dir=export_dir,
+                metrics=metrics)
+        totals = metrics.finish()
+
+        with open(metrics_log) as log:
+            records = [json.loads(line) for line in log]
+        file_records = [r for r in records if r['event'] == 'file']
+        self.assertEqual(len(file_records), 24)
+        for record in file_records:
+            self.assertEqual(
+                record['bytes'], len(self.server_files[record['filename']]))
+            self.assertSetEqual(
+                set(record['stage_seconds']),
+                set(run_metrics.STAGES) - {'reuse'})
+        self.assertEqual(records[-1]['event'], 'run')
+        self.assertEqual(records[-1]['bytes'], totals['bytes'])
+        self.assertEqual(
+            totals['bytes'], sum(len(self.server_files[r['filename']])
+                                 for r in file_records))
+
+        with open(prometheus_file) as textfile:
+            prometheus_lines = textfile.read().splitlines()
+        self.assertIn(
+            'nlm_download_last_run_files{server_dir="/gz"} 24',
+            prometheus_lines)
+        self.assertIn(
+            'nlm_download_last_run_success{server_dir="/gz"} 1',
+            prometheus_lines)
+
+
+class TestPlanner(unittest.TestCase):
+    """Test dry-run download plans against a local FTP server"""
+
+    def setUp(self):
+        self.server_root = tempfile.mkdtemp()
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.server_root)
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        os.mkdir(os.path.join(self.server_root, 'gz'))
+        self.server_files = {
+            'medline14n%04d.xml.gz' % i: os.urandom(10000 + i)
+            for i in range(5)}
+        for name, data in self.server_files.items():
+            with open(os.path.join(self.server_root, 'gz', name), 'wb') as f:
+                f.write(data)
+        self.db_con = downloads_db.initialize_database_connection(':memory:')
+        self.target = directory_sync.SyncTarget(
+            '/gz', self.output_dir, os.path.join(self.output_dir, 'export'))
+
+    def test_plan_downloads(self):
+        partial_name = 'medline14n0002.xml.gz'
+        with open(os.path.join(self.output_dir, partial_name), 'wb') as f:
+            f.write(self.server_files[partial_name][:4000])
+        total_bytes = sum(len(data) for data in self.server_files.values())
+
+        with LocalFTPServer(self.server_root) as server:
+            connection = server.connect()
+            plan = planner.plan_downloads(connection, [self.target],
+                                          self.db_con)
+            self.assertListEqual(
+                sorted(f.filename for f in plan.directories[0].files),
+                sorted(self.server_files))
+            self.assertEqual(plan.total_bytes, total_bytes)
+            self.assertEqual(plan.transfer_bytes, total_bytes - 4000)
+            self.assertIsNone(plan.eta_seconds)
+            # The export directory doesn't exist yet, but its parent is
+            # on the output directory's filesystem, so exports are links
+            self.assertListEqual(
+                [(d.path, d.required) for d in plan.disks],
+                [(self.output_dir, total_bytes - 4000)])
+            self.assertIn('Total: 5 files', planner.format_plan(plan))
+            self.assertEqual(
+                json.loads(json.dumps(planner.plan_as_dict(plan)))['files'],
+                5)
+
+            limited = planner.plan_downloads(
+                connection, [self.target], self.db_con, limit=2,
+                order='smallest_first')
+            self.assertListEqual(
+                [f.filename for f in limited.directories[0].files],
+                ['medline14n0000.xml.gz', 'medline14n0001.xml.gz'])
+
+            # Planning changed nothing, so a real run downloads every
+            # file and records its throughput
+            metrics = run_metrics.RunMetrics(
+                on_finish=downloader.run_recorder(self.db_con, '/gz'))
+            retrieved = downloader.retrieve_nlm_files(
+                connection, '/gz', self.output_dir, self.db_con,
+                metrics=metrics)
+            metrics.finish()
+            self.assertEqual(len(retrieved), 5)
+            bytes_per_second = downloads_db.get_download_throughput(
+                self.db_con)
+            self.assertGreater(bytes_per_second, 0)
+
+            with open(os.path.join(self.server_root, 'gz',
+                                   'medline14n0005.xml.gz'), 'wb') as f:
+                f.write(os.urandom(5000))
+            plan = planner.plan_downloads(connection, [self.target],
+                                          self.db_con)
+            connection.quit()
+        self.assertListEqual(
+            [f.filename for f in plan.directories[0].files],
+            ['medline14n0005.xml.gz'])
+        self.assertEqual(plan.eta_seconds, 5000 / bytes_per_second)
+
+
+class TestDaemon(unittest.TestCase):
+    """Test polling the server over a persistent connection"""
+
+    def setUp(self):
+        self.server_root = tempfile.mkdtemp()
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.server_root)
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        self.server_dir = os.path.join(self.server_root, 'updatefiles')
+        os.mkdir(self.server_dir)
+        self.add_server_file('medline14n0001.xml.gz')
+        self.db_con = downloads_db.initialize_database_connection(':memory:')
+
+    def add_server_file(self, name):
+        with open(os.path.join(self.server_dir, name), 'wb') as f:
+            f.write(os.urandom(1000))
+
+    def test_keepalive_reconnects(self):
+        with LocalFTPServer(self.server_root) as server:
+            now = [0.0]
+            keeper = daemon.KeepaliveConnection(
+                server.connect, keepalive_interval=10, clock=lambda: now[0])
+            first = keeper.get()
+            self.assertIs(keeper.get(), first)
+            # A dropped connection is replaced once it has been idle
+            first.sock.shutdown(socket.SHUT_RDWR)
+            now[0] = 20.0
+            second = keeper.get()
+            self.assertIsNot(second, first)
+            self.assertEqual(second.voidcmd('NOOP')[:3], '200')
+            keeper.close()
+
+    def test_run_daemon(self):
+        """Test that only changed listings trigger downloads and that the
+        poll interval backs off while nothing changes
+        """
+        updates = []
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(updates) == 1 and len(sleeps) == 3:
+                self.add_server_file('medline14n0002.xml.gz')
+
+        with LocalFTPServer(self.server_root) as server:
+            daemon.run_daemon(
+                server.connect, '/updatefiles', self.output_dir,
+                self.db_con, min_interval=10, max_interval=30,
+                keepalive_interval=100, sleep=sleep,
+                should_stop=lambda: len(sleeps) >= 5,
+                on_update=updates.append)
+
+        self.assertListEqual(
+            [[f.filename for f in update] for update in updates],
+            [['medline14n0001.xml.gz'], ['medline14n0002.xml.gz']])
+        self.assertListEqual(sleeps, [10, 20, 30, 10, 20])
+
+    def test_run_daemon_skips_polls_without_downloads(self):
+        """Test that a changed listing with nothing new to download is
+        not reported and keeps backing off
+        """
+        updates = []
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 1:
+                os.mkdir(os.path.join(self.server_dir, 'archive'))
+
+        with LocalFTPServer(self.server_root) as server:
+            daemon.run_daemon(
+                server.connect, '/updatefiles', self.output_dir,
+                self.db_con, min_interval=10, max_interval=80,
+                keepalive_interval=100, sleep=sleep,
+                should_stop=lambda: len(sleeps) >= 3,
+                on_update=updates.append)
+
+        self.assertListEqual(
+            [[f.filename for f in update] for update in updates],
+            [['medline14n0001.xml.gz']])
+        self.assertListEqual(sleeps, [10, 20, 40])
+
+    def test_run_daemon_retries_failed_polls(self):
+        """Test that a failed poll is retried over a new connection and
+        counted as a retry
+        """
+        errors = []
+        updates = []
+        polls = []
+
+        with LocalFTPServer(self.server_root) as server:
+            def connection_factory():
+                if not errors:
+                    raise EOFError('connection refused')
+                return server.connect()
+
+            def metrics_factory():
+                polls.append(run_metrics.RunMetrics())
+                return polls[-1]
+
+            daemon.run_daemon(
+                connection_factory, '/updatefiles', self.output_dir,
+                self.db_con, min_interval=10, sleep=lambda seconds: None,
+                should_stop=lambda: bool(updates), on_update=updates.append,
+                on_error=errors.append, metrics_factory=metrics_factory)
+
+        self.assertEqual(len(errors), 1)
+        self.assertListEqual(
+            [[f.filename for f in update] for update in updates],
+            [['medline14n0001.xml.gz']])
+        self.assertListEqual(
+            [metrics.totals()['retries'] for metrics in polls], [0, 1])
+
+    def test_run_daemon_backs_off_after_errors(self):
+        """Test that repeated failures are retried less and less often"""
+        errors = []
+        updates = []
+        sleeps = []
+
+        with LocalFTPServer(self.server_root) as server:
+            def connection_factory():
+                if len(errors) < 3:
+                    raise EOFError('connection refused')
+                return server.connect()
+
+            daemon.run_daemon(
+                connection_factory, '/updatefiles', self.output_dir,
+                self.db_con, min_interval=10, max_interval=30,
+                sleep=sleeps.append, should_stop=lambda: len(sleeps) >= 4,
+                on_update=updates.append, on_error=errors.append)
+
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(len(updates), 1)
+        self.assertListEqual(sleeps, [10, 20, 30, 10])
+
+
+class TestDirectorySync(unittest.TestCase):
+    """Test syncing several server directories over one connection pool"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.server_root = os.path.join(self.temp_dir, 'server')
+        self.server_files = {}
+        for server_dir, first in (('baseline', 1), ('updatefiles', 747)):
+            os.makedirs(os.path.join(self.server_root, server_dir))
+            os.makedirs(os.path.join(self.temp_dir, server_dir, 'out'))
+            os.makedirs(os.path.join(self.temp_dir, server_dir, 'export'))
+            for i in range(first, first + 5):
+                name = 'medline14n%04d.xml.gz' % i
+                data = os.urandom(2000 + i)
+                self.server_files[name] = (server_dir, data)
+                with open(os.path.join(
+                        self.server_root, server_dir, name), 'wb') as f:
+                    f.write(data)
+        self.targets = [
+            directory_sync.parse_sync_target(
+                '/%s:%s:%s' % (
+                    server_dir, os.path.join(self.temp_dir, server_dir, 'out'),
+                    os.path.join(self.temp_dir, server_dir, 'export')),
+                None, None)
+            for server_dir in ('baseline', 'updatefiles')]
+        self.db_con = downloads_db.initialize_database_connection(':memory:')
+
+    def test_parse_sync_target(self):
+        self.assertEqual(
+            directory_sync.parse_sync_target('/gz', 'out', 'export'),
+            directory_sync.SyncTarget('/gz', 'out', 'export'))
+        self.assertEqual(
+            directory_sync.parse_sync_target('/gz::other', 'out', 'export'),
+            directory_sync.SyncTarget('/gz', 'out', 'other'))
+        with self.assertRaises(ValueError):
+            directory_sync.parse_sync_target(':out', 'out', 'export')
+
+    def test_retrieve_directories(self):
+        with LocalFTPServer(self.server_root) as server:
+            connections = []
+
+            def connect():
+                connections.append(server.connect())
+                return connections[-1]
+
+            retrieved = directory_sync.retrieve_directories(
+                self.targets, self.db_con, connect, workers=3)
+            self.assertLessEqual(len(connections), 3)
+            self.assertDictEqual(
+                directory_sync.retrieve_directories(
+                    self.targets, self.db_con, connect, workers=3),
+                {'/baseline': [], '/updatefiles': []})
+
+        for server_dir, files in retrieved.items():
+            self.assertEqual(len(files), 5)
+            for file_info in files:
+                expected_dir, data = self.server_files[file_info.filename]
+                self.assertEqual('/' + expected_dir, server_dir)
+                with open(file_info.output_path, 'rb') as local_file:
+                    self.assertEqual(local_file.read(), data)
+                self.assertTrue(os.path.exists(os.path.join(
+                    self.temp_dir, expected_dir, 'export',
+                    file_info.filename)))
+        self.assertEqual(
+            self.db_con.execute(
+                'SELECT COUNT(*) FROM nlm_archives').fetchone()[0], 10)
+
+    def test_download_jobs_yields_in_flight_files_before_failing(self):
+        target = self.targets[0]
+        jobs = [
+            (target, downloader.FTPFileParams(
+                '', '100', 'missing', 'medline14n0099.xml.gz', '', '', '')),
+            (target, downloader.FTPFileParams(
+                '', '2001', 'u1', 'medline14n0001.xml.gz', '', '', ''))]
+        downloaded = []
+        with LocalFTPServer(self.server_root) as server, \
+                directory_sync.ConnectionPool(server.connect, 2) as pool:
+            # Throttled so the missing file fails while the other is
+            # still in flight
+            bucket = scheduler.TokenBucket(10000, capacity=100)
+            with self.assertRaises(ftplib.error_perm):
+                for _, file_info in directory_sync.download_jobs(
+                        pool, jobs, bucket=bucket):
+                    downloaded.append(file_info.filename)
+        self.assertListEqual(downloaded, ['medline14n0001.xml.gz'])
+
+
+class TestScheduler(unittest.TestCase):
+    """Test ordering, limiting and throttling of pending downloads"""
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+
+    def make_listing(self):
+        files = []
+        for name, modify, size in (
+                ('medline14n0001.xml.gz.md5', '20140101000000', 60),
+                ('medline14n0001.xml.gz', '20140101000000', 900),
+                ('medline14n0002.notes.txt', '20140301000000', 10),
+                ('medline14n0002.xml.gz', '20140301000000', 500),
+                ('medline14n0003.xml.gz', '20140201000000', 100)):
+            files.append(downloader.FTPFileParams(
+                modify, str(size), name, name, '', '', ''))
+        return files
+
+    def ordered_names(self, policy):
+        return [f.filename for f in scheduler.order_downloads(
+            self.make_listing(), policy)]
+
+    def test_order_downloads(self):
+        self.assertListEqual(
+            self.ordered_names('listing'),
+            [f.filename for f in self.make_listing()])
+        self.assertListEqual(
+            self.ordered_names('archives_first'),
+            ['medline14n0001.xml.gz', 'medline14n0001.xml.gz.md5',
+             'medline14n0002.xml.gz', 'medline14n0002.notes.txt',
+             'medline14n0003.xml.gz'])
+        self.assertListEqual(
+            self.ordered_names('newest_first'),
+            ['medline14n0002.xml.gz', 'medline14n0002.notes.txt',
+             'medline14n0003.xml.gz', 'medline14n0001.xml.gz',
+             'medline14n0001.xml.gz.md5'])
+        # Fractional seconds (RFC 3659) are allowed in modify facts
+        listing = self.make_listing()
+        listing[4] = listing[4]._replace(
+            modification_date='20140301000000.5')
+        self.assertListEqual(
+            [f.filename for f in scheduler.order_downloads(
+                listing, 'newest_first')][:2],
+            ['medline14n0003.xml.gz', 'medline14n0002.xml.gz'])
+        self.assertListEqual(
+            self.ordered_names('smallest_first'),
+            ['medline14n0003.xml.gz', 'medline14n0002.xml.gz',
+             'medline14n0002.notes.txt', 'medline14n0001.xml.gz',
+             'medline14n0001.xml.gz.md5'])
+        with self.assertRaises(ValueError):
+            scheduler.order_downloads(self.make_listing(), 'largest_first')
+
+    def test_limit_downloads(self):
+        listing = self.make_listing()
+        self.assertEqual(len(scheduler.limit_downloads(listing)), 5)
+        self.assertEqual(
+            len(scheduler.limit_downloads(listing, max_files=2)), 2)
+        self.assertListEqual(
+            scheduler.limit_downloads(listing, max_bytes=970), listing[:3])
+        # Files that don't fit are skipped rather than exceeding the limit
+        self.assertListEqual(
+            scheduler.limit_downloads(listing, max_bytes=600),
+            [listing[0], listing[2], listing[3]])
+        self.assertListEqual(
+            scheduler.limit_downloads(listing[1:], max_bytes=10),
+            [listing[2]])
+        self.assertListEqual(
+            scheduler.limit_downloads(listing[1:2], max_bytes=10), [])
+
+    def test_limit_counts_new_files(self):
+        """Test that already-downloaded files don't count towards limits"""
+        db_con = downloads_db.initialize_database_connection(':memory:')
+        listing = self.make_listing()
+        downloads_db.record_downloads(listing[1:4], db_con)
+        update = downloader.ListingUpdate(
+            '/gz', None, listing,
+            *downloads_db.get_files_to_download('/gz', listing, db_con))
+        self.assertListEqual(
+            downloader.schedule_downloads(
+                update, self.output_dir, limit=1, order='archives_first'),
+            [listing[0]])
+        self.assertListEqual(
+            downloader.schedule_downloads(
+                update, self.output_dir, order='newest_first'),
+            [listing[4], listing[0]])
+
+    def test_token_bucket(self):
+        now = [0.0]
+        bucket = scheduler.TokenBucket(100, clock=lambda: now[0])
+        self.assertEqual(bucket.reserve(100), 0)
+        self.assertAlmostEqual(bucket.reserve(50), 0.5)
+        # Later reservations queue behind earlier ones
+        self.assertAlmostEqual(bucket.reserve(50), 1.0)
+        now[0] = 2.0
+        self.assertEqual(bucket.reserve(100), 0)
+        # Idle time doesn't accumulate beyond the bucket's capacity
+        now[0] = 100.0
+        self.assertEqual(bucket.reserve(100), 0)
+        self.assertAlmostEqual(bucket.reserve(100), 1.0)
+
+    def test_throttled_download(self):
+        output_dir = self.output_dir
+        data = os.urandom(30000)
+        file_info = downloader.FTPFileParams(
+            '', str(len(data)), 'a', 'a.xml.gz', '', '', '')
+        bucket = scheduler.TokenBucket(100000, capacity=10000)
+        start = time.monotonic()
+        downloader.download_file(
+            FakeFTPConnection({'a.xml.gz': data}), file_info, output_dir,
+            bucket=bucket)
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+
+TEST_DTD_URL = 'http://dtd.example.org/dtd/nlmmedlinecitationset_140101.dtd'
+
+TEST_DTDS = {
+    TEST_DTD_URL: b"""
+        <!ENTITY % common SYSTEM "nlmcommon_140101.dtd">
+        %common;
+        <!ELEMENT MedlineCitationSet (MedlineCitation*, DeleteCitation?)>
+        <!ELEMENT MedlineCitation (PMID, Article)>
+        <!ATTLIST MedlineCitation Owner CDATA #IMPLIED
+                                  Status CDATA #IMPLIED>
+        <!ELEMENT DeleteCitation (PMID+)>
+        <!ELEMENT Article (ArticleTitle)>
+        <!ELEMENT ArticleTitle (#PCDATA)>
+        """,
+    'http://dtd.example.org/dtd/nlmcommon_140101.dtd': b"""
+        <!ELEMENT PMID (#PCDATA)>
+        <!ATTLIST PMID Version CDATA #REQUIRED>
+        """}
+
+
+def write_medline_archive(file_path, pmids, deleted_pmids=(), dtd_url=None,
+                          titles=None):
+    """Write a small gzipped MedlineCitationSet to file_path"""
+    titles = titles or {}
+    citations = ''.join(
+        '<MedlineCitation Owner="NLM" Status="MEDLINE">'
+        '<PMID Version="1">%d</PMID><Article><ArticleTitle>%s'
+        '</ArticleTitle></Article></MedlineCitation>' % (
+            pmid, titles.get(pmid, 'Title %d' % pmid))
+        for pmid in pmids)
+    if deleted_pmids:
+        citations += '<DeleteCitation>%s</DeleteCitation>' % ''.join(
+            '<PMID Version="1">%d</PMID>' % pmid for pmid in deleted_pmids)
+    doctype = ''
+    if dtd_url is not None:
+        doctype = '<!DOCTYPE MedlineCitationSet PUBLIC "-//NLM//DTD Medline' \
+            ' Citation, 1st January, 2014//EN" "%s">\n' % dtd_url
+    with gzip.open(file_path, 'wt') as archive:
+        archive.write(
+            '<?xml version="1.0"?>\n%s<MedlineCitationSet>%s'
+            '</MedlineCitationSet>\n' % (doctype, citations))
+
+
+@unittest.skipIf(nlm_data_tests is None, 'lxml is required')
+class TestArchiveValidation(unittest.TestCase):
+    """Test the streaming archive checks in nlm_data_tests"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.dtd_cache = os.path.join(self.temp_dir, 'dtd_cache')
+        os.mkdir(self.dtd_cache)
+        for system_id, dtd in TEST_DTDS.items():
+            cached_path = nlm_data_tests.cached_dtd_path(
+                system_id, self.dtd_cache)
+            with open(cached_path, 'wb') as cached_dtd:
+                cached_dtd.write(dtd)
+
+    def test_is_valid_xml_uses_dtd_cache(self):
+        """Test offline validation against cached DTDs"""
+        valid = os.path.join(self.temp_dir, 'medline14n0001.xml.gz')
+        write_medline_archive(valid, range(1, 11), [11, 12], TEST_DTD_URL)
+        invalid = os.path.join(self.temp_dir, 'medline14n0002.xml.gz')
+        with gzip.open(invalid, 'wt') as archive:
+            archive.write(
+                '<!DOCTYPE MedlineCitationSet SYSTEM "%s">'
+                '<MedlineCitationSet><MedlineCitation><PMID>1</PMID>'
+                '</MedlineCitation></MedlineCitationSet>' % TEST_DTD_URL)
+
+        self.assertTrue(nlm_data_tests.is_valid_xml(
+            valid, dtd_cache_dir=self.dtd_cache))
+        self.assertFalse(nlm_data_tests.is_valid_xml(
+            invalid, dtd_cache_dir=self.dtd_cache))
+        # The parsed DTD is reused
+        self.assertIs(
+            nlm_data_tests.load_dtd(TEST_DTD_URL, self.dtd_cache),
+            nlm_data_tests.load_dtd(TEST_DTD_URL, self.dtd_cache))
+
+        result = nlm_data_tests.validate_archive(
+            invalid, dtd_cache_dir=self.dtd_cache)
+        self.assertIs(result.valid_xml, False)
+        result = nlm_data_tests.validate_archive(
+            valid, dtd_cache_dir=os.path.join(self.temp_dir, 'empty'))
+        self.assertIn('not cached', result.error)
+
+    def test_validate_archives(self):
+        small = os.path.join(self.temp_dir, 'medline14n0001.xml.gz')
+        write_medline_archive(small, range(1, 101))
+        large = os.path.join(self.temp_dir, 'medline14n0002.xml.gz')
+        write_medline_archive(
+            large, range(1, nlm_data_tests.MAX_RECORDS_PER_FILE + 2))
+        broken = os.path.join(self.temp_dir, 'medline14n0003.xml.gz')
+        with gzip.open(broken, 'wt') as archive:
+            archive.write('<MedlineCitationSet><MedlineCitation>')
+
+        results = nlm_data_tests.validate_archives(
+            [small, large, broken], processes=2, check_dtd=False)
+
+        self.assertEqual(results[0], nlm_data_tests.ValidationResult(
+            small, 100, True, None, None))
+        self.assertEqual(
+            results[1].n_records, nlm_data_tests.MAX_RECORDS_PER_FILE + 1)
+        self.assertFalse(results[1].has_30k_or_fewer_records)
+        self.assertIsNotNone(results[2].error)
+        report = nlm_data_tests.format_report(results).splitlines()
+        self.assertEqual(report[0], 'medline14n0001.xml.gz\t100\tOK')
+        self.assertTrue(report[1].endswith('FAILED: more than 30000 records'))
+        self.assertIn('ERROR', report[2])
+        self.assertTrue(nlm_data_tests.has_30k_or_fewer_records(small))
+
+
+class TestPMIDIndex(unittest.TestCase):
+    """Test indexing the archive holding each PMID"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.db_con = downloads_db.initialize_database_connection(':memory:')
+
+    def add_archive(self, record_name, pmids, deleted_pmids=(),
+                    unique_file_id=None):
+        archive_path = os.path.join(self.temp_dir, record_name + '.xml.gz')
+        write_medline_archive(archive_path, pmids, deleted_pmids)
+        self.db_con.execute(
+            'DELETE FROM nlm_archives WHERE record_name = ?', (record_name,))
+        self.db_con.execute(downloads_db.NEW_ARCHIVE_SQL, {
+            'size': 0, 'referenced_record': record_name,
+            'filename': record_name + '.xml.gz',
+            'unique_file_id': unique_file_id or record_name,
+            'modification_date': '', 'observed_md5': '', 'md5_verified': 0,
+            'download_date': '', 'output_path': archive_path,
+            'transferred_for_output': 0, 'export_location': '',
+            'downloaded_by_application': 0})
+        return archive_path
+
+    def location(self, pmid):
+        location = downloads_db.get_pmid_location(pmid, self.db_con)
+        if location is None:
+            return None
+        return location.record_name, location.deleted
+
+    def test_extract_pmids(self):
+        archive_path = self.add_archive('medline14n0747', [5, 6], [1, 2])
+        self.assertEqual(
+            pmid_index.extract_pmids(archive_path),
+            pmid_index.ArchivePMIDs([5, 6], [1, 2], None))
+        with open(archive_path, 'wb') as archive:
+            archive.write(b'not gzipped')
+        self.assertIsNotNone(pmid_index.extract_pmids(archive_path).error)
+
+    def test_index_archives(self):
+        self.add_archive('medline14n0001', [1, 2, 3])
+        self.add_archive('medline14n0747', [2], deleted_pmids=[3])
+        self.add_archive('medline14n0002', [4])
+        os.remove(os.path.join(self.temp_dir, 'medline14n0002.xml.gz'))
+
+        report = pmid_index.index_archives(self.db_con, processes=2)
+        self.assertListEqual(
+            report.indexed, ['medline14n0001', 'medline14n0747'])
+        self.assertListEqual(report.missing, ['medline14n0002'])
+        self.assertEqual(self.location(1), ('medline14n0001', False))
+        self.assertEqual(self.location(2), ('medline14n0747', False))
+        self.assertEqual(self.location(3), ('medline14n0747', True))
+        self.assertIsNone(self.location(4))
+        self.assertEqual(
+            downloads_db.get_pmid_location(1, self.db_con).download_location,
+            os.path.join(self.temp_dir, 'medline14n0001.xml.gz'))
+
+        # Only new or reissued archives are indexed again, and earlier
+        # archives never replace later locations
+        self.add_archive('medline14n0001', [1, 2, 3, 7], unique_file_id='v2')
+        report = pmid_index.index_archives(self.db_con)
+        self.assertListEqual(report.indexed, ['medline14n0001'])
+        self.assertEqual(self.location(2), ('medline14n0747', False))
+        self.assertEqual(self.location(7), ('medline14n0001', False))
+
+        # PMIDs dropped from a re-indexed archive fall back to the
+        # earlier archives mentioning them
+        self.add_archive('medline14n0747', [8], unique_file_id='747v2')
+        report = pmid_index.index_archives(self.db_con)
+        self.assertListEqual(report.indexed, ['medline14n0747'])
+        self.assertEqual(self.location(2), ('medline14n0001', False))
+        self.assertEqual(self.location(3), ('medline14n0001', False))
+        self.assertEqual(self.location(8), ('medline14n0747', False))
+
+
+class TestGzipIndex(unittest.TestCase):
+    """Test random access to citations in gzipped archives"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.archive_path = os.path.join(
+            self.temp_dir, 'medline14n0001.xml.gz')
+        # Random titles keep the archive from compressing to a handful of
+        # deflate blocks
+        self.pmids = list(range(1, 3001))
+        write_medline_archive(
+            self.archive_path, self.pmids, titles={
+                pmid: os.urandom(60).hex() for pmid in self.pmids})
+        with gzip.open(self.archive_path, 'rb') as archive:
+            self.contents = archive.read()
+
+    def expected_citation(self, pmid):
+        start = self.contents.index(
+            b'<PMID Version="1">%d</PMID>' % pmid) - len(
+                b'<MedlineCitation Owner="NLM" Status="MEDLINE">')
+        end = self.contents.index(b'</MedlineCitation>', start)
+        return self.contents[start:end + len(b'</MedlineCitation>')]
+
+    @unittest.skipIf(gzip_index._load_libz() is None, 'libz is not available')
+    def test_build_archive_index(self):
+        index = gzip_index.build_archive_index(
+            self.archive_path, span=32 * 1024)
+        self.assertIsNone(index.error)
+        self.assertGreater(len(index.points), 5)
+        self.assertListEqual(
+            [pmid for pmid, _, _ in index.citations], self.pmids)
+        # Resuming from any seek point reproduces the archive's contents
+        for point in index.points:
+            self.assertEqual(
+                gzip_index.read_uncompressed(
+                    self.archive_path, point.uncompressed_offset, 100,
+                    point),
+                self.contents[
+                    point.uncompressed_offset:
+                    point.uncompressed_offset + 100])
+
+    def test_read_uncompressed_from_start(self):
+        self.assertEqual(
+            gzip_index.read_uncompressed(self.archive_path, 5000, 300),
+            self.contents[5000:5300])
+
+    def test_extract_citation(self):
+        db_con = downloads_db.initialize_database_connection(':memory:')
+        db_con.execute(downloads_db.NEW_ARCHIVE_SQL, {
+            'size': 0, 'referenced_record': 'medline14n0001',
+            'filename': 'medline14n0001.xml.gz',
+            'unique_file_id': 'medline14n0001', 'modification_date': '',
+            'observed_md5': '', 'md5_verified': 0, 'download_date': '',
+            'output_path': self.archive_path, 'transferred_for_output': 0,
+            'export_location': '', 'downloaded_by_application': 0})
+        pmid_index.index_archives(db_con, processes=1)
+        report = gzip_index.index_archive_offsets(
+            db_con, span=32 * 1024, processes=1)
+        self.assertListEqual(report.indexed, ['medline14n0001'])
+        self.assertListEqual(
+            gzip_index.index_archive_offsets(db_con).indexed, [])
+
+        for pmid in (1, 1234, 3000):
+            self.assertEqual(
+                gzip_index.extract_citation(pmid, db_con),
+                self.expected_citation(pmid))
+        self.assertIsNone(gzip_index.extract_citation(3001, db_con))
+
+
+class TestNotifier(unittest.TestCase):
+    """Test background delivery of notifications to a local SMTP server"""
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_batches_share_a_connection(self):
+        with LocalSMTPServer() as server:
+            notifier = notifications.Notifier(
+                server.connect, 'nlm@example.com', 'admin@example.com',
+                batch_delay=0.2)
+            for i in range(3):
+                notifier.notify('Update %d' % i, 'Body %d' % i)
+            self.wait_for(lambda: notifier.sent == 1)
+            notifier.notify('Update 3', 'Body 3')
+            self.assertTrue(notifier.close())
+
+        self.assertEqual(server.connections, 1)
+        self.assertListEqual(
+            [m['Subject'] for m in server.messages],
+            ['Update 0 (and 2 more)', 'Update 3'])
+        combined = server.messages[0].get_payload()
+        for i in range(3):
+            self.assertIn('== Update %d ==\nBody %d' % (i, i), combined)
+        self.assertEqual(server.messages[1]['To'], 'admin@example.com')
+
+    def test_reconnects_after_server_drops_connection(self):
+        with LocalSMTPServer(drop_after=1) as server:
+            notifier = notifications.Notifier(
+                server.connect, 'nlm@example.com', 'admin@example.com',
+                batch_delay=0)
+            notifier.notify('First', 'Body')
+            self.wait_for(lambda: notifier.sent == 1)
+            notifier.notify('Second', 'Body')
+            self.assertTrue(notifier.close())
+        self.assertEqual(server.connections, 2)
+        self.assertEqual((notifier.sent, notifier.failed), (2, 0))
+
+    def test_failed_delivery_is_dropped(self):
+        with LocalSMTPServer(reject=1) as server:
+            notifier = notifications.Notifier(
+                server.connect, 'nlm@example.com', 'admin@example.com',
+                batch_delay=0, retries=1, retry_delay=0)
+            notifier.notify('Retried', 'Body')
+            self.assertTrue(notifier.close())
+        self.assertEqual((notifier.sent, notifier.failed), (1, 0))
+        self.assertListEqual(
+            [m['Subject'] for m in server.messages], ['Retried'])
+
+        def refuse():
+            raise ConnectionRefusedError('No mail server')
+        notifier = notifications.Notifier(
+            refuse, 'nlm@example.com', 'admin@example.com', batch_delay=0,
+            retries=2, retry_delay=0)
+        notifier.notify('Lost', 'Body')
+        self.assertTrue(notifier.close())
+        self.assertEqual((notifier.sent, notifier.failed), (0, 1))
+        self.assertIsInstance(notifier.last_error, ConnectionRefusedError)
+
+    def test_slow_server_does_not_block(self):
+        with LocalSMTPServer(delay=2) as server:
+            notifier = notifications.Notifier(
+                server.connect, 'nlm@example.com', 'admin@example.com',
+                batch_delay=0)
+            start = time.monotonic()
+            notifier.notify('Slow', 'Body')
+            self.assertFalse(notifier.close(timeout=0.2))
+            self.assertLess(time.monotonic() - start, 1)
+
+
+class TestExportWatcher(unittest.TestCase):
+    """Test detection of archives removed from the export directory"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.export_dir = os.path.join(self.temp_dir, 'exports')
+        self.output_dir = os.path.join(self.temp_dir, 'downloads')
+        os.mkdir(self.export_dir)
+        os.mkdir(self.output_dir)
+
+    def check_watcher(self, watcher):
+        self.addCleanup(watcher.close)
+        open(os.path.join(self.export_dir, 'a.xml.gz'), 'w').close()
+        watcher.wait(0.01)
+        self.assertFalse(watcher.wait(0.01))
+        os.remove(os.path.join(self.export_dir, 'a.xml.gz'))
+        self.assertTrue(watcher.wait(1))
+        self.assertFalse(watcher.wait(0.01))
+        # Losing the directory itself is reported
+        os.rename(self.export_dir, self.export_dir + '.old')
+        with self.assertRaises(export_watcher.DirectoryGoneError):
+            watcher.wait(1)
+
+    @unittest.skipIf(export_watcher._load_libc() is None,
+                     'inotify is not available')
+    def test_inotify_watcher(self):
+        self.check_watcher(export_watcher.InotifyWatcher(self.export_dir))
+
+    def test_polling_watcher(self):
+        self.check_watcher(export_watcher.PollingWatcher(self.export_dir))
+
+    def add_exported_archives(self, db_con):
+        for name in ('medline14n0001', 'medline14n0002'):
+            local_copy = os.path.join(self.output_dir, name + '.xml.gz')
+            open(local_copy, 'w').close()
+            open(os.path.join(self.export_dir, name + '.xml.gz'), 'w').close()
+            db_con.execute(downloads_db.NEW_ARCHIVE_SQL, {
+                'size': 0, 'referenced_record': name,
+                'filename': name + '.xml.gz', 'unique_file_id': name,
+                'modification_date': '', 'observed_md5': '',
+                'md5_verified': 0, 'download_date': '',
+                'output_path': local_copy, 'transferred_for_output': 1,
+                'export_location': os.path.join(
+                    self.export_dir, name + '.xml.gz'),
+                'downloaded_by_application': 0})
+
+    def consumed_records(self, db_con):
+        return [tuple(row) for row in db_con.execute(
+            'SELECT record_name FROM nlm_archives'
+            ' WHERE downloaded_by_application=1')]
+
+    def test_process_export_changes(self):
+        """Consumed archives are recorded and their local copies removed"""
+        db_con = downloads_db.initialize_database_connection(':memory:')
+        self.add_exported_archives(db_con)
+        os.remove(os.path.join(self.export_dir, 'medline14n0001.xml.gz'))
+        removed = export_watcher.process_export_changes(
+            self.export_dir, db_con, self.output_dir)
+
+        self.assertListEqual(
+            removed, [os.path.join(self.output_dir, 'medline14n0001.xml.gz')])
+        self.assertListEqual(
+            os.listdir(self.output_dir), ['medline14n0002.xml.gz'])
+        self.assertListEqual(
+            self.consumed_records(db_con), [('medline14n0001',)])
+
+    def check_replaced_export_directory(self, use_inotify):
+        db_con = downloads_db.initialize_database_connection(':memory:')
+        self.add_exported_archives(db_con)
+        polls = []
+
+        def should_stop():
+            polls.append(None)
+            if len(polls) == 2:
+                # Nothing is consumed while the directory is missing
+                os.rename(self.export_dir, self.export_dir + '.old')
+            elif len(polls) == 4:
+                self.assertListEqual(self.consumed_records(db_con), [])
+                os.mkdir(self.export_dir)
+                open(os.path.join(
+                    self.export_dir, 'medline14n0002.xml.gz'), 'w').close()
+            return len(polls) > 6
+
+        export_watcher.watch_export_directory(
+            self.export_dir, db_con, self.output_dir, poll_interval=0.01,
+            use_inotify=use_inotify, should_stop=should_stop)
+
+        self.assertListEqual(
+            self.consumed_records(db_con), [('medline14n0001',)])
+        self.assertListEqual(
+            os.listdir(self.output_dir), ['medline14n0002.xml.gz'])
+
+    @unittest.skipIf(export_watcher._load_libc() is None,
+                     'inotify is not available')
+    def test_inotify_export_directory_replaced(self):
+        self.check_replaced_export_directory(use_inotify=True)
+
+    def test_polling_export_directory_replaced(self):
+        self.check_replaced_export_directory(use_inotify=False)
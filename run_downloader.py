@@ -27,11 +27,72 @@ def handle_args():
                 file or read nlm_data_import/netrc/example.netrc.
              """)
     server_settings.add_argument(
-        'server_data_dir',
-        help='Directory containing desired files on the NLM FTP server')
+        'server_data_dir', nargs='*',
+        help="""Directory containing desired files on the NLM FTP server,
+                optionally followed by the local output and export
+                directories for its files, as
+                SERVER_DIR[:OUTPUT_DIR[:EXPORT_DIR]]. Several
+                directories are synced concurrently over a shared pool
+                of WORKERS connections (with the threads backend).
+                Not needed with --watch_exports.
+             """)
     server_settings.add_argument(
         '-l', '--limit', type=int, default=0,
-        help='Only download LIMIT files.')
+        help='Only download LIMIT new files.')
+    server_settings.add_argument(
+        '--limit_bytes', type=int, default=0,
+        help="""Download at most LIMIT_BYTES new bytes. Files that would
+        exceed the limit are skipped.""")
+    server_settings.add_argument(
+        '--order', default='listing',
+        choices=('listing', 'archives_first', 'newest_first',
+                 'smallest_first'),
+        help="""Order in which new files are downloaded. Every policy
+                except `listing` fetches each archive before its md5 and
+                notes files. Defaults to listing.
+             """)
+    server_settings.add_argument(
+        '--max_rate', type=int, default=None,
+        help="""Limit the combined download rate of all connections to
+                MAX_RATE bytes/second.
+             """)
+    server_settings.add_argument(
+        '-w', '--workers', type=int, default=1,
+        help="""Number of simultaneous FTP connections used to download
+                files. Defaults to 1.
+             """)
+    server_settings.add_argument(
+        '-b', '--backend', choices=('threads', 'asyncio'), default='threads',
+        help="""Download with a thread per FTP connection (threads) or
+                multiplex all connections on one event loop (asyncio).
+                The asyncio backend syncs a single SERVER_DATA_DIR.
+                Defaults to threads.
+             """)
+    server_settings.add_argument(
+        '--daemon', default=False, action='store_true',
+        help="""Keep running, polling SERVER_DATA_DIR over a persistent
+                connection and downloading new files as they appear.
+                Uses the threads backend.
+             """)
+    server_settings.add_argument(
+        '--poll_interval', type=float, default=300,
+        help="""Seconds between polls in daemon mode after a change.
+                Defaults to 300.
+             """)
+    server_settings.add_argument(
+        '--max_poll_interval', type=float, default=3600,
+        help="""The poll interval doubles while the listing is unchanged,
+                up to MAX_POLL_INTERVAL seconds. Defaults to 3600.
+             """)
+    server_settings.add_argument(
+        '--plan', default=False, action='store_true',
+        help="""List the files a run would download with their total
+                size, the expected duration at recent throughput and the
+                disk space needed, without downloading anything.
+             """)
+    server_settings.add_argument(
+        '--plan_format', choices=('text', 'json'), default='text',
+        help="Output format for --plan. Defaults to text.")
 
     # Download settings
     local_settings = parser.add_argument_group('LOCAL SETTINGS', '')
@@ -46,18 +107,74 @@ def handle_args():
         help="""Directory where data to be retrieved by the
                 `hypothesis_graph application server are staged.
              """)
+    local_settings.add_argument(
+        '--watch_exports', default=False, action='store_true',
+        help="""Instead of downloading, keep running and record archives
+                as soon as the application server removes them from
+                EXPORT_DIR, deleting their copies in OUTPUT_DIR.
+             """)
+    local_settings.add_argument(
+        '--audit_md5', default=False, action='store_true',
+        help="""Rehash every archive on disk (in parallel) before checking
+                archives against NLM's md5 files.
+             """)
+    local_settings.add_argument(
+        '--index_pmids', default=False, action='store_true',
+        help="""After downloading, record which archive holds the latest
+                version of each PMID in the download database.
+             """)
+    local_settings.add_argument(
+        '--index_offsets', default=False, action='store_true',
+        help="""After downloading, record gzip seek points and citation
+                offsets for each archive so single citations can be
+                extracted without decompressing whole archives.
+             """)
+    local_settings.add_argument(
+        '--metrics_log', default=None,
+        help="""Append per-file and per-run timings to this JSON-lines
+                file.
+             """)
+    local_settings.add_argument(
+        '--prometheus_textfile', default=None,
+        help="""Write last-run totals to this file for the Prometheus
+                node_exporter textfile collector.
+             """)
     # Sending debug emails (requires the send_ses_messages module - see
     # setup.py)
     debugging_settings = parser.add_argument_group('DEBUGGING SETTINGS', '')
     debugging_settings.add_argument(
         '--email_debugging', default=False, action='store_true',
-        help="Send debugging emails. Defaults to FALSE.")
+        help="""Email update summaries and failure tracebacks. Defaults
+                to FALSE.
+             """)
     debugging_settings.add_argument(
         '--from_email', required=False, help="FROM field for debugging emails")
     debugging_settings.add_argument(
         '--to_email', required=False, help="TO field for debugging emails")
+    debugging_settings.add_argument(
+        '--smtp_cfg', required=False,
+        help="SMTP server configuration file for send_ses_message")
+    debugging_settings.add_argument(
+        '--email_batch_delay', type=float, default=5,
+        help="""Seconds to wait for further notifications before sending
+                an email, so that they're combined into one. Defaults
+                to 5.
+             """)
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.email_debugging and not (
+            args.from_email and args.to_email and args.smtp_cfg):
+        parser.error('--email_debugging requires --from_email, --to_email'
+                     ' and --smtp_cfg')
+    if not (args.server_data_dir or args.watch_exports):
+        parser.error('at least one server_data_dir is required')
+    if args.daemon and len(args.server_data_dir) > 1:
+        parser.error('--daemon syncs a single server directory')
+    if args.backend == 'asyncio' and len(args.server_data_dir) > 1:
+        parser.error('--backend asyncio syncs a single server directory')
+    if args.daemon and args.plan:
+        parser.error('--plan and --daemon are mutually exclusive')
+    return args
 
 if __name__ == '__main__':
     download_nlm_data.main(handle_args())
@@ -18,6 +18,8 @@ setup(
         'nlm_data_import': ['netrc/*.netrc'],
     },
     test_suite='nlm_data_import.test',
+    # pyftpdlib serves a local stand-in for the NLM FTP server in tests
+    tests_require=['pyftpdlib'],
     author='Edward J. Stronge',
     author_email='ejstronge@gmail.com',
     description='Download XML records from the NLM',